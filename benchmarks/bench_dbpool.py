@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Round-trip cost of a status query with a new connection per query (the old
+# dbconnection() behaviour) against the pooled connections in digdok_db.
+#
+# Against a real server:
+#   python benchmarks/bench_dbpool.py --dsn "host=localhost dbname=postgres user=postgres"
+# Without a server, a stand-in with a fixed handshake and query latency:
+#   python benchmarks/bench_dbpool.py --standin --connect-ms 15 --query-ms 0.5
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import digdok_db
+
+
+class StandInCursor:
+  def __init__(self, connection):
+    self.connection = connection
+    self.description = (("status",),)
+    self.rowcount = 1
+
+  def execute(self, query, args=None):
+    time.sleep(self.connection.query_latency)
+
+  def fetchone(self):
+    return ("done",)
+
+  def fetchall(self):
+    return [("done",)]
+
+  def close(self):
+    pass
+
+
+class StandInConnection:
+  # Just enough of a psycopg2 connection for the pool and run_query()
+  def __init__(self, connect_latency, query_latency):
+    time.sleep(connect_latency)
+    self.query_latency = query_latency
+    self.closed = 0
+
+  def cursor(self):
+    return StandInCursor(self)
+
+  def commit(self):
+    pass
+
+  def rollback(self):
+    pass
+
+  def get_transaction_status(self):
+    return digdok_db.psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+  def close(self):
+    # Tearing down a connection costs a round trip too
+    time.sleep(self.query_latency)
+    self.closed = 1
+
+
+def per_query(connect, query, count):
+  # The old behaviour: connect, run one statement, close
+  for i in range(count):
+    connection = connect()
+    try:
+      digdok_db.run_query(connection, query, "select_one")
+    finally:
+      connection.close()
+
+def pooled(pool, query, count):
+  for i in range(count):
+    with pool.connection() as connection:
+      digdok_db.run_query(connection, query, "select_one")
+
+def timed(target, threads, *args):
+  workers = [threading.Thread(target=target, args=args) for i in range(threads)]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  argParser = argparse.ArgumentParser()
+  argParser.add_argument("--dsn", type=str, help="libpq connection string for a real server.")
+  argParser.add_argument("--standin", action="store_true", help="Use a stand-in server instead of PostgreSQL.")
+  argParser.add_argument("--connect-ms", type=float, default=15.0, help="Stand-in connection handshake latency.")
+  argParser.add_argument("--query-ms", type=float, default=0.5, help="Stand-in query round-trip latency.")
+  argParser.add_argument("--queries", type=int, default=200, help="Queries per thread.")
+  argParser.add_argument("--threads", type=int, default=4, help="Concurrent callers, like several stages or workers.")
+  args = argParser.parse_args()
+
+  if args.standin:
+    connect = lambda: StandInConnection(args.connect_ms / 1000, args.query_ms / 1000)
+  elif args.dsn:
+    connect = lambda: digdok_db.psycopg2.connect(args.dsn)
+  else:
+    connect = digdok_db.connect
+  query = "SELECT 1"
+
+  # Silence the per-query prints from run_query
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+  try:
+    old = timed(per_query, args.threads, connect, query, args.queries)
+    pool = digdok_db.ConnectionPool(connect, minconn=args.threads, maxconn=args.threads)
+    pool.warm()
+    new = timed(pooled, args.threads, pool, query, args.queries)
+    pool.close()
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+  total = args.queries * args.threads
+  print("Queries: " + str(total) + " on " + str(args.threads) + " thread(s)")
+  print("Connect per query: %8.3f s  %8.3f ms/query  %8.0f queries/s" % (old, old * 1000 / total, total / old))
+  print("Pooled:            %8.3f s  %8.3f ms/query  %8.0f queries/s" % (new, new * 1000 / total, total / new))
+  print("Speedup: %.1fx" % (old / new))
+  print("Pool stats: " + str(pool.stats))
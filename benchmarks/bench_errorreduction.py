@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# Threshold selection for error reduction: Python list and sort against digdok_errorreduction.
+#
+# Builds a synthetic tie point cloud (filter values and point objects with a
+# valid flag, like Metashape returns them) and times picking the percentile
+# threshold the way the error reduction functions used to, copying valid values
+# into a list and sorting it, against the numpy path in digdok_errorreduction.
+#   python benchmarks/bench_errorreduction.py --points 5000000
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import digdok_errorreduction
+
+
+class Point:
+  __slots__ = ("valid",)
+
+  def __init__(self, valid):
+    self.valid = valid
+
+def cloud(count, invalid):
+  rng = random.Random(0)
+  values = [rng.lognormvariate(0, 1) for i in range(count)]
+  points = [Point(rng.random() >= invalid) for i in range(count)]
+  return values, points
+
+def list_sort(values, points, percent, minimum):
+  list_values_valid = list()
+  for i in range(len(values)):
+    if points[i].valid:
+      list_values_valid.append(values[i])
+  list_values_valid.sort()
+  target = len(list_values_valid) - int(len(list_values_valid) * percent / 100) - 1
+  threshold = list_values_valid[target]
+  if (threshold < minimum):
+    threshold = minimum
+  return threshold
+
+def partition(values, points, percent, minimum):
+  arrays = digdok_errorreduction.point_arrays(values, points)
+  return digdok_errorreduction.threshold(*arrays, percent, minimum)
+
+def timed(target, *args):
+  start = time.perf_counter()
+  result = target(*args)
+  return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+  argParser = argparse.ArgumentParser()
+  argParser.add_argument("--points", type=int, default=2000000, help="Tie points in the synthetic cloud.")
+  argParser.add_argument("--invalid", type=float, default=0.05, help="Share of invalid points.")
+  argParser.add_argument("--percent", type=float, default=20, help="Selection percentage.")
+  argParser.add_argument("--rounds", type=int, default=3, help="Rounds, the best of each is reported.")
+  args = argParser.parse_args()
+
+  values, points = cloud(args.points, args.invalid)
+  old_times = []
+  new_times = []
+  for i in range(args.rounds):
+    seconds, old = timed(list_sort, values, points, args.percent, 0)
+    old_times.append(seconds)
+    seconds, new = timed(partition, values, points, args.percent, 0)
+    new_times.append(seconds)
+    assert old == new, "thresholds differ: " + str(old) + " != " + str(new)
+
+  old = min(old_times)
+  new = min(new_times)
+  print("Tie points: " + str(args.points) + ", " + str(args.percent) + "% selection")
+  print("List and sort:  %8.3f s" % old)
+  print("numpy:          %8.3f s" % new)
+  print("Speedup: %.1fx" % (old / new))
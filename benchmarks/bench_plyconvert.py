@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Time and memory of OBJ to binary PLY conversion for nxsbuild.
+#
+# Writes a textured grid OBJ like Metashape's exports (v with colours, vt, vn,
+# f v/vt/vn) of about --faces faces, or uses --obj, and converts it with
+# digdok_plyconvert.obj_to_ply and, if pymeshlab is installed, by loading and
+# saving it in a MeshSet the way export() used to. Peak memory is measured
+# with tracemalloc, so it covers Python and numpy allocations only:
+#   python benchmarks/bench_plyconvert.py --faces 2000000
+
+import os
+import sys
+import math
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import digdok_plyconvert
+
+try:
+  import pymeshlab
+except ImportError:
+  pymeshlab = None
+
+
+def grid_obj(path, faces):
+  side = max(2, int(math.sqrt(faces / 2)) + 1)
+  with open(path, "w") as f:
+    f.write("mtllib grid.mtl\n")
+    for y in range(side):
+      f.write("".join("v %.6f %.6f %.6f 0.5 0.25 0.75\n" % (x, y, (x * y) % 7 * 0.01) for x in range(side)))
+    for y in range(side):
+      f.write("".join("vt %.6f %.6f\n" % (x / (side - 1), y / (side - 1)) for x in range(side)))
+    f.write("vn 0 0 1\nusemtl grid\n")
+    for y in range(side - 1):
+      lines = []
+      for x in range(side - 1):
+        a = y * side + x + 1
+        b, c, d = a + 1, a + side, a + side + 1
+        lines.append("f %d/%d/1 %d/%d/1 %d/%d/1\nf %d/%d/1 %d/%d/1 %d/%d/1\n" % (a, a, b, b, d, d, a, a, d, d, c, c))
+      f.write("".join(lines))
+  with open(os.path.join(os.path.dirname(path), "grid.mtl"), "w") as f:
+    f.write("newmtl grid\nmap_Kd grid.jpg\n")
+  return 2 * (side - 1) ** 2
+
+def measure(label, function):
+  tracemalloc.start()
+  start = time.perf_counter()
+  function()
+  seconds = time.perf_counter() - start
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  print(label.ljust(12) + str(round(seconds, 2)).rjust(8) + " s" + str(round(peak / 2 ** 20, 1)).rjust(10) + " MiB peak")
+
+def meshlab(source, target):
+  ms = pymeshlab.MeshSet()
+  ms.load_new_mesh(source)
+  ms.save_current_mesh(target, binary=True, save_vertex_normal=False, save_face_color=False, save_wedge_texcoord=True)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--faces", type=int, default=1000000)
+  parser.add_argument("--obj", help="Convert this OBJ instead of a generated grid")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as folder:
+    source = args.obj
+    if not source:
+      source = os.path.join(folder, "grid.obj")
+      faces = grid_obj(source, args.faces)
+      print("Grid OBJ of " + str(faces) + " faces, " + str(round(os.path.getsize(source) / 2 ** 20, 1)) + " MiB.")
+    measure("streaming", lambda: digdok_plyconvert.obj_to_ply(source, os.path.join(folder, "streamed.ply")))
+    if pymeshlab:
+      measure("pymeshlab", lambda: meshlab(source, os.path.join(folder, "meshlab.ply")))
+    else:
+      print("pymeshlab not installed, no comparison.")
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# Planning savings of server-side prepared statements for repeated status updates.
+#
+# Builds a scratch copy of process_status in a temporary table and runs the same
+# single-column status UPDATE as plain parameterized SQL, and through PREPARE/EXECUTE
+# the way digdok_queries does it. Needs a PostgreSQL server:
+#   python benchmarks/bench_prepared.py --dsn "host=localhost dbname=postgres user=postgres"
+
+import os
+import sys
+import time
+import uuid
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import digdok_queries
+
+
+def setup(connection, rows):
+  cursor = connection.cursor()
+  columns = ", ".join(column + " text" for column in sorted(digdok_queries.STATUS_COLUMNS))
+  cursor.execute("CREATE TEMPORARY TABLE process_status (uuid uuid PRIMARY KEY, " + columns + ")")
+  uuids = [str(uuid.uuid4()) for i in range(rows)]
+  cursor.executemany("INSERT INTO process_status (uuid) VALUES (%s)", [(u,) for u in uuids])
+  cursor.execute("ANALYZE process_status")
+  connection.commit()
+  cursor.close()
+  return uuids
+
+def plain(connection, uuids, steps, count):
+  cursor = connection.cursor()
+  for i in range(count):
+    step = steps[i % len(steps)]
+    cursor.execute("UPDATE process_status SET " + step + " = %s WHERE uuid = %s", ("done", uuids[i % len(uuids)]))
+    connection.commit()
+  cursor.close()
+
+def prepared(connection, uuids, steps, count):
+  cursor = connection.cursor()
+  for step in steps:
+    cursor.execute("PREPARE bench_" + step + " AS UPDATE process_status SET " + step + " = $1 WHERE uuid = $2::uuid")
+  connection.commit()
+  for i in range(count):
+    step = steps[i % len(steps)]
+    cursor.execute("EXECUTE bench_" + step + " (%s, %s)", ("done", uuids[i % len(uuids)]))
+    connection.commit()
+  cursor.execute("DEALLOCATE ALL")
+  connection.commit()
+  cursor.close()
+
+def timed(target, *args):
+  start = time.perf_counter()
+  target(*args)
+  return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  argParser = argparse.ArgumentParser()
+  argParser.add_argument("--dsn", type=str, required=True, help="libpq connection string.")
+  argParser.add_argument("--rows", type=int, default=10000, help="Rows in the scratch status table.")
+  argParser.add_argument("--updates", type=int, default=5000, help="Status updates per run.")
+  argParser.add_argument("--rounds", type=int, default=3, help="Alternating rounds, the best of each is reported.")
+  args = argParser.parse_args()
+
+  connection = psycopg2.connect(args.dsn)
+  uuids = setup(connection, args.rows)
+  steps = sorted(digdok_queries.STATUS_COLUMNS)
+
+  plain_times = []
+  prepared_times = []
+  for i in range(args.rounds):
+    plain_times.append(timed(plain, connection, uuids, steps, args.updates))
+    prepared_times.append(timed(prepared, connection, uuids, steps, args.updates))
+  connection.close()
+
+  old = min(plain_times)
+  new = min(prepared_times)
+  print("Status updates: " + str(args.updates) + " over " + str(len(steps)) + " columns, " + str(args.rows) + " rows")
+  print("Plain SQL:     %8.3f s  %8.1f us/update" % (old, old * 1e6 / args.updates))
+  print("Prepared:      %8.3f s  %8.1f us/update" % (new, new * 1e6 / args.updates))
+  print("Saved per update: %.1f us (%.1f%%)" % ((old - new) * 1e6 / args.updates, 100 * (old - new) / old))
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#
+# Throughput of the digdok_sharpness pre-filter against Metashape's image quality estimation.
+#
+# Scores every photo of a Photos folder with the pre-filter (serially, then in a
+# process pool) and, when run inside Metashape's Python, with analyzeImages on a
+# scratch chunk, the way estimagequality() does it. Needs Pillow and numpy:
+#   python benchmarks/bench_sharpness.py --folder /data/capture/Photos
+#   metashape -r benchmarks/bench_sharpness.py --folder /data/capture/Photos
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import digdok_photos
+import digdok_sharpness
+
+try:
+  import Metashape
+except ImportError:
+  Metashape = None
+
+
+def serial(paths):
+  return [digdok_sharpness.score(path) for path in paths]
+
+def pooled(paths, workers):
+  return digdok_sharpness.score_all(paths, workers)
+
+def metashape(paths):
+  doc = Metashape.Document()
+  chunk = doc.addChunk()
+  chunk.addPhotos(paths)
+  start = time.perf_counter()
+  if hasattr(chunk, "analyzeImages"):
+    chunk.analyzeImages(chunk.cameras)
+  else:
+    chunk.analyzePhotos(chunk.cameras)
+  return time.perf_counter() - start
+
+def timed(target, *args):
+  start = time.perf_counter()
+  target(*args)
+  return time.perf_counter() - start
+
+def report(name, seconds, count):
+  print("%-22s %8.2f s  %8.1f photos/s" % (name, seconds, count / seconds))
+
+
+if __name__ == "__main__":
+  argParser = argparse.ArgumentParser()
+  argParser.add_argument("--folder", type=str, required=True, help="Folder of JPEG photos.")
+  argParser.add_argument("--limit", type=int, default=0, help="Only use the first n photos.")
+  argParser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes in the pool.")
+  args = argParser.parse_args()
+
+  if not digdok_sharpness.available():
+    sys.exit("Pillow and numpy are needed for the pre-filter.")
+  paths = [path for path, size, mtime in digdok_photos.list_photos(args.folder)]
+  if args.limit:
+    paths = paths[:args.limit]
+  print("Photos: " + str(len(paths)) + ", workers: " + str(args.workers))
+
+  report("Pre-filter, serial", timed(serial, paths), len(paths))
+  report("Pre-filter, pool", timed(pooled, paths, args.workers), len(paths))
+  if Metashape:
+    report("Metashape", metashape(paths), len(paths))
+  else:
+    print("Metashape not available, run with metashape -r to compare with analyzeImages.")
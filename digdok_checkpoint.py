@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# When to save the Metashape project.
+#
+# Saving rewrites the project on the network share, which takes a while once
+# depth maps and dense clouds exist. Instead of every stage saving after every
+# chunk, run_stages() reports stages to a Checkpoint, which saves:
+#  - after an expensive stage, whose result would take long to rebuild
+#  - before an expensive stage starts, if cheaper stages are waiting to be saved
+#  - after a cheap stage, if INTERVAL seconds passed since the last save
+#  - when a stage fails, and when the run ends
+# Cheap stages (marker and bounding box edits) are coalesced into one save.
+# While stages run side by side, a save that falls due waits until none of
+# them is running, so the document isn't written while one is changing it.
+#
+# A stage's 'done' status is only written once a save holds its result, so a
+# resumed job never skips a stage whose result was lost with an unsaved project.
+
+import time
+
+
+INTERVAL = 900 # Seconds after which a cheap stage also triggers a save
+
+# Stages that are slow to redo, saved as soon as they finish
+EXPENSIVE = frozenset([
+  "aligning",
+  "optimizing_alignment",
+  "reducing_error",
+  "building_depthmaps",
+  "building_densecloud",
+  "meshing",
+  "texturing",
+  "building_dem",
+  "building_ortho",
+])
+
+
+class Checkpoint:
+  """ Saves doc after stages according to the policy above, mark_done(step) records a stage as done """
+
+  def __init__(self, doc, mark_done, interval=INTERVAL):
+    self.doc = doc
+    self.mark_done = mark_done
+    self.interval = interval
+    self.pending = [] # Stages done since the last save
+    self.last_save = time.monotonic()
+    self.saves = [] # {"reason", "stages", "seconds"} of every save
+    self.running = set() # Stages begun and not done or failed yet
+    self.due = None # Reason of a save put off while stages were running
+
+  def save(self, reason):
+    start = time.monotonic()
+    self.doc.save()
+    seconds = time.monotonic() - start
+    self.last_save = time.monotonic()
+    self.saves.append({"reason": reason, "stages": list(self.pending), "seconds": round(seconds, 3)})
+    print("Project saved (" + reason + ") in " + str(round(seconds, 1)) + " s.")
+    pending = self.pending
+    self.pending = []
+    for step in pending:
+      self.mark_done(step)
+
+  def save_due(self, reason):
+    """ Save now, or once no stage is running any more """
+    self.due = self.due or reason
+    if not self.running:
+      reason, self.due = self.due, None
+      self.save(reason)
+
+  def begin(self, step):
+    if step in EXPENSIVE and self.pending and not self.running:
+      self.save("before " + step)
+    self.running.add(step)
+
+  def done(self, step):
+    self.running.discard(step)
+    self.pending.append(step)
+    if step in EXPENSIVE:
+      self.save_due(step)
+    elif self.due or time.monotonic() - self.last_save >= self.interval:
+      self.save_due("interval")
+
+  def failed(self, step):
+    # Keep what earlier stages did, and whatever the failed stage got through
+    self.running.discard(step)
+    self.save_due("failed " + step)
+
+  def close(self):
+    if self.pending:
+      self.save("end")
+
+  def seconds(self):
+    return sum(save["seconds"] for save in self.saves)
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+#
+# Pooled, long-lived PostgreSQL connections for the digdok scripts.
+#
+# The connection parameters are read from database.ini once, when this module
+# is imported, and every query goes through a small thread-safe pool of
+# connections. Idle connections are health-checked before they are handed out
+# again and replaced if the server has dropped them.
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from dbconfig import config
+
+
+# Pool settings, can be overridden from an optional [pool] section in database.ini
+POOL_MIN = 1
+POOL_MAX = 4
+HEALTH_CHECK_AFTER = 30 # Seconds a connection may sit idle before it is pinged again
+RETRIES = 1 # Reconnect attempts for queries that are safe to repeat
+
+# Read connection parameters once
+try:
+  params = config()
+except Exception as error:
+  params = None
+  params_error = error
+
+try:
+  pool_params = config(section='pool')
+except Exception:
+  pool_params = {}
+POOL_MIN = int(pool_params.get('minconn', POOL_MIN))
+POOL_MAX = int(pool_params.get('maxconn', POOL_MAX))
+HEALTH_CHECK_AFTER = float(pool_params.get('check_after', HEALTH_CHECK_AFTER))
+
+# Errors that mean the connection itself is gone, not that the query was bad
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class Connection(psycopg2.extensions.connection):
+  # Remembers which statements have been prepared on this server session
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.prepared = set()
+
+
+def connect():
+  """ Open a new connection to the PostgreSQL database server """
+  if params is None:
+    raise params_error
+  print('Connecting to the PostgreSQL database...')
+  return psycopg2.connect(connection_factory=Connection, **params)
+
+
+class ConnectionPool:
+  """ Thread-safe pool of long-lived connections """
+
+  def __init__(self, connect=connect, minconn=POOL_MIN, maxconn=POOL_MAX, check_after=HEALTH_CHECK_AFTER):
+    self.connect = connect
+    self.minconn = minconn
+    self.maxconn = maxconn
+    self.check_after = check_after
+    self.idle = [] # (connection, last used)
+    self.in_use = 0
+    self.closed = False
+    self.condition = threading.Condition()
+    self.stats = {"connects": 0, "reconnects": 0, "health_checks": 0}
+
+  def healthy(self, connection, last_used):
+    if connection.closed:
+      return False
+    if time.monotonic() - last_used < self.check_after:
+      return True
+    # Connection has been idle for a while, make sure the server still knows about it
+    self.stats["health_checks"] += 1
+    try:
+      cursor = connection.cursor()
+      cursor.execute("SELECT 1")
+      cursor.close()
+      connection.rollback()
+    except CONNECTION_ERRORS:
+      return False
+    return True
+
+  def new_connection(self):
+    connection = self.connect()
+    self.stats["connects"] += 1
+    return connection
+
+  def getconn(self):
+    with self.condition:
+      if self.closed:
+        raise psycopg2.InterfaceError("connection pool is closed")
+      while not self.idle and self.in_use >= self.maxconn:
+        self.condition.wait()
+      item = self.idle.pop() if self.idle else None
+      self.in_use += 1
+    try:
+      if item:
+        connection, last_used = item
+        if self.healthy(connection, last_used):
+          return connection
+        print("Pooled database connection lost, reconnecting.")
+        self.stats["reconnects"] += 1
+        self.close_quietly(connection)
+      return self.new_connection()
+    except Exception:
+      with self.condition:
+        self.in_use -= 1
+        self.condition.notify()
+      raise
+
+  def putconn(self, connection, discard=False):
+    if not discard and not connection.closed:
+      try:
+        # Never hand out a connection in the middle of a transaction
+        if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+          connection.rollback()
+      except CONNECTION_ERRORS:
+        discard = True
+    with self.condition:
+      self.in_use -= 1
+      if discard or connection.closed or self.closed or len(self.idle) >= self.maxconn:
+        self.close_quietly(connection)
+      else:
+        self.idle.append((connection, time.monotonic()))
+      self.condition.notify()
+
+  @contextmanager
+  def connection(self):
+    connection = self.getconn()
+    discard = False
+    try:
+      yield connection
+    except CONNECTION_ERRORS:
+      discard = True
+      raise
+    finally:
+      self.putconn(connection, discard)
+
+  def warm(self):
+    # Open minconn connections up front so the first queries don't pay for the handshake
+    with self.condition:
+      missing = self.minconn - len(self.idle) - self.in_use
+    for i in range(max(0, missing)):
+      connection = self.new_connection()
+      with self.condition:
+        self.idle.append((connection, time.monotonic()))
+
+  def forget_prepared(self):
+    # The server dropped its prepared statements, e.g. after DISCARD ALL
+    with self.condition:
+      for connection, last_used in self.idle:
+        connection.prepared.clear()
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      idle, self.idle = self.idle, []
+      self.condition.notify_all()
+    for connection, last_used in idle:
+      self.close_quietly(connection)
+
+  @staticmethod
+  def close_quietly(connection):
+    try:
+      connection.close()
+    except Exception:
+      pass
+
+# -----------------------------------------------------------------
+
+# One pool per process. A forked worker must not share its parent's sockets,
+# so the pool is recreated if the process id changes.
+pool = None
+pool_pid = None
+pool_lock = threading.Lock()
+
+def get_pool():
+  global pool, pool_pid
+  with pool_lock:
+    if pool is None or pool_pid != os.getpid():
+      pool = ConnectionPool()
+      pool_pid = os.getpid()
+    return pool
+
+def close_pool():
+  global pool
+  with pool_lock:
+    if pool is not None and pool_pid == os.getpid():
+      pool.close()
+    pool = None
+
+# -----------------------------------------------------------------
+
+def run_query(connection, query, type, args=None):
+  cursor = connection.cursor()
+  try:
+    cursor.execute(query, args)
+    if type in ["insert", "update"]:
+      result = cursor.fetchall() if cursor.description else None
+      connection.commit()
+      count = cursor.rowcount
+      if type == "insert":
+        print(count, "record(s) inserted.")
+      else:
+        print(count, "record(s) updated.")
+      return result or None
+    elif type == "select_one":
+      result = cursor.fetchone()
+      connection.commit()
+      if result:
+        print("One row returned.")
+        return result
+      print("No records found.")
+    elif type == "select_dict":
+      # First row as a dict keyed by column name
+      result = cursor.fetchone()
+      connection.commit()
+      if result:
+        return dict(zip([column[0] for column in cursor.description], result))
+      print("No records found.")
+    elif type == "select_all":
+      result = cursor.fetchall()
+      connection.commit()
+      if result:
+        return result
+      print("No records found.")
+    else:
+      connection.commit()
+  finally:
+    cursor.close()
+
+def execute(query, type, args=None, prepare=None):
+  """ Run a query on a pooled connection, reconnecting if the connection was lost """
+  # Inserts are not retried, a lost connection may have committed the first attempt
+  attempts = 1 if type == "insert" else 1 + RETRIES
+  for attempt in range(attempts):
+    try:
+      with get_pool().connection() as connection:
+        # prepare(connection) makes sure server-side statements the query uses exist
+        if prepare:
+          prepare(connection)
+        return run_query(connection, query, type, args)
+    except CONNECTION_ERRORS as error:
+      if attempt + 1 >= attempts:
+        raise
+      print("Database connection failed (" + str(error).strip() + "), retrying.")
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+# Duplicate photo detection before photos are added to a chunk.
+#
+# Field crews sometimes copy the same card into Photos twice. Exact duplicates
+# are found by content hash: only files that share their size with another file
+# can be identical, so only those are hashed, in a thread pool with streamed
+# reads. Near-duplicates (the same frame re-saved or resized) can optionally be
+# found with a perceptual difference hash, which needs Pillow. Digests and
+# perceptual hashes are cached in the capture's PhotoIndex.
+
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+
+WORKERS = 8
+CHUNK_SIZE = 1024 * 1024 # Bytes read at a time while hashing
+NEAR_DUPLICATES = False # Also drop near-duplicates by default, needs Pillow
+NEAR_DISTANCE = 4 # Max differing bits of two 64 bit perceptual hashes to count as near-duplicates
+
+
+def file_digest(path):
+  digest = hashlib.blake2b(digest_size=16)
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def perceptual_hash(path):
+  """ 64 bit difference hash of a 9x8 greyscale thumbnail, as hex so it fits a SQLite column """
+  with Image.open(path) as image:
+    # draft() lets the JPEG decoder downscale while decoding, much faster than a full decode
+    image.draft("L", (64, 64))
+    pixels = list(image.convert("L").resize((9, 8)).getdata())
+  bits = 0
+  for row in range(8):
+    for column in range(8):
+      bits = (bits << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+  return format(bits, "016x")
+
+def cached(index, column, paths, compute, workers=WORKERS):
+  """ {path: value} of column for paths, computing and storing the ones the index doesn't have yet """
+  values = index.get_column(column, paths)
+  missing = [path for path in paths if values.get(path) is None]
+  if missing:
+    with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+      computed = list(executor.map(compute, missing))
+    index.set_column(column, zip(missing, computed))
+    values.update(zip(missing, computed))
+  return values
+
+# -----------------------------------------------------------------
+
+def exact_duplicates(inventory, index, workers=WORKERS):
+  """ Paths that are byte-identical copies of an earlier path in the inventory """
+  by_size = defaultdict(list)
+  for path, size in zip(inventory.paths, inventory.sizes):
+    by_size[size].append(path)
+  candidates = [path for paths in by_size.values() if len(paths) > 1 for path in paths]
+  if not candidates:
+    return []
+  digests = cached(index, "digest", candidates, file_digest, workers)
+  seen = set()
+  duplicates = []
+  for path in inventory.paths:
+    digest = digests.get(path)
+    if digest is None:
+      continue
+    if digest in seen:
+      duplicates.append(path)
+    else:
+      seen.add(digest)
+  return duplicates
+
+def near_duplicates(inventory, index, exclude=(), max_distance=NEAR_DISTANCE, workers=WORKERS):
+  """ Paths whose perceptual hash is within max_distance bits of an earlier kept path """
+  if Image is None:
+    print("Pillow is not installed, skipping near-duplicate detection.")
+    return []
+  exclude = set(exclude)
+  paths = [path for path in inventory.paths if path not in exclude]
+  hashes = cached(index, "phash", paths, perceptual_hash, workers)
+  kept = []
+  duplicates = []
+  for path in paths:
+    value = int(hashes[path], 16)
+    if any(bin(value ^ other).count("1") <= max_distance for other in kept):
+      duplicates.append(path)
+    else:
+      kept.append(value)
+  return duplicates
+
+def find_duplicates(inventory, index, near=NEAR_DUPLICATES, workers=WORKERS):
+  """ Paths to leave out of the chunk, the first photo of every duplicate set is kept """
+  duplicates = exact_duplicates(inventory, index, workers)
+  print(str(len(duplicates)) + " exact duplicate photos found.")
+  if near:
+    similar = near_duplicates(inventory, index, duplicates, workers=workers)
+    print(str(len(similar)) + " near-duplicate photos found.")
+    duplicates += similar
+  return duplicates
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+#
+# Gradual selection of tie points for error reduction.
+#
+# Metashape scores every tie point for a criterion (reconstruction uncertainty,
+# projection accuracy, reprojection error). The filter values and point
+# validity are read into numpy arrays in one pass, and the threshold is taken
+# with numpy.partition instead of sorting a Python list. The same code serves
+# Metashape 1.6-1.8 (chunk.point_cloud, PointCloud.Filter) and 2.x
+# (chunk.tie_points, TiePoints.Filter).
+#
+# reduce() follows the USGS workflow: each criterion is applied repeatedly,
+# removing at most <prefix>_Percent of the points per pass, until no point
+# scores above <prefix>_Threshold or MIN_RETAINED of the points are left.
+# Cameras are re-optimized after a pass unless it removed a negligible share
+# of the points.
+
+import time
+
+import numpy
+
+try:
+  import Metashape
+except ImportError:
+  Metashape = None
+
+
+# Filter criterion name: (settings prefix of <prefix>_Percent and <prefix>_Threshold, report label), in the order they run
+CRITERIA = {
+  "ReconstructionUncertainty": ("RU", "Reconstruction Uncertainty"),
+  "ProjectionAccuracy": ("PA", "Projection Accuracy"),
+  "ReprojectionError": ("RE", "Reprojection Error"),
+}
+
+MAX_ITERATIONS = 10 # Passes per criterion
+MIN_RETAINED = 0.5 # Share of the tie points at the start of error reduction that is never removed
+NEGLIGIBLE = 0.001 # Removed share of points below which cameras aren't re-optimized
+
+
+class Selection:
+  """ Result of one gradual selection on a chunk """
+
+  __slots__ = ("criterion", "threshold", "start_points", "removed")
+
+  def __init__(self, criterion, threshold, start_points, removed):
+    self.criterion = criterion
+    self.threshold = threshold
+    self.start_points = start_points
+    self.removed = removed
+
+  def __repr__(self):
+    return "Selection(" + self.criterion + ", threshold=" + str(self.threshold) + ", start_points=" + str(self.start_points) + ", removed=" + str(self.removed) + ")"
+
+# -----------------------------------------------------------------
+
+def tie_points(chunk):
+  """ (tie point cloud, Filter class) of chunk for the running Metashape version """
+  if hasattr(chunk, "tie_points"):
+    return chunk.tie_points, Metashape.TiePoints.Filter
+  return chunk.point_cloud, Metashape.PointCloud.Filter
+
+def point_arrays(values, points):
+  """ Filter values and point validity as numpy arrays """
+  count = len(values)
+  values = numpy.fromiter(values, dtype=numpy.float64, count=count)
+  valid = numpy.fromiter((point.valid for point in points), dtype=bool, count=count)
+  return values, valid
+
+def threshold(values, valid, percent, minimum, keep=0):
+  """ Threshold leaving at most percent of the valid values above it, and at least keep values at or below it.
+  Never lower than minimum. None if no point is valid """
+  selected = values[valid]
+  if not len(selected):
+    return None
+  remove = min(int(len(selected) * percent / 100), len(selected) - keep)
+  if remove <= 0:
+    return max(float(selected.max()), minimum)
+  target = len(selected) - remove - 1
+  return max(float(numpy.partition(selected, target)[target]), minimum)
+
+def select(chunk, criterion, percent, minimum, keep=0):
+  """ Remove the tie points of chunk scoring above the criterion's threshold, returns a Selection or None """
+  cloud, Filter = tie_points(chunk)
+  filter = Filter()
+  filter.init(chunk, criterion=getattr(Filter, criterion))
+  values, valid = point_arrays(filter.values, cloud.points)
+  limit = threshold(values, valid, percent, minimum, keep)
+  if limit is None:
+    return None
+  removed = int(numpy.count_nonzero(valid & (values > limit)))
+  filter.selectPoints(limit)
+  filter.removePoints(limit)
+  return Selection(criterion, limit, int(numpy.count_nonzero(valid)), removed)
+
+# -----------------------------------------------------------------
+
+def reduce(chunk, settings, optimize):
+  """ Run every criterion on chunk until it converges, optimize(chunk) re-optimizes the cameras.
+  Returns one dict per pass with point counts and timings """
+  cloud = tie_points(chunk)[0]
+  keep = int(sum(1 for point in cloud.points if point.valid) * MIN_RETAINED)
+  iterations = []
+  for criterion, (prefix, label) in CRITERIA.items():
+    percent = getattr(settings, prefix + "_Percent")
+    minimum = getattr(settings, prefix + "_Threshold")
+    if percent is None or minimum is None:
+      # NULL in the settings row turns the criterion off
+      print(label + " filter on chunk " + chunk.label + ": no percent or threshold set, skipped.")
+      continue
+    unoptimized = 0 # Points removed since the cameras were last optimized
+    for iteration in range(1, MAX_ITERATIONS + 1):
+      start = time.perf_counter()
+      selection = select(chunk, criterion, percent, minimum, keep)
+      select_seconds = time.perf_counter() - start
+      if selection is None or not selection.removed:
+        print(label + " filter on chunk " + chunk.label + ": no points removed.")
+        break
+      unoptimized += selection.removed
+      remaining = selection.start_points - selection.removed
+
+      optimize_seconds = 0
+      optimized = unoptimized >= NEGLIGIBLE * selection.start_points
+      if optimized:
+        start = time.perf_counter()
+        optimize(chunk)
+        optimize_seconds = time.perf_counter() - start
+        unoptimized = 0
+
+      converged = selection.threshold <= minimum
+      iterations.append({
+        "chunk": chunk.label,
+        "criterion": criterion,
+        "iteration": iteration,
+        "threshold": selection.threshold,
+        "start_points": selection.start_points,
+        "removed": selection.removed,
+        "optimized": optimized,
+        "select_seconds": round(select_seconds, 3),
+        "optimize_seconds": round(optimize_seconds, 3),
+      })
+      print(
+        label + " pass " + str(iteration) + " on chunk " + chunk.label + ": threshold " + str(selection.threshold)
+        + ", " + str(selection.removed) + " of " + str(selection.start_points) + " points removed"
+        + ("" if optimized else ", cameras not re-optimized")
+      )
+      if converged:
+        print(label + " threshold " + str(minimum) + " reached.")
+        break
+      if remaining <= keep:
+        print("Tie point retention floor of " + str(keep) + " points reached.")
+        break
+    if unoptimized:
+      # Points removed by the last passes, the cameras are always optimized after each criterion
+      start = time.perf_counter()
+      optimize(chunk)
+      last = iterations[-1]
+      last["optimized"] = True
+      last["optimize_seconds"] = round(last["optimize_seconds"] + time.perf_counter() - start, 3)
+      print(label + " on chunk " + chunk.label + ": cameras optimized after " + str(unoptimized) + " removed points.")
+  return iterations
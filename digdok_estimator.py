@@ -0,0 +1,211 @@
+#!/usr/bin/python
+#
+# Runtime and memory estimates for queued captures.
+#
+# Every finished stage leaves a row in new.stage_timing (digdok_instrument.py)
+# with its wall time, peak memory, the capture's photo count and megapixels and
+# the settings that drive its cost. CostModel fits, per stage, a log-linear
+# least squares model of seconds and peak memory against those inputs. Stages
+# with fewer than MIN_SAMPLES finished runs fall back to the rough PRIORS.
+#
+# estimate_queued() fills process_status.estimated_seconds and
+# estimated_memory (sql/009_estimates.sql) for queued captures, reading their
+# photo headers from the capture's PhotoIndex if there is one, so claim_job()
+# can pick the shortest job first. A capture that can't be estimated gets
+# estimated_at only and isn't tried again until its settings change, which
+# clears the estimates of the setting group's queued captures.
+
+import math
+import os
+import time
+
+import numpy
+
+import digdok_queries
+import digdok_settings
+import digdok_photos
+
+
+MIN_SAMPLES = 8 # Finished runs of a stage before its fitted model is used
+HISTORY = 5000 # Most recent stage_timing rows used for fitting
+REFIT_SECONDS = 3600 # Refit the models at most this often
+RIDGE = 1e-3 # Keeps the fit stable when a setting never varied in the history
+
+# process_status column of each stage and the setting that turns it on
+STAGES = {
+  "estimating_iq": "est_iq_bool",
+  "aligning": "align_bool",
+  "populating_targets": "poptargets_bool",
+  "uncheckingmarkers": "uncheckmarkers_bool",
+  "adding_scalebars": "scalebar_bool",
+  "aligning_bbox": "alignbbox_bool",
+  "optimizing_alignment": "optimizealignment_bool",
+  "reducing_error": "err_red_bool",
+  "building_depthmaps": "depthmap_bool",
+  "building_densecloud": "densecloud_bool",
+  "meshing": "mesh_bool",
+  "texturing": "texture_bool",
+  "building_dem": "dem_bool",
+  "building_ortho": "ortho_bool",
+  "exporting": "export_bool",
+}
+
+# Rough starting points until there is history: (seconds per megapixel at depth map
+# quality High, peak memory in bytes per megapixel). Stages using depth maps scale
+# with the number of depth map pixels.
+PRIORS = {
+  "estimating_iq": (0.005, 0.1e6),
+  "aligning": (0.1, 0.5e6),
+  "populating_targets": (0.0005, 0.1e6),
+  "uncheckingmarkers": (0.0005, 0.1e6),
+  "adding_scalebars": (0.0005, 0.1e6),
+  "aligning_bbox": (0.0005, 0.1e6),
+  "optimizing_alignment": (0.01, 0.2e6),
+  "reducing_error": (0.05, 0.2e6),
+  "building_depthmaps": (0.25, 0.5e6),
+  "building_densecloud": (0.2, 1e6),
+  "meshing": (0.15, 1e6),
+  "texturing": (0.05, 0.5e6),
+  "building_dem": (0.03, 0.3e6),
+  "building_ortho": (0.05, 0.3e6),
+  "exporting": (0.02, 0.1e6),
+}
+DEPTHMAP_STAGES = ("building_depthmaps", "building_densecloud", "meshing")
+BASE_MEMORY = 2 * 2 ** 30 # Bytes Metashape uses before any stage
+
+
+def features(photos, megapixels, settings):
+  """ Model inputs: intercept and logs of the cost drivers """
+  return [
+    1.0,
+    math.log(max(photos, 1)),
+    math.log(max(megapixels, 1)),
+    math.log(digdok_settings.DEPTHMAP_QUALITY.get(settings["depthmap_quality"], 2)),
+    math.log(max(settings["keypoint_limit"] or 1, 1)),
+    math.log1p(max(settings["face_count_custom"] or 0, 0)),
+  ]
+
+class Estimate:
+  """ Predicted seconds and peak memory per stage of one capture """
+
+  __slots__ = ("stages",)
+
+  def __init__(self, stages):
+    self.stages = stages # status column -> (seconds, peak memory bytes)
+
+  def seconds(self):
+    return sum(seconds for seconds, memory in self.stages.values())
+
+  def memory(self):
+    return max([memory for seconds, memory in self.stages.values()] + [BASE_MEMORY])
+
+  def __repr__(self):
+    return "Estimate(" + str(round(self.seconds())) + " s, " + str(round(self.memory() / 2 ** 30, 1)) + " GiB)"
+
+# -----------------------------------------------------------------
+
+class CostModel:
+  """ Per stage log-linear models of seconds and peak memory """
+
+  def __init__(self):
+    self.coefficients = {} # stage -> (seconds coefficients, memory coefficients)
+    self.samples = {}
+
+  def fit(self, rows):
+    """ rows: (stage, wall_seconds, peak_rss_bytes, parameters dict) of finished stages """
+    by_stage = {}
+    for stage, seconds, memory, parameters in rows:
+      if not seconds or not memory or not parameters or "photos" not in parameters:
+        continue
+      try:
+        x = features(parameters["photos"], parameters["megapixels"], parameters)
+      except (KeyError, TypeError, ValueError):
+        continue
+      by_stage.setdefault(stage, []).append((x, math.log(max(seconds, 0.001)), math.log(memory)))
+
+    self.coefficients = {}
+    self.samples = {stage: len(samples) for stage, samples in by_stage.items()}
+    for stage, samples in by_stage.items():
+      if len(samples) < MIN_SAMPLES:
+        continue
+      x = numpy.array([sample[0] for sample in samples])
+      y = numpy.array([[sample[1], sample[2]] for sample in samples])
+      # Ridge regularised least squares, as an augmented lstsq problem
+      penalty = math.sqrt(RIDGE) * numpy.identity(x.shape[1])
+      penalty[0, 0] = 0 # the intercept isn't penalised
+      solution = numpy.linalg.lstsq(
+        numpy.vstack([x, penalty]), numpy.vstack([y, numpy.zeros((x.shape[1], 2))]), rcond=None
+      )[0]
+      self.coefficients[stage] = (solution[:, 0], solution[:, 1])
+    print(
+      "Cost model fitted for " + str(len(self.coefficients)) + " stages from " + str(sum(self.samples.values()))
+      + " stage runs, priors used for " + str(len(STAGES) - len(self.coefficients)) + "."
+    )
+    return self
+
+  def predict(self, photos, megapixels, settings):
+    """ Estimate for a capture with settings a ProcessingSettings """
+    values = settings.as_dict()
+    x = numpy.array(features(photos, megapixels, values))
+    stages = {}
+    for stage, enabled in STAGES.items():
+      if not values[enabled]:
+        continue
+      if stage in self.coefficients:
+        seconds_coefficients, memory_coefficients = self.coefficients[stage]
+        stages[stage] = (float(math.exp(x @ seconds_coefficients)), float(math.exp(x @ memory_coefficients)))
+      else:
+        per_megapixel, memory_per_megapixel = PRIORS[stage]
+        scale = megapixels
+        if stage in DEPTHMAP_STAGES:
+          # Depth map pixels shrink with the square of the downscale factor, High is 2
+          scale = megapixels * 4 / digdok_settings.DEPTHMAP_QUALITY.get(values["depthmap_quality"], 2) ** 2
+        stages[stage] = (per_megapixel * scale, BASE_MEMORY + memory_per_megapixel * scale)
+    return Estimate(stages)
+
+# -----------------------------------------------------------------
+
+fitted = None
+fitted_at = 0
+
+def model():
+  """ CostModel fitted on recent history, refitted every REFIT_SECONDS """
+  global fitted, fitted_at
+  if fitted is None or time.monotonic() - fitted_at > REFIT_SECONDS:
+    rows = digdok_queries.execute("stage_history", "select_all", (HISTORY,)) or []
+    fitted = CostModel().fit(rows)
+    fitted_at = time.monotonic()
+  return fitted
+
+def estimate_capture(uuid, path):
+  settings = digdok_settings.cache.get(uuid)
+  # Runs while a worker chooses its next job, so nothing is written to the capture folder:
+  # the photo index is used if the capture has one, the folder is scanned otherwise
+  if os.path.exists(path + "/" + digdok_photos.INDEX_FILE):
+    index = digdok_photos.PhotoIndex(path, readonly=True)
+    try:
+      inventory = index.inventory()
+    finally:
+      index.close()
+  else:
+    inventory = digdok_photos.scan(path + "/Photos")
+  return model().predict(len(inventory), inventory.megapixels(), settings)
+
+def estimate_queued(limit=20):
+  """ Estimate queued captures that don't have an estimate yet, returns how many were estimated """
+  captures = digdok_queries.execute("unestimated_captures", "select_all", (limit,)) or []
+  estimated = 0
+  for capture in captures:
+    uuid, path = capture[0], capture[1]
+    try:
+      estimate = estimate_capture(uuid, path)
+    except Exception as e:
+      # A capture that can't be estimated is still processed, just without an estimate.
+      # It is marked as attempted so it isn't picked again until its settings change.
+      print("Could not estimate " + str(uuid) + ": " + str(e))
+      digdok_queries.execute("estimate_failed", "update", (uuid,))
+      continue
+    print("Estimated " + str(uuid) + ": " + repr(estimate))
+    digdok_queries.execute("set_estimate", "update", (estimate.seconds(), int(estimate.memory()), uuid))
+    estimated += 1
+  return estimated
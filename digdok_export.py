@@ -0,0 +1,242 @@
+#!/usr/bin/python
+#
+# Export outputs of a job and the order they are written in.
+#
+# Each Output is one file (or set of files) written by export(): the report,
+# models, point cloud, rasters, and the PLY and Nexus files made from the
+# exported model. Outputs that call Metashape run one after the other in the
+# calling thread, as they work on the open document. External outputs (PLY
+# conversion, nxsbuild, nxsedit) run in a small thread pool as soon as the
+# output they read is written, so they overlap with the remaining Metashape
+# exports instead of forming a serial tail. An output whose input failed or
+# was not written is not run.
+#
+# Every output is timed, and the size of the files it wrote recorded, in
+# ExportPlan.results, which export() stores in new.processing.exports.
+#
+# Which outputs are made is decided by the export_formats setting, a list of
+# {"type", "format", "settings"}. Each (type, format) has an exporter in
+# EXPORTERS, registered with @exporter, which adds the outputs it needs to an
+# ExportJob. Intermediates several outputs share, like a decimated copy of the
+# model, are added under the same name and so built once, and only if an
+# output asks for them.
+
+import os
+import time
+import shutil
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+WORKERS = 3 # External outputs running at once
+NEXUS_PATH = "/home/hallvard/Apps/nexus/nexus/bin" # Searched for nxsbuild and nxsedit after PATH
+
+# Output states
+DONE = "done"
+FAILED = "failed"
+BLOCKED = "blocked" # an output it reads failed or wasn't written
+
+
+class ExportError(Exception):
+  def __init__(self, failed, blocked):
+    self.failed = failed
+    self.blocked = blocked
+    message = "Exports failed: " + ", ".join(failed)
+    if blocked:
+      message += "; not written because of them: " + ", ".join(blocked)
+    super().__init__(message)
+
+class Output:
+  """ One export. work(*inputs) writes it and returns its path, a list of paths, or None if there was
+  nothing to write. inputs are the paths returned by the outputs named in requires """
+
+  __slots__ = ("name", "work", "requires", "external")
+
+  def __init__(self, name, work, requires=(), external=False):
+    self.name = name
+    self.work = work
+    self.requires = tuple(requires)
+    self.external = external # True if it doesn't use Metashape and can run in the pool
+
+  def __repr__(self):
+    return "Output(" + self.name + ")"
+
+def size(paths):
+  total = 0
+  for path in paths:
+    try:
+      total += os.path.getsize(path)
+    except OSError:
+      pass
+  return total
+
+# -----------------------------------------------------------------
+
+class ExportPlan:
+  """ Writes outputs in dependency order, Metashape outputs serially and external ones in a pool """
+
+  def __init__(self, outputs, workers=WORKERS):
+    names = [output.name for output in outputs]
+    for output in outputs:
+      for required in output.requires:
+        if required not in names or names.index(required) >= names.index(output.name):
+          raise ValueError(output.name + " requires " + required + ", which is not listed before it")
+    self.outputs = outputs
+    self.workers = workers
+    self.states = {}
+    self.paths = {} # output name -> path returned by its work
+    self.results = [] # {"output", "outcome", "seconds", "bytes", "paths"} of every output run
+
+  def timed(self, output):
+    inputs = [self.paths[required] for required in output.requires]
+    start = time.perf_counter()
+    try:
+      written = output.work(*inputs)
+      return written, time.perf_counter() - start, None
+    except Exception as e:
+      return None, time.perf_counter() - start, e
+
+  def completed(self, output, written, seconds, error):
+    if error is None:
+      self.states[output.name] = DONE
+      self.paths[output.name] = written
+      # Intermediates may return something other than paths, e.g. a model key
+      paths = [written] if isinstance(written, str) else list(written) if isinstance(written, (list, tuple)) else []
+      result = {"output": output.name, "outcome": DONE, "seconds": round(seconds, 3), "bytes": size(paths), "paths": paths}
+      if written is None:
+        print(output.name + ": nothing to export.")
+      elif paths:
+        print(output.name + " exported in " + str(result["seconds"]) + " s, " + str(round(result["bytes"] / 2 ** 20, 1)) + " MiB: " + ", ".join(paths))
+      else:
+        print(output.name + " done in " + str(result["seconds"]) + " s.")
+    else:
+      self.states[output.name] = FAILED
+      result = {"output": output.name, "outcome": FAILED, "seconds": round(seconds, 3), "bytes": 0, "paths": [], "error": str(error)}
+      print()
+      print("!!!!! Export of " + output.name + " failed !!!!!")
+      print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+    self.results.append(result)
+
+  def ready(self, output):
+    """ True if output can be written, None if it has to wait, False if it never can """
+    for required in output.requires:
+      state = self.states.get(required)
+      if state in (FAILED, BLOCKED) or (state == DONE and self.paths[required] is None):
+        return False
+      if state is None:
+        return None
+    return True
+
+  def run(self):
+    pending = list(self.outputs)
+    running = {} # future -> output
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      while pending or running:
+        # Outputs finished in the pool while a Metashape output ran may let others start
+        for future in [future for future in running if future.done()]:
+          self.completed(running.pop(future), *future.result())
+        inline = None
+        for output in list(pending):
+          ready = self.ready(output)
+          if ready is None or (inline is not None and not output.external):
+            continue
+          pending.remove(output)
+          if ready is False:
+            self.states[output.name] = BLOCKED
+            print(output.name + " not exported, its input is missing.")
+          elif output.external:
+            running[executor.submit(self.timed, output)] = output
+          else:
+            inline = output
+        if inline is not None:
+          # External outputs keep running in the pool meanwhile
+          self.completed(inline, *self.timed(inline))
+          continue
+        if not running:
+          continue
+        finished, not_done = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+          self.completed(running.pop(future), *future.result())
+
+    failed = [name for name, state in self.states.items() if state == FAILED]
+    if failed:
+      raise ExportError(failed, [name for name, state in self.states.items() if state == BLOCKED])
+    return self.results
+
+# -----------------------------------------------------------------
+
+# Outputs made when export_formats is empty, the exports before export_formats was used
+DEFAULT_FORMATS = [
+  {"type": "report", "format": "pdf"},
+  {"type": "mesh", "format": "obj"},
+  {"type": "mesh", "format": "ply", "settings": {"faces": 500000, "texture": True}},
+  {"type": "mesh", "format": "nxz"},
+  {"type": "points", "format": "laz"},
+  {"type": "dem", "format": "tiff"},
+  {"type": "ortho", "format": "tiff"},
+]
+
+EXPORTERS = {} # (type, format) -> function(job, chunk, prefix, settings) adding outputs to job
+
+def exporter(type, format):
+  """ Register the decorated function as the exporter of type and format """
+  def register(function):
+    EXPORTERS[(type, format)] = function
+    return function
+  return register
+
+class ExportJob:
+  """ Outputs of one export, each added once however many exporters need it """
+
+  def __init__(self, folder, name, shift=None, comment=None):
+    self.folder = folder # Output folder, ending in a separator
+    self.name = name # Appended to file names, the processing uuid
+    self.shift = shift # Offset subtracted from coordinates in short_coords outputs
+    self.comment = comment
+    self.outputs = []
+    self.names = set()
+
+  def add(self, output):
+    """ Add output unless one of the same name was added, returns its name """
+    if output.name not in self.names:
+      self.names.add(output.name)
+      self.outputs.append(output)
+    return output.name
+
+  def request(self, chunk, prefix, formats):
+    """ Add the outputs of formats, a list of {"type", "format", "settings"}, for chunk """
+    for spec in formats:
+      key = (spec.get("type"), spec.get("format"))
+      if key not in EXPORTERS:
+        print("No exporter for " + str(key[0]) + " as " + str(key[1]) + ", skipped. Known: "
+          + ", ".join(type + "/" + format for type, format in sorted(EXPORTERS)))
+        continue
+      EXPORTERS[key](self, chunk, prefix, spec.get("settings") or {})
+
+  def plan(self, workers=WORKERS):
+    return ExportPlan(self.outputs, workers)
+
+# -----------------------------------------------------------------
+# External outputs
+
+def nexus_tool(name):
+  found = shutil.which(name) or shutil.which(name, path=NEXUS_PATH)
+  if not found:
+    raise FileNotFoundError(name + " not found in PATH or " + NEXUS_PATH)
+  return found
+
+def nexus(filename_ply, filename_nxs=None):
+  """ Multiresolution Nexus file of a PLY, next to it if filename_nxs isn't given """
+  filename_nxs = filename_nxs or os.path.splitext(filename_ply)[0] + ".nxs"
+  try:
+    subprocess.run([nexus_tool("nxsbuild"), filename_ply, "-o", filename_nxs], check=True)
+  except subprocess.CalledProcessError:
+    subprocess.run([nexus_tool("nxsbuild"), "-G", filename_ply, "-o", filename_nxs], check=True)
+  return filename_nxs
+
+def nexus_compressed(filename_nxs):
+  """ Compressed .nxz of a Nexus file, for the web viewer """
+  filename_nxz = os.path.splitext(filename_nxs)[0] + ".nxz"
+  subprocess.run([nexus_tool("nxsedit"), "-z", filename_nxs, "-o", filename_nxz], check=True)
+  return filename_nxz
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+#
+# Resource use of processing stages.
+#
+# For every stage Instrument records wall time, CPU time, peak resident memory,
+# how much the capture folder grew (project files and exports, the Photos
+# folder is left out) and the camera, tie point, dense point and face counts
+# after the stage. Rows go to new.stage_timing (sql/008_stage_timing.sql) in
+# db mode, or to a JSON lines file in standalone mode, and carry the settings
+# that drive stage cost so runs with different settings can be compared.
+#
+# Memory is sampled by a background thread while a stage runs, with psutil if
+# it is installed and /proc/self/statm otherwise. CPU time and memory are for
+# the whole process, so stages running side by side share them.
+
+import os
+import json
+import time
+import socket
+import threading
+from datetime import datetime, timezone
+
+import digdok_queries
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+
+SAMPLE_INTERVAL = 1 # Seconds between memory samples
+SKIP_FOLDERS = ("Photos",) # Not counted in bytes written
+
+# Settings stored with every row
+PARAMETERS = [
+  "setting_group",
+  "keypoint_limit",
+  "tiepoint_limit",
+  "depthmap_quality",
+  "depthmap_filter",
+  "face_count_custom",
+  "texture_size",
+  "uv_pages",
+  "dem_resolution",
+  "ortho_resolution",
+]
+
+
+def rss():
+  """ Resident memory of this process in bytes, None if it can't be read """
+  if psutil:
+    return psutil.Process().memory_info().rss
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+def folder_size(folder, skip=SKIP_FOLDERS):
+  total = 0
+  try:
+    entries = list(os.scandir(folder))
+  except OSError:
+    return 0
+  for entry in entries:
+    try:
+      if entry.is_dir(follow_symlinks=False):
+        if entry.name not in skip:
+          total += folder_size(entry.path, skip)
+      elif entry.is_file(follow_symlinks=False):
+        total += entry.stat().st_size
+    except OSError:
+      pass
+  return total
+
+def counts(doc):
+  """ Camera, tie point, dense point and face counts over the chunks of doc """
+  result = {"cameras": 0, "cameras_enabled": 0, "tie_points": 0, "dense_points": 0, "faces": 0}
+  for chunk in doc.chunks:
+    result["cameras"] += len(chunk.cameras)
+    result["cameras_enabled"] += sum(1 for camera in chunk.cameras if camera.enabled)
+    # Metashape 2.x renamed point_cloud to tie_points and dense_cloud to point_cloud
+    if hasattr(chunk, "tie_points"):
+      tie_points, dense = chunk.tie_points, chunk.point_cloud
+    else:
+      tie_points, dense = chunk.point_cloud, getattr(chunk, "dense_cloud", None)
+    if tie_points:
+      result["tie_points"] += len(tie_points.points)
+    if dense:
+      result["dense_points"] += dense.point_count
+    if chunk.model:
+      result["faces"] += len(chunk.model.faces)
+  return result
+
+# -----------------------------------------------------------------
+
+class DatabaseSink:
+  """ Rows into new.stage_timing for one processing uuid """
+
+  def __init__(self, processing_uuid):
+    self.processing_uuid = processing_uuid
+
+  def record(self, row):
+    digdok_queries.execute("insert_stage_timing", "insert", (
+      self.processing_uuid, row["stage"], row["outcome"], row["started_at"], row["wall_seconds"],
+      row["cpu_seconds"], row["peak_rss_bytes"], row["bytes_written"],
+      json.dumps(row["counts"]), json.dumps(row["parameters"]), row["worker_id"]
+    ))
+
+class JsonLinesSink:
+  """ Rows appended to a JSON lines file """
+
+  def __init__(self, path):
+    self.path = path
+
+  def record(self, row):
+    with open(self.path, "a") as f:
+      f.write(json.dumps(row) + "\n")
+
+class Instrument:
+  """ Measures stages between begin(stage) and end(stage, outcome) and records them in sinks """
+
+  def __init__(self, sinks, folder, counts=None, parameters=None):
+    self.sinks = sinks
+    self.folder = folder
+    self.counts = counts # Called after each stage for the document counts
+    self.parameters = parameters or {}
+    self.worker_id = socket.gethostname() + ":" + str(os.getpid()) # Same as digdok_queue.worker_id
+    self.active = {} # stage -> start values
+    self.lock = threading.Lock()
+    self.sampler = None
+
+  def sample(self):
+    while True:
+      with self.lock:
+        if not self.active:
+          self.sampler = None
+          return
+        current = rss()
+        if current is not None:
+          for start in self.active.values():
+            start["peak"] = max(start["peak"] or 0, current)
+      time.sleep(SAMPLE_INTERVAL)
+
+  def begin(self, stage):
+    start = {
+      "started_at": datetime.now(timezone.utc),
+      "wall": time.perf_counter(),
+      "cpu": time.process_time(),
+      "peak": rss(),
+      "size": folder_size(self.folder),
+    }
+    with self.lock:
+      self.active[stage] = start
+      if self.sampler is None:
+        self.sampler = threading.Thread(target=self.sample, name="digdok-instrument", daemon=True)
+        self.sampler.start()
+
+  def end(self, stage, outcome):
+    with self.lock:
+      start = self.active.pop(stage, None)
+    if start is None:
+      return
+    peak = rss()
+    if peak is not None and start["peak"] is not None:
+      peak = max(peak, start["peak"])
+    try:
+      document = self.counts() if self.counts else {}
+    except Exception as e:
+      print("Could not count document contents: " + str(e))
+      document = {}
+    row = {
+      "stage": stage,
+      "outcome": outcome,
+      "started_at": start["started_at"].isoformat(),
+      "wall_seconds": round(time.perf_counter() - start["wall"], 3),
+      "cpu_seconds": round(time.process_time() - start["cpu"], 3),
+      "peak_rss_bytes": peak,
+      "bytes_written": max(0, folder_size(self.folder) - start["size"]),
+      "counts": document,
+      "parameters": self.parameters,
+      "worker_id": self.worker_id,
+    }
+    print(
+      stage + ": " + str(row["wall_seconds"]) + " s wall, " + str(row["cpu_seconds"]) + " s CPU, peak "
+      + (str(round(peak / 2 ** 30, 2)) + " GiB" if peak else "memory unknown") + ", "
+      + str(round(row["bytes_written"] / 2 ** 20, 1)) + " MiB written"
+    )
+    # Instrumentation never fails a job
+    for sink in self.sinks:
+      try:
+        sink.record(row)
+      except Exception as e:
+        print("Could not record stage timing in " + type(sink).__name__ + ": " + str(e))
@@ -1,36 +1,116 @@
 #!/usr/bin/python
 #
+import os
+import signal
+import argparse
 import digdok_metashape as dd
+import digdok_queue as queue
+import digdok_estimator as estimator
+import digdok_supervisor as supervisor
+import digdok_meshpost as meshpost
 
 MODE = "db"
+POLL_INTERVAL = 60 # Seconds between fallback polls in daemon mode, in case a notification is missed
 
 
-def get_project_queue():
-    query = "SELECT COUNT(*) FROM new.view_process_location"
-    count = int(dd.dbconnection(query, "select_one")[0])
-    print(str(count) + " projects in queue.")
-    return count
+class Shutdown:
+    # First SIGINT/SIGTERM lets the current job finish, a second one stops immediately
+    def __init__(self):
+        self.requested = False
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.write_fd, False)
+        signal.signal(signal.SIGINT, self.handle)
+        signal.signal(signal.SIGTERM, self.handle)
 
+    def handle(self, signum, frame):
+        if self.requested:
+            raise KeyboardInterrupt
+        self.requested = True
+        print()
+        print("Shutdown requested, finishing current job. Signal again to stop now.")
+        # Wake up the listener if it is waiting
+        try:
+            os.write(self.write_fd, b"x")
+        except BlockingIOError:
+            pass
 
-if __name__ == "__main__":
-    if MODE == "db":
-        project_count = get_project_queue()
-        while project_count > 0:
-            print("Loading project.")
+
+def run_job(capture):
+    # Run one claimed capture, keeping its lease alive until it is done
+    uuid = capture[0]
+    with queue.Lease(uuid):
+        try:
+            dd.run(MODE, capture)
+        except Exception as e:
+            # Set status failed
             print()
-            try:
-                uuid = dd.run(MODE)
-            except Exception as e:
-                # Set status failed
-                print()
-                print("!!!!! Exception !!!!!")
-                print(e)
-                print()
-                dd.update_status(uuid, "status", "failed")
-            else:
-                # Set status done
-                dd.update_status(uuid, "status", "done")
-            project_count = get_project_queue()
-        print("Project queue is empty. Exiting.")
-    else:
+            print("!!!!! Exception !!!!!")
+            print(e)
+            print()
+            queue.finish_job(uuid, "failed")
+        else:
+            # Set status done
+            queue.finish_job(uuid, "done")
+
+
+def claim(order):
+    if order in ("sjf", "priority"):
+        # Newly queued captures need an estimate before they can be ordered by it or fitted in the node's memory
+        estimator.estimate_queued()
+    return queue.claim_job(order=order)
+
+
+def drain(shutdown, order="queue"):
+    # Claim jobs one at a time until the queue is empty, other workers skip the ones we hold
+    capture = claim(order)
+    while capture:
+        print("Loading project.")
+        print()
+        run_job(capture)
+        if shutdown.requested:
+            return
+        capture = claim(order)
+
+
+def work(daemon=False, poll_interval=POLL_INTERVAL, order="queue"):
+    # Process queued captures in this process until the queue is empty, or until shutdown in daemon mode
+    if MODE != "db":
         dd.run(MODE)
+        meshpost.wait()
+        return
+    shutdown = Shutdown()
+    if daemon:
+        listener = queue.Listener(shutdown.read_fd)
+        while not shutdown.requested:
+            drain(shutdown, order)
+            if shutdown.requested:
+                break
+            print("Project queue is empty. Waiting for new captures.")
+            listener.wait(poll_interval)
+        listener.close()
+        print("Worker stopped.")
+    else:
+        drain(shutdown, order)
+        if not shutdown.requested:
+            print("Project queue is empty. Exiting.")
+    # Models still being post-processed belong to finished jobs
+    meshpost.wait()
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("-d", "--daemon", action="store_true", help="Keep running and wait for new captures instead of exiting when the queue is empty.")
+    argParser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="Daemon mode: longest wait between queue checks, in seconds.")
+    argParser.add_argument("--order", choices=sorted(queue.ORDERS), default="queue", help="Order to take captures in: 'queue' (view order), 'sjf' (shortest estimated job first) or 'priority' (highest priority, aged by time queued).")
+    argParser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes to run on this node, each processing its own capture.")
+    argParser.add_argument("--log-folder", help="With several workers: write each worker's output to worker-N.log in this folder.")
+    args = argParser.parse_args()
+
+    if args.workers > 1 and MODE == "db":
+        supervisor.Supervisor(
+            args.workers,
+            {"daemon": args.daemon, "poll_interval": args.poll_interval, "order": args.order},
+            args.log_folder
+        ).run()
+    else:
+        work(args.daemon, args.poll_interval, args.order)
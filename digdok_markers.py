@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Marker (ground control point) errors of a chunk, computed in bulk.
+#
+# Reference locations are converted to geocentric coordinates and their local
+# east/north/up frames looked up once per marker and kept, since they only
+# change when the reference does. Estimated positions are taken through the
+# chunk transform as one matrix product, and the errors rotated into the local
+# frames together. Results are cached per chunk until the chunk transform, its
+# coordinate system or a marker changes, so asking again after a stage that
+# moved nothing is free. The cache is cleared whenever a new document is loaded.
+#
+# Markers without an estimated position or reference location are left out
+# instead of failing the whole computation.
+
+import math
+
+import numpy
+
+
+class MarkerErrors:
+  """ RMSE of the markers of a chunk, in metres """
+
+  __slots__ = ("labels", "errors", "control")
+
+  def __init__(self, labels, errors, control):
+    self.labels = labels # Marker labels
+    self.errors = errors # (n, 3) east, north, up error of each marker
+    self.control = control # (n,) True for control points, False for check points
+
+  def __len__(self):
+    return len(self.labels)
+
+  def sum_squared(self, mask=None):
+    errors = self.errors if mask is None else self.errors[mask]
+    return float((errors ** 2).sum())
+
+  @staticmethod
+  def rmse(errors):
+    if not len(errors):
+      return 0
+    return float(math.sqrt((errors ** 2).sum(axis=1).mean()))
+
+  def total(self):
+    return self.rmse(self.errors)
+
+  def axes(self):
+    """ (east, north, up) RMSE """
+    if not len(self):
+      return (0, 0, 0)
+    return tuple(float(value) for value in numpy.sqrt((self.errors ** 2).mean(axis=0)))
+
+  def markers(self):
+    """ {label: total error} """
+    return dict(zip(self.labels, (float(value) for value in numpy.linalg.norm(self.errors, axis=1))))
+
+  def control_points(self):
+    return self.rmse(self.errors[self.control])
+
+  def check_points(self):
+    return self.rmse(self.errors[~self.control])
+
+  def summary(self):
+    east, north, up = self.axes()
+    return (
+      str(len(self)) + " markers, RMSE " + str(round(self.total(), 4)) + " m (E " + str(round(east, 4))
+      + ", N " + str(round(north, 4)) + ", U " + str(round(up, 4)) + "), control "
+      + str(round(self.control_points(), 4)) + " m, check " + str(round(self.check_points(), 4)) + " m"
+    )
+
+# -----------------------------------------------------------------
+
+def matrix(m, size):
+  return numpy.array([[m[row, column] for column in range(size)] for row in range(size)])
+
+def vector(v):
+  return (v.x, v.y, v.z)
+
+def crs_key(chunk):
+  """ The chunk's coordinate system as a comparable value, None without one """
+  return chunk.crs.wkt if chunk.crs else None
+
+class MarkerErrorCache:
+  """ MarkerErrors per chunk, recomputed when the chunk transform, coordinate system or a marker changes """
+
+  def __init__(self):
+    self.results = {} # chunk key -> (state, MarkerErrors)
+    self.references = {} # (chunk key, CRS, marker key, reference location) -> (geocentric location, local frame rotation)
+
+  def reference(self, chunk, marker):
+    """ Geocentric reference location and local frame rotation of marker """
+    location = vector(marker.reference.location)
+    key = (chunk.key, crs_key(chunk), marker.key, location)
+    if key not in self.references:
+      if chunk.crs:
+        source = chunk.crs.unproject(marker.reference.location)
+        # Rotation only: the frame's translation cancels out of a difference
+        frame = matrix(chunk.crs.localframe(source), 4)[:3, :3]
+        self.references[key] = (vector(source), frame)
+      else:
+        self.references[key] = (location, numpy.identity(3))
+    return self.references[key]
+
+  def errors(self, chunk):
+    if chunk.transform.matrix is None:
+      return MarkerErrors([], numpy.zeros((0, 3)), numpy.zeros(0, dtype=bool))
+    markers = [
+      marker for marker in chunk.markers
+      if marker.position is not None and marker.reference.location is not None
+    ]
+    transform = matrix(chunk.transform.matrix, 4)
+    state = (
+      transform.tobytes(),
+      crs_key(chunk),
+      tuple((marker.key, vector(marker.position), vector(marker.reference.location), marker.reference.enabled) for marker in markers),
+    )
+    cached = self.results.get(chunk.key)
+    if cached and cached[0] == state:
+      return cached[1]
+
+    labels = [marker.label for marker in markers]
+    control = numpy.array([bool(marker.reference.enabled) for marker in markers], dtype=bool)
+    if markers:
+      positions = numpy.array([vector(marker.position) for marker in markers])
+      references = [self.reference(chunk, marker) for marker in markers]
+      sources = numpy.array([source for source, frame in references])
+      frames = numpy.array([frame for source, frame in references])
+      estimated = positions @ transform[:3, :3].T + transform[:3, 3]
+      errors = numpy.einsum("nij,nj->ni", frames, estimated - sources)
+    else:
+      errors = numpy.zeros((0, 3))
+    result = MarkerErrors(labels, errors, control)
+    self.results[chunk.key] = (state, result)
+    return result
+
+  def clear(self):
+    self.results.clear()
+    self.references.clear()
+
+cache = MarkerErrorCache()
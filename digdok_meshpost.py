@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Mesh post-processing with pymeshlab, outside Metashape.
+#
+# process() loads an exported model into a pymeshlab.MeshSet and, as asked,
+# removes duplicate and unreferenced vertices and duplicate faces, repairs
+# non-manifold edges and vertices, decimates by quadric edge collapse (keeping
+# texture coordinates if the model has them) and recomputes normals, then
+# saves it. Models come already shifted by short_coords: Metashape applies the
+# offset in double precision, pymeshlab would do it on float32 coordinates.
+#
+# Models are processed in a pool of worker processes that lives as long as the
+# worker, so export() only hands a model over and the job carries on, or the
+# worker claims its next capture, while the mesh work runs. done(result) is
+# called when a model is finished, from a pool thread. wait() blocks until
+# everything handed over is finished and recorded, before the worker exits.
+#
+# pymeshlab renamed its filters in 2022.2, both names are tried.
+
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+WORKERS = max(1, (os.cpu_count() or 1) // 8) # Models processed at once
+
+# Step -> filter names, newest pymeshlab first
+FILTERS = {
+  "duplicate_vertices": ("meshing_remove_duplicate_vertices", "remove_duplicate_vertices"),
+  "duplicate_faces": ("meshing_remove_duplicate_faces", "remove_duplicate_faces"),
+  "unreferenced_vertices": ("meshing_remove_unreferenced_vertices", "remove_unreferenced_vertices"),
+  "non_manifold_edges": ("meshing_repair_non_manifold_edges", "repair_non_manifold_edges_by_removing_faces"),
+  "non_manifold_vertices": ("meshing_repair_non_manifold_vertices", "repair_non_manifold_vertices_by_splitting"),
+  "decimate": ("meshing_decimation_quadric_edge_collapse", "simplification_quadric_edge_collapse_decimation"),
+  "decimate_textured": ("meshing_decimation_quadric_edge_collapse_with_texture", "simplification_quadric_edge_collapse_decimation_with_texture"),
+  "vertex_normals": ("compute_normal_per_vertex", "re_compute_vertex_normals"),
+  "face_normals": ("compute_normal_per_face", "re_compute_face_normals"),
+}
+CLEAN = ["duplicate_vertices", "duplicate_faces", "non_manifold_edges", "non_manifold_vertices", "unreferenced_vertices"]
+
+
+def apply(ms, step, **params):
+  """ Run step with the filter name this pymeshlab has, returns the name """
+  for name in FILTERS[step]:
+    if hasattr(ms, name):
+      getattr(ms, name)(**params)
+      return name
+  raise RuntimeError("pymeshlab has no filter for " + step + ", tried " + ", ".join(FILTERS[step]))
+
+def process(source, target, faces=0, clean=True, normals=True, binary=True):
+  """ Post-process the model in source into target, returns a dict describing what was done """
+  import pymeshlab
+  start = time.perf_counter()
+  ms = pymeshlab.MeshSet()
+  ms.load_new_mesh(source)
+  mesh = ms.current_mesh()
+  result = {"source": source, "path": target, "faces_before": mesh.face_number(), "steps": []}
+
+  if clean:
+    for step in CLEAN:
+      result["steps"].append(apply(ms, step))
+  textured = ms.current_mesh().has_wedge_tex_coord()
+  if faces and ms.current_mesh().face_number() > faces:
+    if textured:
+      result["steps"].append(apply(ms, "decimate_textured", targetfacenum=faces, preserveboundary=True))
+    else:
+      result["steps"].append(apply(ms, "decimate", targetfacenum=faces, preserveboundary=True, preservenormal=True))
+  if normals:
+    result["steps"].append(apply(ms, "face_normals"))
+    result["steps"].append(apply(ms, "vertex_normals"))
+
+  save_options = dict(save_wedge_texcoord=textured)
+  if target.lower().endswith(".ply"):
+    # Only the PLY writer has a binary option
+    save_options["binary"] = binary
+  ms.save_current_mesh(target, **save_options)
+  result["faces"] = ms.current_mesh().face_number()
+  result["seconds"] = round(time.perf_counter() - start, 3)
+  result["bytes"] = os.path.getsize(target)
+  return result
+
+# -----------------------------------------------------------------
+
+executor = None
+executor_lock = threading.Lock()
+pending = set() # Futures not finished and recorded yet
+pending_changed = threading.Condition()
+
+def pool():
+  global executor
+  with executor_lock:
+    if executor is None:
+      # Spawned, not forked: the worker holds Metashape and database connections
+      executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return executor
+
+def finished(future, done):
+  error = future.exception()
+  if error is None:
+    result = dict(future.result(), outcome="done")
+    print("Mesh post-processing of " + result["source"] + " done in " + str(result["seconds"]) + " s, "
+      + str(result["faces_before"]) + " -> " + str(result["faces"]) + " faces: " + result["path"])
+  else:
+    result = {"outcome": "failed", "error": str(error)}
+    print("!!!!! Mesh post-processing failed: " + str(error) + " !!!!!")
+  if done:
+    try:
+      done(result)
+    except Exception as e:
+      print("Could not record mesh post-processing: " + str(e))
+  with pending_changed:
+    pending.discard(future)
+    pending_changed.notify_all()
+
+def submit(source, target, done=None, **options):
+  """ Hand source over for process(source, target, **options) and return at once """
+  global executor
+  try:
+    future = pool().submit(process, source, target, **options)
+  except (OSError, BrokenProcessPool) as e:
+    # Embedded interpreters can't always start worker processes
+    print("Process pool unavailable (" + str(e) + "), post-processing meshes in a thread.")
+    with executor_lock:
+      executor = ThreadPoolExecutor(max_workers=WORKERS)
+    future = executor.submit(process, source, target, **options)
+  with pending_changed:
+    pending.add(future)
+  future.add_done_callback(lambda future: finished(future, done))
+  print("Mesh post-processing of " + source + " handed over, " + str(len(pending)) + " models in progress.")
+  return future
+
+def wait():
+  """ Block until every model handed over is finished """
+  with pending_changed:
+    if pending:
+      print("Waiting for post-processing of " + str(len(pending)) + " models.")
+    while pending:
+      pending_changed.wait()
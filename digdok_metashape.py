@@ -15,11 +15,27 @@ from datetime import datetime, date
 import math
 import csv
 import json
-import subprocess
 import Metashape
-import pymeshlab
 import psycopg2
-from dbconfig import config
+import digdok_db
+import digdok_queries
+import digdok_settings
+import digdok_photos
+import digdok_dedup
+import digdok_sharpness
+import digdok_errorreduction
+import digdok_markers
+import digdok_instrument
+import digdok_scheduler
+import digdok_offload
+import digdok_export
+import digdok_meshpost
+import digdok_plyconvert
+from digdok_settings import ProcessingSettings
+from digdok_status import StatusCache
+from digdok_checkpoint import Checkpoint
+from digdok_stages import Stage, Pipeline
+from digdok_export import Output, ExportJob, exporter
 
 
 # Variables
@@ -32,413 +48,160 @@ csvformat = Metashape.ReferenceFormatCSV #format of file is comma delimited
 # Modes: db, standalone
 # mode = "db"
 
+# Cached process_status row of the current job, see digdok_status.py
+status_cache = None
+
+# Project saves of the current job, see digdok_checkpoint.py
+checkpoint = None
+
+# Stage resource use of the current job, see digdok_instrument.py
+instrument = None
+
+# Photos of the current capture, see digdok_photos.py
+photo_inventory = None
+duplicates_dropped = 0 # Duplicate photos left out of the chunk, see digdok_dedup.py
+photo_sharpness = {} # Pre-filter sharpness score by normalized photo path, see digdok_sharpness.py
+
 def vars(uuid):
-  # Declaring vars as global:
-  global setting_group
-  ## Workflow
-  global est_iq_bool
-  global align_bool
-  global poptargets_bool
-  global uncheckmarkers_bool
-  global scalebar_bool
-  global alignbbox_bool
-  global optimizealignment_bool
-  global err_red_bool
-  global depthmap_bool
-  global densecloud_bool
-  global mesh_bool
-  global texture_bool
-  global dem_bool
-  global ortho_bool
-  ## Image quality
-  global iq_threshold
-  ## Error correction Percentages
-  global RU_Percent
-  global PA_Percent
-  global RE_Percent
-  ## Error correction Thresholds
-  global RU_Threshold
-  global PA_Threshold
-  global RE_Threshold
-  ## Depthmaps settings
-  global depthmap_quality
-  global depthmap_filter
-  ## CRS
-  global crs
-  ## Image alignment settings
-  global keypoint_limit
-  global tiepoint_limit
-  global generic_preselection_bool
-  global reference_preselection_bool
-  ## UV and Texture settings
-  global uv_pages
-  global texture_size
-  global ghosting_filter_bool
-  global blending_mode
-  global texture_type
-  global fill_holes_bool
-  ## Model/mesh settings
-  global surface_type
-  global interpolation
-  global face_count_custom
-  global source_data
-  global vertex_colors_bool
-  global vertex_confidence_bool
-  ##DEM settings
-  global dem_datasource
-  global dem_interpolation
-  global dem_resolution
-  global dem_params
-  ## Orthos settings
-  global ortho_surfacedata
-  global ortho_blending_mode
-  global ortho_fill_holes_bool
-  global ortho_ghosting_filter_bool
-  global ortho_cull_faces_bool
-  global ortho_refine_seamlines_bool
-  global ortho_resolution
-  ## Export settings
-  global export_bool
-  global short_coords
-  global export_formats
-
-
-  # If db mode, get vars from DB
+  # Settings for this job, shared with the other functions through the global settings object
+  global settings
+
+  # If db mode, get settings from DB, reusing the cached setting group if it hasn't changed
   if mode == "db":
-    query = (
-      "SELECT settings.*"
-      "FROM new.process_settings settings "
-      "JOIN new.process_status proc ON proc.settings_uuid = settings.uuid "
-      "WHERE proc.uuid = '" + uuid + "';"
-    )
-    settings = dbconnection(query, "select_one")
+    settings = digdok_settings.cache.get(uuid)
 
     print("Settings retrieved: ")
     print(settings)
 
-    setting_group = settings[1]
-
-    ## Workflow
-    est_iq_bool = settings[2]
-    align_bool = settings[3]
-    poptargets_bool = settings[4]
-    uncheckmarkers_bool = settings[5]
-    scalebar_bool = settings[52]
-    alignbbox_bool = settings[6]
-    optimizealignment_bool = settings[7]
-    err_red_bool = settings[8]
-    depthmap_bool = settings[9]
-    densecloud_bool = settings[10]
-    mesh_bool = settings[11]
-    texture_bool = settings[12]
-    dem_bool = settings[13]
-    ortho_bool = settings[14]
-
-    ## Image quality
-    iq_threshold = settings[15]
-
-    ## Error correction Percentages
-    RU_Percent = settings[16]
-    PA_Percent = settings[17]
-    RE_Percent = settings[18]
-
-    ## Error correction Thresholds
-    RU_Threshold = settings[19]
-    PA_Threshold = settings[20]
-    RE_Threshold = settings[21]
-
-    ## Depthmaps settings
-    depthmap_quality = settings[22]
-    depthmap_filter = settings[23]
-  
-    ## CRS
-    crs = settings[24]
-
-    ## Image alignment settings
-    keypoint_limit = settings[25]
-    tiepoint_limit = settings[26]
-    generic_preselection_bool = settings[27]
-    reference_preselection_bool = settings[28]
-
-    ## UV and Texture settings
-    uv_pages = settings[29]
-    texture_size = settings[30]
-    ghosting_filter_bool = settings[31]
-    blending_mode = settings[32]
-    texture_type = settings[33]
-    fill_holes_bool = settings[34]
-
-    ## Model/mesh settings
-    surface_type = settings[35]
-    interpolation = settings[36]
-    face_count_custom = settings[37]
-    source_data = settings[38]
-    vertex_colors_bool = settings[39]
-    vertex_confidence_bool = settings[40]
-
-    ##DEM settings
-    dem_datasource = settings[41]
-    dem_interpolation = settings[42]
-    dem_resolution = settings[43]
-    dem_params = settings[55]
-
-    ## Orthos settings
-    ortho_surfacedata = settings[44]
-    ortho_blending_mode = settings[45]
-    ortho_fill_holes_bool = settings[46]
-    ortho_ghosting_filter_bool = settings[47]
-    ortho_cull_faces_bool = settings[48]
-    ortho_refine_seamlines_bool = settings[49]
-    ortho_resolution = settings[50]
-
-    ## Export settings
-    export_bool = settings[51]
-    short_coords = settings[53]
-    export_formats = settings[54]
-
-
-  # If standalone mode, set vars here 
+  # If standalone mode, use the defaults in digdok_settings.STANDALONE
   else:
-    setting_group = "Default manual settings (HRI 27.12.22)"
-
-    ## Workflow
-    est_iq_bool = True
-    align_bool = True
-    poptargets_bool = True
-    uncheckmarkers_bool = True
-    scalebar_bool = True
-    alignbbox_bool = True
-    optimizealignment_bool = True
-    err_red_bool = True
-    depthmap_bool = True
-    densecloud_bool = False
-    mesh_bool = True
-    texture_bool = True
-    dem_bool = True
-    ortho_bool = True
-  
-    ## Image quality
-    iq_threshold = 0.6
-  
-    ## Error correction Percentages
-    RU_Percent = 20
-    PA_Percent = 20
-    RE_Percent = 20
-  
-    ## Error correction Thresholds
-    RU_Threshold = 10
-    PA_Threshold = 5
-    RE_Threshold = 0.9
-  
-    ## CRS
-    crs = 32630
-  
-    ## Image alignment settings
-    keypoint_limit = 40000
-    tiepoint_limit = 10000
-    generic_preselection_bool = True
-    reference_preselection_bool = True
-
-    ## UV and Texture settings
-    uv_pages = 2
-    texture_size = 4096
-    ghosting_filter_bool = True
-    blending_mode = "MosaicBlending"
-    texture_type = "DiffuseMap"
-    fill_holes_bool = True
-
-    ## Model/mesh settings
-    surface_type = "Arbitrary"
-    interpolation = "EnabledInterpolation"
-    face_count_custom = 0
-    source_data = "DepthMapsData"
-    vertex_colors_bool = True
-    vertex_confidence_bool = True
-
-    ## DEM settings
-    dem_datasource = "DenseCloudData"
-    dem_interpolation = "EnabledInterpolation"
-    dem_resolution = 0
-
-    ## Orthos settings
-    ortho_surfacedata = "ElevationData"
-    ortho_blending_mode = "MosaicBlending"
-    ortho_fill_holes_bool = True
-    ortho_ghosting_filter_bool = False
-    ortho_cull_faces_bool = False
-    ortho_refine_seamlines_bool = False
-    ortho_resolution = 0
-
-    ## Export settings
-    export_bool = True
-    export_formats = '[{"type": "mesh", "format": "obj", "settings": {"faces": 0, "texture": True}},{"type": "mesh", "format": "ply", "settings": {"faces": 500000, "texture": True}},{"type": "dem", "format": "tiff", "settings": {"resolution": 0}}]'
-    short_coords = '[{"x": 0, "y": 0, "z": 0}]'
+    settings = ProcessingSettings.standalone()
 
   ## Print settings
   print()
-  print("Setting group: " + setting_group)
+  print("Setting group: " + settings.setting_group)
   print()
-  print("Estimate image quality: " + str(est_iq_bool))
-  print("Image quality threshold: " + str(iq_threshold))
+  print("Estimate image quality: " + str(settings.est_iq_bool))
+  print("Image quality threshold: " + str(settings.iq_threshold))
   print()
-  print("Align images: " + str(align_bool))
-  print("Keypoint limit: " + str(keypoint_limit))
-  print("Tiepoint limit: " + str(tiepoint_limit))
-  print("Generic preselection: " + str(generic_preselection_bool))
-  print("Reference preselection: " + str(reference_preselection_bool))
+  print("Align images: " + str(settings.align_bool))
+  print("Keypoint limit: " + str(settings.keypoint_limit))
+  print("Tiepoint limit: " + str(settings.tiepoint_limit))
+  print("Generic preselection: " + str(settings.generic_preselection_bool))
+  print("Reference preselection: " + str(settings.reference_preselection_bool))
   print()
-  print("Populate targets: " + str(poptargets_bool))
-  print("CRS: EPSG::" + str(crs))
+  print("Populate targets: " + str(settings.poptargets_bool))
+  print("CRS: EPSG::" + str(settings.crs))
   print()
-  print("Uncheck markers: " + str(uncheckmarkers_bool))
-  print("Add scalebars: " + str(scalebar_bool))
-  print("Align bounding box: " + str(alignbbox_bool))
-  print("Optimize alignment: " + str(optimizealignment_bool))
-  print("Error reduction: " + str(err_red_bool))
-  print("RU percent: " + str(RU_Percent))
-  print("RU threshold: " + str(RU_Threshold))
-  print("PA percent: " + str(PA_Percent))
-  print("PA threshold: " + str(PA_Threshold))
-  print("RE percent: " + str(RE_Percent))
-  print("RE threshold: " + str(RE_Threshold))
+  print("Uncheck markers: " + str(settings.uncheckmarkers_bool))
+  print("Add scalebars: " + str(settings.scalebar_bool))
+  print("Align bounding box: " + str(settings.alignbbox_bool))
+  print("Optimize alignment: " + str(settings.optimizealignment_bool))
+  print("Error reduction: " + str(settings.err_red_bool))
+  print("RU percent: " + str(settings.RU_Percent))
+  print("RU threshold: " + str(settings.RU_Threshold))
+  print("PA percent: " + str(settings.PA_Percent))
+  print("PA threshold: " + str(settings.PA_Threshold))
+  print("RE percent: " + str(settings.RE_Percent))
+  print("RE threshold: " + str(settings.RE_Threshold))
   print()
-  print("Build depthmaps: " + str(depthmap_bool))
-  print("Depth map quality: " + depthmap_quality)
-  print("Depth map filter: " + depthmap_filter)
+  print("Build depthmaps: " + str(settings.depthmap_bool))
+  print("Depth map quality: " + settings.depthmap_quality)
+  print("Depth map filter: " + settings.depthmap_filter)
   print()
-  print("Build dense cloud: " + str(densecloud_bool))
+  print("Build dense cloud: " + str(settings.densecloud_bool))
   print()
-  print("Build mesh: " + str(mesh_bool))
-  print("Mesh surface type: " + str(surface_type))
-  print("Mesh interpolation: " + str(interpolation))
-  print("Mesh face count: " + str(face_count_custom))
-  print("Mesh source data: " + str(source_data))
-  print("Mesh vertex colours: " + str(vertex_colors_bool))
-  print("Mesh vertex confidence: " + str(vertex_confidence_bool))
+  print("Build mesh: " + str(settings.mesh_bool))
+  print("Mesh surface type: " + str(settings.surface_type))
+  print("Mesh interpolation: " + str(settings.interpolation))
+  print("Mesh face count: " + str(settings.face_count_custom))
+  print("Mesh source data: " + str(settings.source_data))
+  print("Mesh vertex colours: " + str(settings.vertex_colors_bool))
+  print("Mesh vertex confidence: " + str(settings.vertex_confidence_bool))
   print()
-  print("Build texture: " + str(texture_bool))
-  print("UV page count: " + str(uv_pages))
-  print("Belnding mode: " + str(blending_mode))
-  print("Texture size: " + str(texture_size))
-  print("Texture type: " + str(texture_type))
-  print("Enable ghosting filter: " + str(ghosting_filter_bool))
-  print("Enable hole filling: " + str(fill_holes_bool))
+  print("Build texture: " + str(settings.texture_bool))
+  print("UV page count: " + str(settings.uv_pages))
+  print("Belnding mode: " + str(settings.blending_mode))
+  print("Texture size: " + str(settings.texture_size))
+  print("Texture type: " + str(settings.texture_type))
+  print("Enable ghosting filter: " + str(settings.ghosting_filter_bool))
+  print("Enable hole filling: " + str(settings.fill_holes_bool))
   print()
-  print("Build DEM: " + str(dem_bool))
-  print("DEM datasource: " + str(dem_datasource))
-  print("DEM interpolation: " + str(dem_interpolation))
-  print("DEM resolution: " + str(dem_resolution))
+  print("Build DEM: " + str(settings.dem_bool))
+  print("DEM datasource: " + str(settings.dem_datasource))
+  print("DEM interpolation: " + str(settings.dem_interpolation))
+  print("DEM resolution: " + str(settings.dem_resolution))
   print()
-  print("Build orthomosaic: " + str(ortho_bool))
-  print("Surface data: " + str(ortho_surfacedata))
-  print("Blending mode: " + str(ortho_blending_mode))
-  print("Enable hole filling: " + str(ortho_fill_holes_bool))
-  print("Enable ghosting filter: " + str(ortho_ghosting_filter_bool))
-  print("Enable back-face culling: " + str(ortho_cull_faces_bool))
-  print("Refine seamlines based on image content: " + str(ortho_refine_seamlines_bool))
-  print("Ortho resolution: " + str(ortho_resolution))
+  print("Build orthomosaic: " + str(settings.ortho_bool))
+  print("Surface data: " + str(settings.ortho_surfacedata))
+  print("Blending mode: " + str(settings.ortho_blending_mode))
+  print("Enable hole filling: " + str(settings.ortho_fill_holes_bool))
+  print("Enable ghosting filter: " + str(settings.ortho_ghosting_filter_bool))
+  print("Enable back-face culling: " + str(settings.ortho_cull_faces_bool))
+  print("Refine seamlines based on image content: " + str(settings.ortho_refine_seamlines_bool))
+  print("Ortho resolution: " + str(settings.ortho_resolution))
   print()
 
-def dbconnection(query, type):
-  """ Connect to the PostgreSQL database server """
-  connection = None
+def dbconnection(query, type, args=None):
+  """ Run a query on a pooled connection to the PostgreSQL database server """
   try:
-      # read connection parameters
-      params = config()
-      # connect to the PostgreSQL server
-      print('Connecting to the PostgreSQL database...')
-      connection = psycopg2.connect(**params)
-      # create a cursor
-      cursor = connection.cursor()
-      # Execute query
-      cursor.execute(query)
-      if type == "insert":
-        connection.commit()
-        result = cursor.fetchall()
-        count = cursor.rowcount
-        print(count, "record(s) inserted.")
-        if result:
-          return result
-      elif type == "update":
-        connection.commit()
-        result = cursor.fetchall()
-        count = cursor.rowcount
-        print(count, "record(s) updated.")
-        if result:
-          return result
-      elif type == "select_one":
-        result = cursor.fetchone()
-        if result:
-          print("One row returned.")
-          return result
-        else:
-          print("No records found.")
-      elif type == "select_all":
-        result = cursor.fetchall()
-        if result:
-          return result
-        else:
-          print("No records found.")  
+    return digdok_db.execute(query, type, args)
+  except (Exception, psycopg2.DatabaseError) as error:
+      print(error)
+
+def dbstatement(name, type, *args):
+  """ Run a named, prepared statement from digdok_queries """
+  try:
+    return digdok_queries.execute(name, type, args)
   except (Exception, psycopg2.DatabaseError) as error:
       print(error)
-  finally:
-    if connection:
-      cursor.close()
-      connection.close()
 
 # -----------------------------------------------------------------
 
 def update_status(uuid, step, status):
   if mode == "db":
-    query = (
-      "UPDATE new.process_status "
-      "SET " + step + " = '" + status + "' "
-      "WHERE uuid = '" + uuid + "';"
-    )
-    dbconnection(query, "update")
+    if status_cache and status_cache.uuid == uuid:
+      status_cache.update_status(step, status)
+      return
+    try:
+      digdok_queries.update_status(uuid, step, status)
+    except (Exception, psycopg2.DatabaseError) as error:
+      print(error)
     print("Updated " + step + " status to '" + status + "'. \n")
 
 # -----------------------------------------------------------------
 
 def update_processing(uuid, step, value):
   if mode == "db":
-    query = (
-      "UPDATE new.processing "
-      "SET " + step + " = " + str(value) + " "
-      "WHERE uuid = '" + uuid + "';"
-    )
-    dbconnection(query, "update")
+    if status_cache and status_cache.processing_uuid == uuid:
+      status_cache.update_processing(step, value)
+      return
+    try:
+      digdok_queries.update_processing(uuid, step, value)
+    except (Exception, psycopg2.DatabaseError) as error:
+      print(error)
 # -----------------------------------------------------------------
 
 def get_status(uuid, step):
   if mode == "db":
-    query = (
-      "SELECT " + step + " "
-      "FROM new.process_status "
-      "WHERE uuid = '" + uuid + "';"
-    )
-    status = dbconnection(query, "select_one")
-    return status[0]
+    if status_cache and status_cache.uuid == uuid:
+      return status_cache.get_status(step)
+    try:
+      status = digdok_queries.get_status(uuid, step)
+    except (Exception, psycopg2.DatabaseError) as error:
+      print(error)
+      status = None
+    return status[0] if status else None
 
 # -----------------------------------------------------------------
 
 def set_software():
   if mode == "db":
 
-    query = (
-      "SELECT uuid "
-      "FROM new.software "
-      "WHERE software_name = 'Metashape' and software_version = '" + version + "';"
-    )
-    software_uuid = dbconnection(query, "select_one")
+    software_uuid = dbstatement("software_uuid", "select_one", version)
 
     if not software_uuid:
-      query = (
-        "INSERT INTO new.software (company, software_name, software_version, software_type) "
-        "VALUES ('Agisoft'::varchar,'Metashape'::varchar,'" + version + "'::varchar, 'Photogrammetry'::varchar) "
-        "RETURNING uuid"
-      )
-      software_uuid = dbconnection(query, "insert")
+      software_uuid = dbstatement("insert_software", "insert", version)[0]
     return software_uuid[0]
 
 
@@ -450,42 +213,17 @@ def set_processing(uuid):
     software_uuid = set_software()
 
     # Check if a processing entry linked to the capture and processing status entries exist
-    query = (
-      "SELECT proc.uuid "
-      "FROM new.processing proc "
-      "JOIN new.capture_processing_link cp ON cp.processing_uuid = proc.uuid "
-      "JOIN new.capture cap ON cap.uuid = cp.capture_uuid "
-      "JOIN new.process_status ps ON ps.capture_uuid = cap.uuid "
-      "WHERE ps.uuid = '" + uuid + "'::uuid"
-    )
     global processing_uuid
     try:
-      processing_uuid = dbconnection(query, "select_one")[0]
+      processing_uuid = dbstatement("processing_for_status", "select_one", uuid)[0]
     except Exception as e:
       # If the processing entry doesn't exist (if it's not linked, we assume it doesn't exist..), create it:
-      query = (
-        "INSERT INTO new.processing (software, processed_on) "
-        "VALUES ( ARRAY ['" + software_uuid + "'::uuid], CURRENT_DATE) "
-        "RETURNING uuid;"
-        )
       # And link the newly created processing entry to the current capture entry via link-table.
-      processing_uuid = dbconnection(query, "insert")[0][0]
-      query = (
-        "INSERT INTO new.capture_processing_link (capture_uuid, processing_uuid) "
-        "SELECT cap.uuid, '" + processing_uuid + "'::uuid "
-        "FROM new.capture cap "
-        "JOIN new.process_status ps ON ps.capture_uuid = cap.uuid "
-        "WHERE ps.uuid = '" + uuid + "';"
-      )
-      dbconnection(query, "insert")
+      processing_uuid = dbstatement("insert_processing", "insert", software_uuid)[0][0]
+      dbstatement("link_processing", "insert", processing_uuid, uuid)
     else:
       # If the processing entry already exists, update it with the current software info
-      query = (
-        "UPDATE new.processing "
-        "SET software = (SELECT ARRAY_AGG(DISTINCT e) FROM UNNEST(software || '{" + software_uuid + "}') e) "
-        "WHERE new.processing.uuid = '" + processing_uuid + "' ;"
-      )
-      dbconnection(query, "update")
+      dbstatement("add_processing_software", "update", software_uuid, processing_uuid)
     print()
     print("processing_uuid: " + str(processing_uuid))
     print("software_uuid: " + software_uuid)
@@ -498,6 +236,7 @@ def pickfoldernamechunk():
 
   ## Select folder
   global path
+  global photo_inventory
   path = Metashape.app.getExistingDirectory("Select root folder for projects.")
   backslash = "/" # Metashape now uses slash (/) not backslash (\).
   print (path) # display full path and folder name in console
@@ -513,12 +252,11 @@ def pickfoldernamechunk():
       chunk.label = folder
 
       # load all images from specified folder into new chunk
-      image_list = os.listdir(folderpath + "/Photos")
-      photo_list = list()
-      for photo in image_list:
-        if ("jpg" or "jpeg" or "JPG" or "JPEG") in photo.lower():
-          photo_list.append(folderpath + "/Photos/" + photo)
-      chunk.addPhotos(photo_list)
+      photo_index = digdok_photos.PhotoIndex(folderpath)
+      photo_inventory = photo_index.rescan()
+      excluded = screen_photos(photo_index)
+      photo_index.close()
+      chunk.addPhotos([photo for photo in photo_inventory.paths if photo not in excluded])
 
   ## Remove empty chunks
   for chunk in list(doc.chunks):
@@ -526,27 +264,45 @@ def pickfoldernamechunk():
       doc.remove(chunk)
 
   ## Save project
-  camera = chunk.cameras[0]
-  date = datetime.strptime(camera.photo.meta["Exif/DateTimeOriginal"], '%Y:%m:%d %H:%M:%S')
+  date = photo_inventory.capture_date()
   #area = Metashape.app.getString(label = "Area mapped (for filename):", value = "Room")
   project_name = folder + "_" + date.strftime("%d%m%y") + ".psx"
   doc.save(path + "/" + project_name)
 
+def screen_photos(photo_index):
+  # Photos to leave out of the chunk: copies of other photos. If image quality is estimated the photos
+  # are scored for sharpness as well, estimagequality() uses the scores to analyze fewer of them
+  global duplicates_dropped
+  global photo_sharpness
+  excluded = set(digdok_dedup.find_duplicates(photo_inventory, photo_index))
+  duplicates_dropped = len(excluded)
+  photo_sharpness = {}
+  if settings.est_iq_bool:
+    if digdok_sharpness.available():
+      scores = digdok_sharpness.scores(photo_inventory, photo_index)
+      photo_sharpness = {os.path.normpath(photo): value for photo, value in scores.items()}
+    else:
+      print("Pillow or numpy is not installed, leaving image quality to Metashape.")
+  return excluded
+
 # -----------------------------------------------------------------
 
-def loadfromdb():
+def loadfromdb(capture=None):
   # Create a new chunk named from a selected a folder and add all photos from that folder
-  query = "SELECT * FROM new.view_process_location"
-  capture = dbconnection(query, "select_one")
+  # capture is a view_process_location row already claimed through digdok_queue, if not given the first queued row is used.
+  if capture is None:
+    capture = dbstatement("first_queued_capture", "select_one")
 
   if not capture:
     sys.exit("No models to process. Exiting.")
 
   # Clear data from earlier runs
   doc.clear()
+  digdok_markers.cache.clear()
 
   # Select folder
   global path
+  global photo_inventory
   path = capture[1]
   global uuid
   uuid = capture[0]
@@ -557,12 +313,26 @@ def loadfromdb():
   bkslno = path.rfind(backslash)+1
   pathlen = len(path)
 
+  # Photo index in the capture folder, only new or changed photos are read again
+  photo_index = digdok_photos.PhotoIndex(path)
+  photo_inventory = photo_index.rescan()
+  excluded = screen_photos(photo_index)
+  photo_index.close()
+
   # Check for existing project and open
   existing_projects = glob.glob(path + '/' + folder + '_*.psx')
   if get_status(uuid, "status") not in ["done", "skip"]:
     if existing_projects:
       doc.open(existing_projects[0], read_only=False, ignore_lock=True)
       print("Project " + existing_projects[0] + " already exists. Opened existing project for editing.")
+      # Add photos that arrived since the project was created, never the ones already in it
+      for chunk in doc.chunks:
+        if str(chunk.label) == str(folder):
+          new_photos = [photo for photo in digdok_photos.pending(photo_inventory, chunk) if photo not in excluded]
+          if new_photos:
+            print("Adding " + str(len(new_photos)) + " new photos to chunk " + chunk.label + ".")
+            chunk.addPhotos(new_photos)
+            doc.save()
       update_status(uuid, "status", "processing")
       #return uuid
       return
@@ -587,25 +357,18 @@ def loadfromdb():
       #create new chunk named after folder
       chunk = doc.addChunk()
       chunk.label = folder
-    #load all images from specified folder into new chunk
-    image_list = os.listdir(path + "/Photos")
-    photo_list = list()
-    for photo in image_list:
-      if ("jpg" or "jpeg" or "JPG" or "JPEG") in photo.lower():
-        photo_list.append(path + "/Photos/" + photo)
-    chunk.addPhotos(photo_list)
+    else:
+      chunk = doc.chunk
+    #load all images from specified folder into new chunk, skipping any it already has
+    chunk.addPhotos([photo for photo in digdok_photos.pending(photo_inventory, chunk) if photo not in excluded])
 
   #remove empty chunks
   for chunk in list(doc.chunks):
     if not len(chunk.cameras):
       doc.remove(chunk)
 
-  #save project
-  camera = doc.chunks[0].cameras[0]
-  try:
-    date = datetime.strptime(camera.photo.meta["Exif/DateTimeOriginal"], '%Y:%m:%d %H:%M:%S')
-  except Exception as e:
-    date = datetime.fromtimestamp(os.path.getmtime(photo_list[0]))
+  #save project, named after the capture date from the photo inventory
+  date = photo_inventory.capture_date()
 
   #area = Metashape.app.getString(label = "Area mapped (for filename):", value = "Room")
   project_name = folder + "_" + date.strftime("%d%m%y") + ".psx"
@@ -629,40 +392,56 @@ def estimagequality(threshold):
     camerasniq = [camera for camera in chunk.cameras
       if 'Image/Quality' not in camera.meta]
 
-    if len(camerasniq) > 0:
-      #print('Test OK!')
-      #print(found_major_version)
-      if found_major_version <= 1.5:
-        chunk.estimateImageQuality(camerasniq)
-      elif found_major_version < 2:
-        chunk.analyzePhotos(camerasniq)
-      else:
-        chunk.analyzeImages(camerasniq)
-
-    for i in range(0, len(chunk.cameras)):
-      print('photo ' + str(i))
-      camera = chunk.cameras[i]
-      print(camera)
+    # Metashape analyzes a sample of the photos scored by the pre-filter in screen_photos(), the scores are
+    # calibrated against its quality, and the photos predicted to be clearly sharp aren't analyzed
+    scored = {
+      camera.key: photo_sharpness[os.path.normpath(camera.photo.path)] for camera in camerasniq
+      if camera.photo and os.path.normpath(camera.photo.path) in photo_sharpness
+    }
+    if len(scored) > 2 * digdok_sharpness.SAMPLE_SIZE:
+      sample = set(digdok_sharpness.sample(scored))
+      analyzequality(chunk, [camera for camera in camerasniq if camera.key in sample])
+      qualities = {camera.key: float(camera.meta['Image/Quality']) for camera in camerasniq
+        if camera.key in sample and 'Image/Quality' in camera.meta}
+      fit = digdok_sharpness.calibrate(scored, qualities)
+      sharp = set(digdok_sharpness.screen(scored, fit, threshold)) if fit else set()
+      camerasniq = [camera for camera in camerasniq if camera.key not in sample and camera.key not in sharp]
+      print(str(len(sharp)) + " cameras in " + chunk.label + " clearly sharp by their calibrated sharpness score, not analyzed.")
+
+    analyzequality(chunk, camerasniq)
+
+    disabled = 0
+    for camera in chunk.cameras:
+      if 'Image/Quality' not in camera.meta:
+        continue
       quality = float(camera.meta['Image/Quality'])
-      print(str(quality))
       if quality < threshold:
         camera.enabled = False
-        print("Quality below threshold, camera disabled.")
-    doc.save()
+        disabled += 1
+    print(str(disabled) + " of " + str(len(chunk.cameras)) + " cameras in " + chunk.label + " below quality threshold, disabled.")
 
-  mlabel = 'Photos with image quality less than ' + str(threshold) + ' disabled. Project saved.'
+  mlabel = 'Photos with image quality less than ' + str(threshold) + ' disabled.'
   #Metashape.app.messageBox(mlabel)     # display msgbox when done
   print(mlabel)
 
+def analyzequality(chunk, cameras):
+  if not cameras:
+    return
+  if found_major_version <= 1.5:
+    chunk.estimateImageQuality(cameras)
+  elif found_major_version < 2:
+    chunk.analyzePhotos(cameras)
+  else:
+    chunk.analyzeImages(cameras)
+
 # -----------------------------------------------------------------------
 def align():
   aligned_cameras = []
   for chunk in doc.chunks:
     chunk.detectMarkers()
     chunk.detectMarkers(inverted = True)
-    chunk.matchPhotos(keypoint_limit = keypoint_limit, tiepoint_limit = tiepoint_limit, generic_preselection = generic_preselection_bool, reference_preselection = reference_preselection_bool)
+    chunk.matchPhotos(keypoint_limit = settings.keypoint_limit, tiepoint_limit = settings.tiepoint_limit, generic_preselection = settings.generic_preselection_bool, reference_preselection = settings.reference_preselection_bool)
     chunk.alignCameras()
-    doc.save()
     for camera in chunk.cameras:
       if camera.transform!=None:
         aligned_cameras.append(camera)
@@ -676,13 +455,8 @@ def poptargets():
 
   # If target data in database, get targets and make csv
   if mode == "db":
-    query = (
-    "SELECT target_id, coord_x, coord_y, coord_z "
-    "FROM new.view_gcp_targets "
-    "WHERE status_uuid = '" + uuid + "';"
-    )
-    targets = dbconnection(query, "select_all")
-    if len(targets)>0:
+    targets = dbstatement("gcp_targets", "select_all", uuid)
+    if targets:
       with open(targetfile, "w") as f:
         csv_writer = csv.writer(f)
         for target_tuple in targets:
@@ -696,7 +470,7 @@ def poptargets():
   if os.path.exists(targetfile):
     for chunk in doc.chunks:
   
-      chunk.crs = Metashape.CoordinateSystem("EPSG::" + str(crs))	
+      chunk.crs = Metashape.CoordinateSystem("EPSG::" + str(settings.crs))	
   
       #MarkersList = str(list(chunk.markers))                           # strings a list of class markers.
       #print (MarkersList)                                              # display list of detected targets in console.
@@ -706,7 +480,6 @@ def poptargets():
       else:
         chunk.importReference(targetfile, csvformat, columns='nxyz', delimiter=',', skip_rows=0) #import coord values.
       chunk.updateTransform()
-      doc.save()
   
       #List enabled targets
       for marker in chunk.markers:
@@ -727,13 +500,8 @@ def add_scalebars():
 
   # If target data in database, get targets and make csv
   if mode == "db":
-    query = (
-    "SELECT target_first, target_second, distance, precision "
-    "FROM new.view_scalebars "
-    "WHERE status_uuid = '" + uuid + "';"
-    )
-    scalebars = dbconnection(query, "select_all")
-    if len(scalebars)>0:
+    scalebars = dbstatement("scalebars", "select_all", uuid)
+    if scalebars:
       with open(scalebarfile, "w") as f:
         csv_writer = csv.writer(f)
         for scalebar_tuple in scalebars:
@@ -777,7 +545,6 @@ def add_scalebars():
               scalebardict['scalebar_%02d' % i] .label = scalebar_row[0] + " - " + scalebar_row[1]
               print("Scalebar {} created.".format(scalebardict['scalebar_%02d' % i] .label))
       chunk.updateTransform()
-      doc.save()
   
       #List enabled targets
       for scalebar in chunk.scalebars:
@@ -801,37 +568,28 @@ def uncheckmarkers():
         marker.reference.enabled = False
         print(str(marker) + " disabled.")
 
-    doc.save()
     for marker in chunk.markers:
       if marker.reference.enabled:
         target_list.append(marker)
 
-    print('All markers with fewer than 3 projections unchecked in chunk ' + chunk.label + '. Project saved.')
+    print('All markers with fewer than 3 projections unchecked in chunk ' + chunk.label + '.')
   return len(target_list)
 
 # -----------------------------------------------------------------------
 
-# calculate average total error in metres
+# calculate average total error in metres, see digdok_markers.py for the per-axis and per-marker breakdown
 def calc_error():
-  error_list = []
+  sum_squared = 0
+  n = 0
   for chunk in doc.chunks:
-    for marker in chunk.markers:
-      try:
-        source = chunk.crs.unproject(marker.reference.location) # measured values in geocentric coordinates
-        estim = chunk.transform.matrix.mulp(marker.position) # estimated coordinates in geocentric coordinates
-        local = chunk.crs.localframe(chunk.transform.matrix.mulp(marker.position)) # local LSE coordinates
-        error = local.mulv(estim - source)
-
-        total = error.norm()      # error points
-        sum_squared = (total) ** 2    # Square root of error
-        error_list += [sum_squared]      # List with errors
-      except Exception as e:
-        return 0
-
-  error_sum = sum(error_list)
-  n = len(error_list)
+    errors = digdok_markers.cache.errors(chunk)
+    if len(errors):
+      print("Marker error in chunk " + chunk.label + ": " + errors.summary())
+    sum_squared += errors.sum_squared()
+    n += len(errors)
+
   if n > 0:
-    ErrorTotal = (error_sum / n) ** 0.5
+    ErrorTotal = (sum_squared / n) ** 0.5
     return ErrorTotal
   else:
     return 0
@@ -855,207 +613,38 @@ def alignbb2cs():
     reg = chunk.region
     reg.rot = R.t()
     chunk.region = reg
-    doc.save()
-  print("All bounding boxes aligned to grid. Project saved.")
+  print("All bounding boxes aligned to grid.")
 
 # --------------------------------------------------------------------------------
 # Optimize alignemnts
 def optimizealignments():
 
   for chunk in doc.chunks:
-    if found_major_version <= 1.5: # Haven't cheked older versions, both the same for now
-      chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False, fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_corrections=False, adaptive_fitting=False, tiepoint_covariance=True)
-    else:
-      chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False, fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_corrections=False, adaptive_fitting=False, tiepoint_covariance=True)
-
-    doc.save()
-    print('Camera positions optimised for chunk ' + chunk.label + '. Project saved.')
+    optimizecameras(chunk)
+    print('Camera positions optimised for chunk ' + chunk.label + '.')
 
-# --------------------------------------------------------------------------------
-# Error reduction - Reconstruction Uncertainty
-def reconstructionuncertainty():
-
-  for chunk in doc.chunks:
-    if found_major_version <= 1.5: 
-      continue
-    elif found_major_version < 2:
-      points = chunk.point_cloud.points
-      filter = Metashape.PointCloud.Filter()
-      filter.init(chunk, criterion = Metashape.PointCloud.Filter.ReconstructionUncertainty) #Reconstruction Uncertainty
-      list_values = filter.values
-      list_values_valid = list()
-      StartPoints = len(list_values_valid)
-
-      for i in range(len(list_values)):
-        if points[i].valid:
-          list_values_valid.append(list_values[i])
-      list_values_valid.sort()
-      target = int(len(list_values_valid) * RU_Percent / 100)
-      StartPoints = int(len(list_values_valid))
-      threshold = list_values_valid[target]
-      if (threshold < RU_Threshold):
-        threshold = RU_Threshold
-      filter.selectPoints(threshold)
-      filter.removePoints(threshold)
-
-      print("")
-      print("Error Reduction Report for chunk " + chunk.label + ":")
-      RU_actual_threshold = threshold
-      print(str(threshold) + " threshold reached")
-      print(str(StartPoints) + " points at start")
-      print(str(target) + " points removed")
-      print("Reconstruction Uncertainty filter completed")
-    else:
-      points = chunk.tie_points.points
-      filter = Metashape.TiePoints.Filter()
-      filter.init(chunk, criterion = Metashape.TiePoints.Filter.ReconstructionUncertainty) #Reconstruction Uncertainty
-      list_values = filter.values
-      list_values_valid = list()
-      StartPoints = len(list_values_valid)
-
-      for i in range(len(list_values)):
-        if points[i].valid:
-          list_values_valid.append(list_values[i])
-      list_values_valid.sort()
-      target = int(len(list_values_valid) * RU_Percent / 100)
-      StartPoints = int(len(list_values_valid))
-      threshold = list_values_valid[target]
-      if (threshold < RU_Threshold):
-        threshold = RU_Threshold
-      filter.selectPoints(threshold)
-      filter.removePoints(threshold)
-
-      print("")
-      print("Error Reduction Report for chunk " + chunk.label + ":")
-      RU_actual_threshold = threshold
-      print(str(threshold) + " threshold reached")
-      print(str(StartPoints) + " points at start")
-      print(str(target) + " points removed")
-      print("Reconstruction Uncertainty filter completed")
-    #doc.save()
+def optimizecameras(chunk):
+  if found_major_version <= 1.5: # Haven't cheked older versions, both the same for now
+    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False, fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_corrections=False, adaptive_fitting=False, tiepoint_covariance=True)
+  else:
+    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False, fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_corrections=False, adaptive_fitting=False, tiepoint_covariance=True)
 
 # --------------------------------------------------------------------------------
-# Error reduction - Projection Accuracy
-def projectionaccuracy():
+# Error reduction - repeated gradual selection by Reconstruction Uncertainty, Projection Accuracy
+# and Reprojection Error, re-optimizing cameras in between. See digdok_errorreduction.reduce()
+def reduceerrors():
 
+  iterations = []
   for chunk in doc.chunks:
-    if found_major_version <= 1.5: 
+    if found_major_version <= 1.5:
       continue
-    elif found_major_version < 2:
-      points = chunk.point_cloud.points
-      filter = Metashape.PointCloud.Filter()
-      filter.init(chunk, criterion = Metashape.PointCloud.Filter.ProjectionAccuracy) #Projection Accuracy
-      list_values = filter.values
-      list_values_valid = list()
-
-      for i in range(len(list_values)):
-        if points[i].valid:
-          list_values_valid.append(list_values[i])
-      list_values_valid.sort()
-      target = int(len(list_values_valid) * PA_Percent / 100)
-      StartPoints = int(len(list_values_valid))
-      threshold = list_values_valid[target]
-      if (threshold < PA_Threshold):
-        threshold = PA_Threshold
-      filter.selectPoints(threshold)
-      filter.removePoints(threshold)
-
-      print("")
-      print("Error Reduction Report for chunk " + chunk.label + ":")
-      PA_actual_threshold = threshold
-      print(str(threshold) + " threshold reached")
-      print(str(StartPoints) + " points at start")
-      print(str(target) + " points removed")
-      print("Projection Accuracy filter completed")
-    else:
-      points = chunk.tie_points.points
-      filter = Metashape.TiePoints.Filter()
-      filter.init(chunk, criterion = Metashape.TiePoints.Filter.ProjectionAccuracy) #Projection Accuracy
-      list_values = filter.values
-      list_values_valid = list()
-
-      for i in range(len(list_values)):
-        if points[i].valid:
-          list_values_valid.append(list_values[i])
-      list_values_valid.sort()
-      target = int(len(list_values_valid) * PA_Percent / 100)
-      StartPoints = int(len(list_values_valid))
-      threshold = list_values_valid[target]
-      if (threshold < PA_Threshold):
-        threshold = PA_Threshold
-      filter.selectPoints(threshold)
-      filter.removePoints(threshold)
-
-      print("")
-      print("Error Reduction Report for chunk " + chunk.label + ":")
-      PA_actual_threshold = threshold
-      print(str(threshold) + " threshold reached")
-      print(str(StartPoints) + " points at start")
-      print(str(target) + " points removed")
-      print("Projection Accuracy filter completed")      
-    #doc.save()
+    print("")
+    print("Error Reduction Report for chunk " + chunk.label + ":")
+    iterations += digdok_errorreduction.reduce(chunk, settings, optimizecameras)
+    print("Error reduction completed for chunk " + chunk.label + ".")
+  return iterations
 
 # --------------------------------------------------------------------------------
-# Error reduction - Reprojection Error
-def reproductionerror():
-
-  for chunk in doc.chunks:
-    if found_major_version <= 1.5: 
-      continue
-    elif found_major_version < 2:
-      points = chunk.point_cloud.points
-      filter = Metashape.PointCloud.Filter()
-      filter.init(chunk, criterion = Metashape.PointCloud.Filter.ReprojectionError) #Reprojection Error
-      list_values = filter.values
-      list_values_valid = list()
-
-      for i in range(len(list_values)):
-        if points[i].valid:
-          list_values_valid.append(list_values[i])
-      list_values_valid.sort()
-      target = int(len(list_values_valid) * RE_Percent / 100)
-      StartPoints = int(len(list_values_valid))
-      threshold = list_values_valid[target]
-      if (threshold < RE_Threshold):
-        threshold = RE_Threshold
-      filter.selectPoints(threshold)
-      filter.removePoints(threshold)
-
-      print("")
-      print("Error Reduction Report for chunk " + chunk.label + ":")
-      RE_actual_threshold = threshold
-      print(str(threshold) + " threshold reached")
-      print(str(StartPoints) + " points at start")
-      print(str(target) + " points removed")
-      print("Reprojection Error filter completed")
-    else:
-      points = chunk.tie_points.points
-      filter = Metashape.TiePoints.Filter()
-      filter.init(chunk, criterion = Metashape.TiePoints.Filter.ReprojectionError) #Reprojection Error
-      list_values = filter.values
-      list_values_valid = list()
-
-      for i in range(len(list_values)):
-        if points[i].valid:
-          list_values_valid.append(list_values[i])
-      list_values_valid.sort()
-      target = int(len(list_values_valid) * RE_Percent / 100)
-      StartPoints = int(len(list_values_valid))
-      threshold = list_values_valid[target]
-      if (threshold < RE_Threshold):
-        threshold = RE_Threshold
-      filter.selectPoints(threshold)
-      filter.removePoints(threshold)
-
-      print("")
-      print("Error Reduction Report for chunk " + chunk.label + ":")
-      RE_actual_threshold = threshold
-      print(str(threshold) + " threshold reached")
-      print(str(StartPoints) + " points at start")
-      print(str(target) + " points removed")
-      print("Reprojection Error filter completed")
-    #doc.save()
-# --------------------------------------------------------------------------------
 # Build Depth Maps
 # This step could benefit from calibration..
 # - Check witch filter level is better for objects.
@@ -1071,45 +660,46 @@ def reproductionerror():
 #
 
 def depthmaps():
-  quality_map = {
-    "Ultra": 1,
-    "High": 2,
-    "Medium": 4,
-    "Low": 8,
-    "Lowest": 16
-  }
+  quality_map = digdok_settings.DEPTHMAP_QUALITY
   #filter_attr = depthmap_filter + "Filtering"
 
+  tasks = []
   for chunk in doc.chunks:
     if found_major_version <= 1.5:
-      quality_attr = depthmap_quality + "Quality"
+      quality_attr = settings.depthmap_quality + "Quality"
       chunk.buildDepthMaps(
         quality=quality_attr,
-        filter=depthmap_filter,
+        filter=settings.depthmap_filter,
         reuse_depth=True
       )
     else:
-      quality_attr = quality_map[depthmap_quality]
-      chunk.buildDepthMaps(
+      quality_attr = quality_map[settings.depthmap_quality]
+      params = dict(
         downscale=quality_attr,
-        filter_mode=getattr(Metashape, depthmap_filter),
+        filter_mode=getattr(Metashape, settings.depthmap_filter),
         reuse_depth=True, max_neighbors=16,
         subdivide_task=True, 
         workitem_size_cameras=20,
         max_workgroup_size=100
       )
+      if digdok_offload.offloaded("building_depthmaps"):
+        tasks.append((chunk, "BuildDepthMaps", params))
+        continue
+      chunk.buildDepthMaps(**params)
 
-    doc.save()
-    print('Depthmaps created for chunk ' + chunk.label + '. Project saved.')
+    print('Depthmaps created for chunk ' + chunk.label + '.')
+  if tasks:
+    offload("building_depthmaps", tasks)
 
 # --------------------------------------------------------------------------------
 # Build Dense Cloud
 def densecloud():
+  tasks = []
   for chunk in doc.chunks:
     if found_major_version <= 1.5: # Haven't checked older versions, both the same for now
       chunk.buildDenseCloud()
-    elif found_major_version < 2:
-      chunk.buildDenseCloud(
+    else:
+      params = dict(
         point_colors=True,
         point_confidence=False,
         keep_depth=True,
@@ -1118,18 +708,28 @@ def densecloud():
         workitem_size_cameras=20,
         max_workgroup_size=100
       )
+      task = "BuildDenseCloud" if found_major_version < 2 else "BuildPointCloud"
+      if digdok_offload.offloaded("building_densecloud"):
+        tasks.append((chunk, task, params))
+        continue
+      getattr(chunk, digdok_offload.method(task))(**params)
+    print('Dense cloud built for chunk ' + chunk.label + '.')
+  if tasks:
+    offload("building_densecloud", tasks)
+
+# --------------------------------------------------------------------------------
+# Run tasks of a stage on the network processing server, see digdok_offload.py
+def offload(stage, tasks):
+  def record(event, values):
+    if mode != "db":
+      return
+    if event == "submitted":
+      dbstatement("insert_offload_batch", "insert", processing_uuid, stage, values["backend"], values["server"], values["batch_id"], values["tasks"], values["worker_id"])
     else:
-      chunk.buildPointCloud(
-        point_colors=True, 
-        point_confidence=False,
-        keep_depth=True, 
-        max_neighbors=100,
-        subdivide_task=True, 
-        workitem_size_cameras=20,
-        max_workgroup_size=100
-      )
-    doc.save()
-    print('Dense cloud built for chunk ' + chunk.label + '. Project saved.')
+      dbstatement("finish_offload_batch", "update", values["status"], values["seconds"], processing_uuid, stage, values["batch_id"])
+  digdok_offload.run(doc, stage, tasks, digdok_offload.backend(), record)
+  for chunk in doc.chunks:
+    print(stage + ' done on the server for chunk ' + chunk.label + '.')
 
 
 # --------------------------------------------------------------------------------
@@ -1139,23 +739,22 @@ def mesh():
   for chunk in doc.chunks:
     if found_major_version <= 1.5:
       chunk.buildModel(
-        surface_type=getattr(Metashape, surface_type),
-        interpolation=getattr(Metashape, interpolation),
-        face_count=face_count_custom,
-        source_data=getattr(Metashape, source_data),
-        vertex_colors=vertex_colors_bool
+        surface_type=getattr(Metashape, settings.surface_type),
+        interpolation=getattr(Metashape, settings.interpolation),
+        face_count=settings.face_count_custom,
+        source_data=getattr(Metashape, settings.source_data),
+        vertex_colors=settings.vertex_colors_bool
       )
     else:
       chunk.buildModel(
-        surface_type=getattr(Metashape, surface_type),
-        interpolation=getattr(Metashape, interpolation),
-        face_count_custom=face_count_custom,
-        source_data=getattr(Metashape, source_data),
-        vertex_colors=vertex_colors_bool,
-        vertex_confidence=vertex_confidence_bool
+        surface_type=getattr(Metashape, settings.surface_type),
+        interpolation=getattr(Metashape, settings.interpolation),
+        face_count_custom=settings.face_count_custom,
+        source_data=getattr(Metashape, settings.source_data),
+        vertex_colors=settings.vertex_colors_bool,
+        vertex_confidence=settings.vertex_confidence_bool
       )
-    doc.save()
-    print('Mesh built for chunk ' + chunk.label + '. Project saved.')
+    print('Mesh built for chunk ' + chunk.label + '.')
 
 
 # --------------------------------------------------------------------------------
@@ -1165,28 +764,27 @@ def texture(divider=1):
   for chunk in doc.chunks:
     if found_major_version <= 1.5: # Haven't cheked older versions, both the same for now
       chunk.buildUV(
-        page_count=uv_pages,
-        texture_size=texture_size
+        page_count=settings.uv_pages,
+        texture_size=settings.texture_size
       )
       chunk.buildTexture(
-        texture_size=texture_size,
-        ghosting_filter=ghosting_filter_bool
+        texture_size=settings.texture_size,
+        ghosting_filter=settings.ghosting_filter_bool
       )
     else:
       chunk.buildUV(
         mapping_mode=Metashape.GenericMapping,
-        page_count=uv_pages,
-        texture_size=texture_size / divider
+        page_count=settings.uv_pages,
+        texture_size=settings.texture_size / divider
       )
       chunk.buildTexture(
-        blending_mode=getattr(Metashape, blending_mode),
-        texture_size=texture_size / divider,
-        fill_holes=fill_holes_bool,
-        ghosting_filter=ghosting_filter_bool,
-        texture_type=getattr(Metashape.Model.TextureType, texture_type)
+        blending_mode=getattr(Metashape, settings.blending_mode),
+        texture_size=settings.texture_size / divider,
+        fill_holes=settings.fill_holes_bool,
+        ghosting_filter=settings.ghosting_filter_bool,
+        texture_type=getattr(Metashape.Model.TextureType, settings.texture_type)
       )
-    doc.save()
-    print('UV maps and texture created for chunk ' + chunk.label + '. Project saved.')
+    print('UV maps and texture created for chunk ' + chunk.label + '.')
 
 # --------------------------------------------------------------------------------
 # Build DEM
@@ -1195,22 +793,21 @@ def dem():
   for chunk in doc.chunks:
     if found_major_version <= 1.5:
       chunk.buildDem(
-        source=getattr(Metashape, dem_datasource),
-        interpolation=getattr(Metashape, dem_interpolation)
+        source=getattr(Metashape, settings.dem_datasource),
+        interpolation=getattr(Metashape, settings.dem_interpolation)
       )
     else:
       # print(str(dem_params))
       # chunk.buildDem(**dem_params)
       chunk.buildDem(
-        source_data=getattr(Metashape, dem_datasource),
-        interpolation=getattr(Metashape, dem_interpolation),
-        resolution=dem_resolution, 
+        source_data=getattr(Metashape, settings.dem_datasource),
+        interpolation=getattr(Metashape, settings.dem_interpolation),
+        resolution=settings.dem_resolution, 
         subdivide_task=True
       )
 
 
-    doc.save()
-    print('DEM created for chunk ' + chunk.label + '. Project saved.')
+    print('DEM created for chunk ' + chunk.label + '.')
 
 # --------------------------------------------------------------------------------
 # Build Orthomosaic
@@ -1219,25 +816,24 @@ def ortho():
   for chunk in doc.chunks:
     if found_major_version <= 1.5:
       chunk.buildOrthomosaic(
-        surface=getattr(Metashape, ortho_surfacedata),
-        blending=getattr(Metashape, ortho_blending_mode),
-        fill_holes=ortho_fill_holes_bool,
-        cull_faces=ortho_cull_faces_bool,
-        refine_seamlines=ortho_refine_seamlines_bool
+        surface=getattr(Metashape, settings.ortho_surfacedata),
+        blending=getattr(Metashape, settings.ortho_blending_mode),
+        fill_holes=settings.ortho_fill_holes_bool,
+        cull_faces=settings.ortho_cull_faces_bool,
+        refine_seamlines=settings.ortho_refine_seamlines_bool
       )
     else:
       chunk.buildOrthomosaic(
-        surface_data=getattr(Metashape, ortho_surfacedata),
-        blending_mode=getattr(Metashape, ortho_blending_mode),
-        fill_holes=ortho_fill_holes_bool,
-        ghosting_filter=ortho_ghosting_filter_bool,
-        cull_faces=ortho_cull_faces_bool,
-        refine_seamlines=ortho_refine_seamlines_bool,
-        resolution=ortho_resolution
+        surface_data=getattr(Metashape, settings.ortho_surfacedata),
+        blending_mode=getattr(Metashape, settings.ortho_blending_mode),
+        fill_holes=settings.ortho_fill_holes_bool,
+        ghosting_filter=settings.ortho_ghosting_filter_bool,
+        cull_faces=settings.ortho_cull_faces_bool,
+        refine_seamlines=settings.ortho_refine_seamlines_bool,
+        resolution=settings.ortho_resolution
       )
 
-    doc.save()
-    print('Orthomosaic created for chunk ' + chunk.label + '. Project saved.')
+    print('Orthomosaic created for chunk ' + chunk.label + '.')
 
 # --------------------------------------------------------------------------------
 # Export data
@@ -1250,245 +846,310 @@ def export():
     'The project contains objects NN from NN, \n captured by NN on the DD.MM.YYYY \n ' 
     'using X equipment. The resulting exports are licensed  XY by KHM/NN.'
     )
-  settings = [('Test 1', 'Value 1'), ('Test 2', 'Value 2')]
-
-  faceCount = 500000  #Number of faces for decimated mesh
+  report_settings = [('Test 1', 'Value 1'), ('Test 2', 'Value 2')]
 
   # Check and set shorhtened coordinates
-  if short_coords:
-    print("Shortcoords: " + str(short_coords))
+  if settings.short_coords:
+    print("Shortcoords: " + str(settings.short_coords))
     short_coord_file = path + "/short_coords.csv"     # Path to the folder and target file name to write and read.
     # short_coord_dict = json.loads(short_coords)
 
   # Write short coords to csv in project folder
     with open(short_coord_file, "w") as f:
-      csv_writer = csv.DictWriter(f, short_coords.keys())
+      csv_writer = csv.DictWriter(f, settings.short_coords.keys())
       csv_writer.writeheader()
-      csv_writer.writerow(short_coords)
+      csv_writer.writerow(settings.short_coords)
     print("Shorthened coordinate data saved to " + short_coord_file)
 
   # Apply to ply export (with decimated mesh?) for use by meshlab and 3dhop
-    shiftCoords = Metashape.Vector((short_coords['x'], short_coords['y'], short_coords['z']))
+    shiftCoords = Metashape.Vector((settings.short_coords['x'], settings.short_coords['y'], settings.short_coords['z']))
   else:
     shiftCoords = Metashape.Vector(0, 0, 0)
 
-  # Def formats
-  ply = Metashape.ModelFormatPLY
-  obj = Metashape.ModelFormatOBJ
-  laz = Metashape.PointsFormatLAZ # Check if this isn't PointCloudFormatLAZ in >2.0.0
-  comment = "KHM " + str(date.today().year)
-
+  job = ExportJob(output_folder, processing_uuid, shiftCoords, "KHM " + str(date.today().year))
+  formats = settings.export_formats or digdok_export.DEFAULT_FORMATS
+  full_models = {} # chunk key -> key of the model exports start from
   for chunk in doc.chunks:
-    crs = chunk.crs
+    # Outputs are named after the chunk if there is more than one
+    prefix = chunk.label + " " if len(doc.chunks) > 1 else ""
+    full_models[chunk.key] = chunk.model.key if chunk.model else None
 
     if found_major_version <= 1.5:
       print("Version 1.5 or earlier export not yet set.")
-      if chunk.point_cloud:
-        filename_densepoint = output_folder + 'pointcloud_' + processing_uuid + '.las'
-        chunk.exportPointCloud(
-          filename_densepoint,
-          source_data=Metashape.PointCloudData
-        )
-    elif found_major_version < 2:
-      filename_report = output_folder + 'report_' + processing_uuid + '.pdf'
-      chunk.exportReport(
-        path=filename_report,
-        title=folder,
-        description=processing_uuid
-        # user_settings = settings
-      )
-      print("Report exported as " + filename_report)
-
-      if chunk.model:
-        filename_model = output_folder + 'model_' + processing_uuid + '.obj'
-        chunk.exportModel(
-          filename_model,
-          binary=False,
-          clip_to_boundary=False,
-          precision=6,
-          save_texture=True,
-          embed_texture=True,
-          save_normals=True,
-          save_colors=True,
-          save_cameras=True,
-          strip_extensions=False,
-          format=obj,
-          crs=crs,
-          comment=comment,
-          save_comment=True
-        )
-        print()
-        print("Model exported as " + filename_model)
-        duplicateMesh = Metashape.Tasks.DuplicateAsset()
-        duplicateMesh.asset_type = Metashape.ModelData
-        duplicateMesh.clip_to_boundary = False
-        duplicateMesh.asset_key = chunk.models[0].key
-        duplicateMesh.apply(chunk)
-        chunk.decimateModel(face_count=faceCount, apply_to_selection=False)
-        chunk.buildUV(mapping_mode=Metashape.GenericMapping, texture_size=4096)
-        chunk.buildTexture(blending_mode=Metashape.MosaicBlending, texture_size=4096, fill_holes=True, ghosting_filter=True)
-        decimated_model = output_folder + 'model_shortcoords_' + processing_uuid
-        filename_decimated_model = decimated_model + '.ply'
-        chunk.exportModel(
-          filename_decimated_model,
-          binary=True,
-          clip_to_boundary=False,
-          save_texture=True,
-          embed_texture=True,
-          save_normals=True,
-          save_colors=True,
-          save_cameras=True,
-          strip_extensions=False,
-          format=ply,
-          crs=crs,
-          shift=shiftCoords
-        )
-        print()
-        print("Decimated model with shortened coordinates exported as " + filename_decimated_model)
-
-      if chunk.point_cloud:
-        filename_densepoint = output_folder + 'pointcloud_' + processing_uuid + '.las'
-        chunk.exportPoints(
-          filename_densepoint, 
-          source_data=Metashape.DenseCloudData,
-          save_normals=True,
-          save_colors=True,
-          save_confidence=True,
-          format=Metashape.PointsFormatLAZ,
-          crs=crs,
-          comment=comment
-        )
-
-      if chunk.elevation:
-        filename_dem = output_folder + 'dem_' + processing_uuid + '.tif'
-        chunk.exportRaster(
-          filename_dem, 
-          source_data = Metashape.ElevationData
-        )
-
-      if chunk.orthomosaic:
-        filename_ortho = output_folder + 'ortho_' + processing_uuid + '.tif'
-        chunk.exportRaster(
-          filename_ortho,
-          source_data=Metashape.OrthomosaicData
-        )
-    else:
-      filename_report = output_folder + 'report_' + processing_uuid + '.pdf'
-      chunk.exportReport(
-        path=filename_report,
-        title=folder,
-        description=processing_uuid
-        #user_settings=settings
-        )
-      print("Report exported as " + filename_report)
-
-      if chunk.model:
-        filename_model = output_folder + 'model_' + processing_uuid + '.obj'
-        chunk.exportModel(
-          filename_model,
-          binary=False,
-          clip_to_boundary=False,
-          precision=6,
-          save_texture=True,
-          embed_texture=True,
-          save_normals=True,
-          save_colors=True,
-          save_cameras=True,
-          strip_extensions=False,
-          format=obj,
-          crs=crs,
-          comment=comment,
-          save_comment=True
-        )
-        print()
-        print("Model exported as " + filename_model)
-        duplicateMesh = Metashape.Tasks.DuplicateAsset()
-        duplicateMesh.asset_type = Metashape.ModelData
-        duplicateMesh.clip_to_boundary = False
-        duplicateMesh.asset_key = chunk.models[0].key
-        duplicateMesh.apply(chunk)
-        chunk.decimateModel(face_count=faceCount, apply_to_selection=False)
-        chunk.buildUV(mapping_mode=Metashape.GenericMapping, texture_size=4096)
-        chunk.buildTexture(blending_mode=Metashape.MosaicBlending, texture_size=4096, fill_holes=True, ghosting_filter=True)
-        decimated_model = output_folder + 'model_shortcoords_' + processing_uuid
-        filename_decimated_model = decimated_model + '.ply'
-        chunk.exportModel(
-          filename_decimated_model, 
-          binary=True, 
-          clip_to_boundary=False,  
-          save_texture=True, 
-          embed_texture=True, 
-          save_normals=True, 
-          save_colors=True, 
-          save_cameras=True, 
-          strip_extensions=False, 
-          format=ply, 
-          crs=crs, 
-          shift=shiftCoords
-          )
-        print()
-        print("Decimated model with shortened coordinates exported as " + filename_decimated_model)
-
-      if chunk.point_cloud:
-        filename_densepoint = output_folder + 'pointcloud_' + processing_uuid + '.las'
-        chunk.ExportPointCloud(
-          filename_densepoint, 
-          source_data = Metashape.PointCloudData,
-          save_normals=True,
-          save_colors=True,
-          save_confidence=True,
-          format= Metashape.PointCloudFormatLAZ,
-          crs = crs,
-          comment = comment
-          )
-
-      if chunk.elevation:
-        filename_dem = output_folder + 'dem_' + processing_uuid + '.tif'
-        chunk.exportRaster(
-          filename_dem, 
-          source_data = Metashape.ElevationData
-          )
-
-      if chunk.orthomosaic:
-        filename_ortho = output_folder + 'ortho_' + processing_uuid + '.tif'
-        chunk.exportRaster(
-          filename_ortho, 
-          source_data = Metashape.OrthomosaicData
-          )
-    doc.save()
-    print('Orthomosaic created for chunk ' + chunk.label + '. Project saved.')
-
-  # Create Nexus files
-
-  # Prepare mesh in MeshLab
-  extless_filename_model = os.path.splitext(filename_model)[0]
-  ms = pymeshlab.MeshSet()
-  ms.load_new_mesh(filename_model)
-  ms.save_current_mesh(
-    extless_filename_model + ".ply", 
-    binary=True, 
-    save_vertex_normal=False, 
-    save_face_color=False,
-    save_wedge_texcoord=True
-    )
+      job.request(chunk, prefix, [spec for spec in formats if spec.get("type") == "points"])
+      continue
+    job.request(chunk, prefix, formats)
 
-  os.environ['PATH'] += ':'+'/home/hallvard/Apps/nexus/nexus/bin'
+  plan = job.plan()
   try:
-    build_nxs = "nxsbuild " + extless_filename_model + ".ply -o " + extless_filename_model + ".nxs"
-    subprocess.run(build_nxs, shell=True)
-  except Exception as e:
-    build_nxs = "nxsbuild -G" + extless_filename_model + ".ply -o " + extless_filename_model + ".nxs"
-    subprocess.run(build_nxs, shell=True)
+    plan.run()
   finally:
-    build_nxz = "nxsedit -z " + extless_filename_model + ".nxs -o " + extless_filename_model + ".nxz"
-    subprocess.run(build_nxz, shell=True)
+    # Decimated copies stay in the project, the full model stays the active one
+    for chunk in doc.chunks:
+      if full_models.get(chunk.key) is not None:
+        chunk.model = find_model(chunk, full_models[chunk.key])
+    print("Exports took " + str(round(sum(result["seconds"] for result in plan.results), 1)) + " s of work, "
+      + str(round(sum(result["bytes"] for result in plan.results) / 2 ** 20, 1)) + " MiB written.")
+    if mode == "db":
+      update_processing(processing_uuid, "exports", json.dumps(plan.results))
+
+# --------------------------------------------------------------------------------
+# Exporters for the export_formats setting, see digdok_export.py
+
+LOD_LEVELS = [2000000, 500000, 100000, 20000] # Face counts of mesh/lod levels
+LEGACY_FACES = 500000 # Face count of the decimated model exported before export_formats, named without it
+
+def find_model(chunk, key):
+  for model in chunk.models:
+    if model.key == key:
+      return model
+  raise ValueError("Chunk " + chunk.label + " has no model with key " + str(key))
+
+def model_output(job, chunk, prefix, faces, texture_size, source=None):
+  """ Name of the output making a decimated copy with faces faces, textured if texture_size, None for
+  the full model. The copy is made from the model of the output named source, a larger level, or from
+  the full model. Added once however many exports use the copy """
+  if not faces:
+    return None
+  full_key = chunk.model.key if chunk.model else None
+  name = prefix + "model " + str(faces) + " faces" + (" textured" if texture_size else "")
+  if source:
+    return job.add(Output(name, lambda source_key: decimate_model(chunk, source_key, full_key, faces, texture_size), requires=[source]))
+  return job.add(Output(name, lambda: decimate_model(chunk, full_key, full_key, faces, texture_size)))
+
+def decimate_model(chunk, source_key, full_key, faces, texture_size):
+  """ Decimated copy of the model source_key, textured from the full model, returns its key """
+  if source_key is None:
+    return None
+  duplicateMesh = Metashape.Tasks.DuplicateAsset()
+  duplicateMesh.asset_type = Metashape.ModelData
+  duplicateMesh.clip_to_boundary = False
+  duplicateMesh.asset_key = source_key
+  duplicateMesh.apply(chunk)
+  # The copy is the active model now
+  chunk.decimateModel(face_count=faces, apply_to_selection=False)
+  if texture_size:
+    chunk.buildUV(mapping_mode=Metashape.GenericMapping, texture_size=texture_size)
+    transfer_texture(chunk, full_key, texture_size)
+  return chunk.model.key
+
+def transfer_texture(chunk, full_key, texture_size):
+  """ Texture the active model from the full model's texture, blending the photos again only if the
+  full model has no texture or this Metashape version can't transfer it """
+  full_model = find_model(chunk, full_key)
+  if found_major_version >= 1.7 and getattr(full_model, "textures", None):
+    try:
+      chunk.buildTexture(
+        blending_mode=Metashape.MosaicBlending, texture_size=texture_size, fill_holes=True,
+        source_model=full_key, transfer_texture=True
+      )
+      return
+    except (TypeError, ValueError, RuntimeError) as e:
+      print("Could not transfer the texture of the full model (" + str(e) + "), blending photos.")
+  chunk.buildTexture(blending_mode=Metashape.MosaicBlending, texture_size=texture_size, fill_holes=True, ghosting_filter=True)
+
+def mesh_output(job, chunk, prefix, format, options):
+  """ Name of the output exporting a model as format ('obj' or 'ply') with options faces (0 for the full
+  model), texture, texture_size and short_coords """
+  faces = int(options.get("faces") or 0)
+  texture_size = int(options.get("texture_size", 4096)) if options.get("texture", True) else 0
+  # Decimated copies are for viewers, and have shortened coordinates unless told otherwise
+  shift = options.get("short_coords", bool(faces))
+  source = model_output(job, chunk, prefix, faces, texture_size)
+  full_key = chunk.model.key if chunk.model else None
+  # model_<uuid>.obj and model_shortcoords_<uuid>.ply keep the names they had before export_formats
+  filename = job.folder + "model_" + ("shortcoords_" if shift else "") + (str(faces) + "_" if faces and faces != LEGACY_FACES else "") + job.name + "." + format
+  name = prefix + ("model " + str(faces) + " faces" if faces else "model") + (" shortcoords" if shift else "") + " " + format
+  work = lambda key=full_key: export_model(chunk, filename, key, format, job.shift if shift else None, job.comment)
+  return job.add(Output(name, work, requires=[source]) if source else Output(name, work))
+
+def export_model(chunk, filename, key, format, shift, comment):
+  if key is None:
+    return None
+  chunk.model = find_model(chunk, key)
+  if format == "obj":
+    options = dict(binary=False, precision=6, format=Metashape.ModelFormatOBJ)
+  else:
+    options = dict(binary=True, format=Metashape.ModelFormatPLY)
+  if shift is not None:
+    options["shift"] = shift
+  chunk.exportModel(
+    filename,
+    clip_to_boundary=False,
+    save_texture=True,
+    embed_texture=True,
+    save_normals=True,
+    save_colors=True,
+    save_cameras=True,
+    strip_extensions=False,
+    crs=chunk.crs,
+    comment=comment,
+    save_comment=True,
+    **options
+  )
+  return filename
+
+@exporter("mesh", "obj")
+def obj_exporter(job, chunk, prefix, options):
+  mesh_output(job, chunk, prefix, "obj", options)
+
+@exporter("mesh", "ply")
+def ply_exporter(job, chunk, prefix, options):
+  mesh_output(job, chunk, prefix, "ply", options)
+
+@exporter("mesh", "lod")
+def lod_exporter(job, chunk, prefix, options):
+  """ Levels of detail, options levels (face counts, default LOD_LEVELS) in options format (default
+  'ply'), each decimated from the level above it """
+  texture_size = int(options.get("texture_size", 4096)) if options.get("texture", True) else 0
+  source = None
+  for faces in sorted((int(faces) for faces in options.get("levels", LOD_LEVELS)), reverse=True):
+    source = model_output(job, chunk, prefix, faces, texture_size, source)
+    # Finds the level just added by its name
+    mesh_output(job, chunk, prefix, options.get("format", "ply"), dict(options, faces=faces))
+
+@exporter("mesh", "meshlab")
+def meshlab_exporter(job, chunk, prefix, options):
+  """ Full model post-processed by pymeshlab in digdok_meshpost's process pool, options faces (0 keeps
+  them all), clean, normals, short_coords and format ('ply' or 'obj'). The export doesn't wait for it """
+  faces = int(options.get("faces") or 0)
+  format = options.get("format", "ply")
+  # Shifted by Metashape in double precision when the source is exported, pymeshlab holds float32 coordinates.
+  # A zero shift means there is none
+  shift = bool(options.get("short_coords", True) and job.shift is not None and any(job.shift[i] for i in range(3)))
+  source = mesh_output(job, chunk, prefix, "obj", {"short_coords": shift})
+  target = job.folder + "model_meshlab_" + ("shortcoords_" if shift else "") + (str(faces) + "_" if faces else "") + job.name + "." + format
+  job.add(Output(
+    prefix + "meshlab " + os.path.basename(target),
+    lambda filename_model: meshpost(filename_model, target, faces, options.get("clean", True), options.get("normals", True), format == "ply"),
+    requires=[source], external=True
+  ))
+
+def meshpost(source, target, faces, clean, normals, binary):
+  # Bound now, the globals belong to the next job by the time the model is done
+  job_mode, job_processing_uuid = mode, processing_uuid
+  def record(result):
+    if job_mode == "db":
+      dbstatement("append_mesh_post", "update", json.dumps([result]), job_processing_uuid)
+  digdok_meshpost.submit(source, target, record, faces=faces, clean=clean, normals=normals, binary=binary)
+  return target
+
+@exporter("mesh", "nxs")
+def nexus_exporter(job, chunk, prefix, options):
+  """ Nexus file of the model. From the exported OBJ converted to binary PLY outside Metashape, or with
+  options source 'ply' from a binary PLY Metashape exports, with no conversion """
+  mesh_options = dict(options, short_coords=options.get("short_coords", False))
+  if options.get("source", "obj") == "ply":
+    ply = mesh_output(job, chunk, prefix, "ply", mesh_options)
+    return job.add(Output(ply + " nexus", digdok_export.nexus, requires=[ply], external=True))
+  source = mesh_output(job, chunk, prefix, "obj", mesh_options)
+  # Not named like the OBJ, a PLY export of the same model may be written at the same time
+  ply = job.add(Output(
+    source + " nexus ply", lambda filename_model: digdok_plyconvert.obj_to_ply(filename_model, os.path.splitext(filename_model)[0] + "_nexus.ply"),
+    requires=[source], external=True
+  ))
+  return job.add(Output(
+    source + " nexus", lambda filename_ply: digdok_export.nexus(filename_ply, filename_ply[:-len("_nexus.ply")] + ".nxs"),
+    requires=[ply], external=True
+  ))
+
+@exporter("mesh", "nxz")
+def nexus_compressed_exporter(job, chunk, prefix, options):
+  nexus = nexus_exporter(job, chunk, prefix, options)
+  job.add(Output(nexus + " compressed", digdok_export.nexus_compressed, requires=[nexus], external=True))
+
+@exporter("report", "pdf")
+def report_exporter(job, chunk, prefix, options):
+  filename = job.folder + 'report_' + job.name + '.pdf'
+  job.add(Output(prefix + "report", lambda: export_report(chunk, filename)))
+
+def export_report(chunk, filename_report):
+  chunk.exportReport(
+    path=filename_report,
+    title=folder,
+    description=processing_uuid
+    # user_settings = report_settings
+  )
+  return filename_report
+
+def points_output(job, chunk, prefix, format):
+  filename = job.folder + 'pointcloud_' + job.name + '.' + format
+  job.add(Output(prefix + "point cloud " + format, lambda: export_points(chunk, filename, format, job.comment)))
+
+@exporter("points", "laz")
+def laz_exporter(job, chunk, prefix, options):
+  points_output(job, chunk, prefix, "laz")
+
+@exporter("points", "las")
+def las_exporter(job, chunk, prefix, options):
+  points_output(job, chunk, prefix, "las")
+
+def export_points(chunk, filename_densepoint, format, comment):
+  if not chunk.point_cloud:
+    return None
+  if found_major_version <= 1.5:
+    chunk.exportPointCloud(
+      filename_densepoint,
+      source_data=Metashape.PointCloudData
+    )
+  elif found_major_version < 2:
+    chunk.exportPoints(
+      filename_densepoint,
+      source_data=Metashape.DenseCloudData,
+      save_normals=True,
+      save_colors=True,
+      save_confidence=True,
+      format=Metashape.PointsFormatLAZ if format == "laz" else Metashape.PointsFormatLAS,
+      crs=chunk.crs,
+      comment=comment
+    )
+  else:
+    chunk.exportPointCloud(
+      filename_densepoint,
+      source_data=Metashape.PointCloudData,
+      save_normals=True,
+      save_colors=True,
+      save_confidence=True,
+      format=Metashape.PointCloudFormatLAZ if format == "laz" else Metashape.PointCloudFormatLAS,
+      crs=chunk.crs,
+      comment=comment
+    )
+  return filename_densepoint
+
+def raster_output(job, chunk, prefix, options, kind):
+  """ DEM or orthomosaic as GeoTIFF, at options resolution in metres if it is set """
+  filename = job.folder + kind + '_' + job.name + '.tif'
+  resolution = float(options.get("resolution") or 0)
+  job.add(Output(prefix + kind, lambda: export_raster(chunk, filename, kind, resolution)))
+
+@exporter("dem", "tiff")
+@exporter("dem", "tif")
+def dem_exporter(job, chunk, prefix, options):
+  raster_output(job, chunk, prefix, options, "dem")
+
+@exporter("ortho", "tiff")
+@exporter("ortho", "tif")
+def ortho_exporter(job, chunk, prefix, options):
+  raster_output(job, chunk, prefix, options, "ortho")
+
+def export_raster(chunk, filename, kind, resolution=0):
+  data = chunk.elevation if kind == "dem" else chunk.orthomosaic
+  if not data:
+    return None
+  options = {"resolution": resolution} if resolution else {}
+  chunk.exportRaster(
+    filename,
+    source_data=Metashape.ElevationData if kind == "dem" else Metashape.OrthomosaicData,
+    **options
+  )
+  return filename
 
 
 # #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-# #
 # #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-# Run script  #-#-#-#-#-#-#-#-#-#-#-#-#-#-# #
 # #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-# #
 
-def run(runmode):
+def run(runmode, capture=None):
 
   global mode
   mode = runmode
@@ -1496,346 +1157,183 @@ def run(runmode):
   # Check mode, and create project
   if mode == "standalone":
     print("Mode: Manual, standalone.")
-    pickfoldernamechunk()
     global uuid
     uuid = ""
+    # Get/set variables, before the photos are loaded as they decide which photos are used
+    vars(uuid)
+    pickfoldernamechunk()
   elif mode == "db":
     print("Mode: PostgreSQL database.")
-    loadfromdb()
+    if capture is None:
+      capture = dbstatement("first_queued_capture", "select_one")
+    if not capture:
+      sys.exit("No models to process. Exiting.")
+    # Get/set variables, before the photos are loaded as they decide which photos are used
+    vars(capture[0])
+    loadfromdb(capture)
     set_processing(uuid)
-  # Get/set variables
-  vars(uuid)
-
-  # Estimate image quality
-  if est_iq_bool:
-    print("")
-    print("***** Estimating Image Quality *****")
-    print("")
-    if get_status(uuid, "estimating_iq") in ["done", "skip"]:
-      print("Image quality estimation already done. Skipping.\n")
-    else:
-      update_status(uuid, "estimating_iq", "processing")
-      try:
-        estimagequality(iq_threshold)
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "estimating_iq", "failed")
-      else:
-        update_status(uuid, "estimating_iq", "done")
-
-  # Align images
-  if align_bool:
-    print("")
-    print("***** Aligning Images *****")
-    print("")
-    if get_status(uuid, "aligning") in ["done", "skip"]:
-      print("Image aligning already done. Skipping.\n")
-    else:
-      update_status(uuid, "aligning", "processing")
-      try:
-        images_aligned = align()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "aligning", "failed")
-      else:
-        update_processing(processing_uuid, "images_aligned", images_aligned)
-        update_status(uuid, "aligning", "done")
-
-  # Populate targets
-  if poptargets_bool:
-    print("")
-    print("***** Georeferencing Targets *****")
-    print("")    
-    if get_status(uuid, "populating_targets") in ["done", "skip"]:
-      print("Target population already done. Skipping.\n")
-    else:
-      update_status(uuid, "populating_targets", "processing")
-      try:
-        targets_used = poptargets()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "populating_targets", "failed")
-      else:
-        update_processing(processing_uuid, "targets_used", targets_used)
-        error = calc_error()
-        update_processing(processing_uuid, "estimated_error", error)
-        update_status(uuid, "populating_targets", "done")
-
-  # Uncheck markers with less than N projections
-  if uncheckmarkers_bool:
-    print("")
-    print("***** Unchecking Markers *****")
-    print("")
-    if get_status(uuid, "uncheckingmarkers") in ["done", "skip"]:
-      print("Target population already done. Skipping.\n")
-    else:
-      update_status(uuid, "uncheckingmarkers", "processing")
-      try:
-        targets_used = uncheckmarkers()
-        error = calc_error()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "uncheckingmarkers", "failed")
-      else:
-        print(str(targets_used) + " targets used.")
-        update_processing(processing_uuid, "targets_used", targets_used)
-        update_processing(processing_uuid, "estimated_error", error)
-        update_status(uuid, "uncheckingmarkers", "done")
-
-  # Populate Scalebars
-  if scalebar_bool:
-    print("")
-    print("***** Adding Scalebars *****")
-    print("")    
-    if get_status(uuid, "adding_scalebars") in ["done", "skip"]:
-      print("Scalebars alrady added. Skipping.\n")
-    else:
-      update_status(uuid, "adding_scalebars", "processing")
-      try:
-        scalebars_used = add_scalebars()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "adding_scalebars", "failed")
-      else:
-        print(str(scalebars_used) + " scalebars used.")
-        update_processing(processing_uuid, "scalebars_used", scalebars_used)
-        update_status(uuid, "adding_scalebars", "done")
-
-  # Align Bounding boxes to grid
-  if alignbbox_bool:
-    print("")
-    print("***** Aligning Bounding Box *****")
-    print("")
-    if get_status(uuid, "aligning_bbox") in ["done", "skip"]:
-      print("Bounding boxes already aligned to grid. Skipping.\n")
-    else:
-      update_status(uuid, "aligning_bbox", "processing")
-      try:
-        alignbb2cs()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "aligning_bbox", "failed")
-      else:
-        update_status(uuid, "aligning_bbox", "done")
-
-  # Optimise alignment (first time)
-  if optimizealignment_bool:
-    print("")
-    print("***** Optimising Alignment *****")
-    print("")
-    if get_status(uuid, "optimizing_alignment") in ["done", "skip"]:
-      print("Alignment already optimised. Skipping.\n")
-    else:
-      update_status(uuid, "optimizing_alignment", "processing")
-      try:
-        optimizealignments()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "optimizing_alignment", "failed")
-      else:
-        error = calc_error()
-        update_processing(processing_uuid, "estimated_error", error)
-        update_status(uuid, "optimizing_alignment", "done")
+    update_processing(processing_uuid, "duplicates_dropped", duplicates_dropped)
 
-  # Reducing errors and re-optimising alignment
-  if err_red_bool:
-    print("")
-    print("***** Running Error Reduction Algorithms *****")
-    print("")
-    if get_status(uuid, "reducing_error") in ["done", "skip"]:
-      print("Error reduction already done. Skipping.\n")
-    else:
-      update_status(uuid, "reducing_error", "processing")
-      try:
-        reconstructionuncertainty()
-        optimizealignments()
-        projectionaccuracy()
-        optimizealignments()
-        reproductionerror()
-        optimizealignments()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "reducing_error", "failed")
-      else:
-        error = calc_error()
-        update_processing(processing_uuid, "estimated_error", error)
-        update_status(uuid, "reducing_error", "done")
-
-  # Build Depth Maps
-  if depthmap_bool:
-    print("")
-    print("***** Building Depthmaps *****")
-    print("")
-    if get_status(uuid, "building_depthmaps") in ["done", "skip"]:
-      print("Depthmaps already built. Skipping.\n")
-    else:
-      update_status(uuid, "building_depthmaps", "processing")
-      try:
-        depthmaps()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "building_depthmaps", "failed")
-      else:
-        update_processing(processing_uuid, "depth_maps_created", "true")
-        update_status(uuid, "building_depthmaps", "done")
-
-  # Build Dense Cloud
-  if densecloud_bool:
-    print("")
-    print("***** Building Dense Cloud *****")
-    print("")
-    if get_status(uuid, "building_densecloud") in ["done", "skip"]:
-      print("Dense cloud already built. Skipping.\n")
-    else:
-      update_status(uuid, "building_densecloud", "processing")
-      try:
-        densecloud()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "building_densecloud", "failed")
-      else:
-        update_processing(processing_uuid, "dense_point_cloud_created", "true")
-        update_status(uuid, "building_densecloud", "done")
-
-  # Build Mesh
-  if mesh_bool:
-    print("")
-    print("***** Creating Mesh *****")
-    print("")
-    if get_status(uuid, "meshing") in ["done", "skip"]:
-      print("Mesh already built. Skipping.\n")
-    else:
-      update_status(uuid, "meshing", "processing")
-      try:
-        mesh()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "meshing", "failed")
-      else:
-        update_processing(processing_uuid, "mesh_created", "true")
-        update_status(uuid, "meshing", "done")
-
-  # Build Texture
-  if texture_bool:
-    print("")
-    print("***** Creating Texture *****")
-    print("")
-    if get_status(uuid, "texturing") in ["done", "skip"]:
-      print("Mesh already built. Skipping.\n")
-    else:
-      update_status(uuid, "texturing", "processing")
-      try:
-        texture()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "texturing", "failed")
-      else:
-        update_processing(processing_uuid, "texture_created", "true")
-        update_status(uuid, "texturing", "done")
-
-  # DEM
-  if dem_bool:
-    print("")
-    print("***** Building DEM *****")
-    print("")
-    if get_status(uuid, "building_dem") in ["done", "skip"]:
-      print("DEM already made. Skipping.\n")
-    else:
-      update_status(uuid, "building_dem", "processing")
-      try:
-        dem()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "building_dem", "failed")
-      else:
-        update_processing(processing_uuid, "dem_created", "true")
-        update_status(uuid, "building_dem", "done")
-
-  # Orthophoto
-  if ortho_bool:
-    print("")
-    print("***** Building Orthomosaic *****")
-    print("")
-    if get_status(uuid, "building_ortho") in ["done", "skip"]:
-      print("Orthomosaic already made. Skipping.\n")
-    else:
-      update_status(uuid, "building_ortho", "processing")
-      try:
-        ortho()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "building_ortho", "failed")
-      else:      
-        update_processing(processing_uuid, "orthophoto_created", "true")
-        update_status(uuid, "building_ortho", "done")
-
-  # Decimate mesh
-
-
-  # Exports
-  if export_bool:
-    print("")
-    print("***** Exporting results *****")
-    print("")
-    if get_status(uuid, "exporting") in ["done", "skip"]:
-      print("Exports already done. Skipping.\n")
-    else:
-      update_status(uuid, "exporting", "processing")
-      try:
-        export()
-      except Exception as e:
-        print()
-        print("!!!!! Exception !!!!!")
-        print(e)
-        print()
-        update_status(uuid, "exporting", "failed")
-      else:
-        update_status(uuid, "exporting", "done")
+  # Status reads and writes for the rest of the run go through the cache
+  global status_cache
+  if mode == "db":
+    status_cache = StatusCache(uuid, processing_uuid)
+  # Project saves, stages are marked done once they are saved
+  global checkpoint
+  checkpoint = Checkpoint(doc, lambda step: update_status(uuid, step, "done"))
+  # Stage timings and resource use, in new.stage_timing or in a JSON lines file next to the projects
+  global instrument
+  if mode == "db":
+    sinks = [digdok_instrument.DatabaseSink(processing_uuid)]
+  else:
+    sinks = [digdok_instrument.JsonLinesSink(path + "/stage_timing.jsonl")]
+  instrument = digdok_instrument.Instrument(
+    sinks, path,
+    counts=lambda: digdok_instrument.counts(doc),
+    parameters=dict(
+      {name: getattr(settings, name) for name in digdok_instrument.PARAMETERS},
+      # Inputs of the cost model in digdok_estimator.py
+      photos=len(photo_inventory) if photo_inventory else 0,
+      megapixels=round(photo_inventory.megapixels(), 1) if photo_inventory else 0
+    )
+  )
+  try:
+    run_stages()
+  finally:
+    checkpoint.close()
+    if mode == "db":
+      update_processing(processing_uuid, "checkpoints", json.dumps(checkpoint.saves))
+    print("Project saved " + str(len(checkpoint.saves)) + " times, " + str(round(checkpoint.seconds(), 1)) + " s in total.")
+    if status_cache:
+      status_cache.close()
+      status_cache = None
 
   return uuid
 
+# Stage building each kind of source data, for the stages reading it
+SOURCE_STAGES = {
+  "DepthMapsData": "building_depthmaps",
+  "DepthMapsAndLaserScansData": "building_depthmaps",
+  "DenseCloudData": "building_densecloud",
+  "TiePointsData": "reducing_error",
+  "ModelData": "meshing",
+  "ElevationData": "building_dem",
+}
+PARALLEL_STAGES = 2 # Stages that don't touch the same data run side by side, up to this many
+
+def source_stage(source):
+  """ Stage building source data, the dense cloud if it isn't known """
+  if source == "PointCloudData":
+    # The tie points before 2.0, the dense cloud since
+    return "building_densecloud" if found_major_version >= 2 else "reducing_error"
+  return SOURCE_STAGES.get(source, "building_densecloud")
+
+def run_stages():
+
+  # Texturing works on the model's texture, the DEM and orthomosaic on their own rasters, scalebars and
+  # targets on different markers, so those branches run side by side. The rest work on what the
+  # stages before them built and run alone.
+  pipeline = Pipeline([
+    Stage("estimating_iq", "Estimating Image Quality", settings.est_iq_bool,
+      lambda: estimagequality(settings.iq_threshold)),
+    Stage("aligning", "Aligning Images", settings.align_bool,
+      lambda: {"images_aligned": align()},
+      after=["estimating_iq"]),
+    Stage("populating_targets", "Georeferencing Targets", settings.poptargets_bool,
+      lambda: {"targets_used": poptargets()},
+      requires=["aligning"],
+      metrics={"estimated_error": calc_error},
+      exclusive=False),
+    # Uncheck markers with less than N projections
+    Stage("uncheckingmarkers", "Unchecking Markers", settings.uncheckmarkers_bool,
+      lambda: {"targets_used": uncheckmarkers()},
+      requires=["populating_targets"],
+      metrics={"estimated_error": calc_error}),
+    Stage("adding_scalebars", "Adding Scalebars", settings.scalebar_bool,
+      lambda: {"scalebars_used": add_scalebars()},
+      requires=["aligning"],
+      exclusive=False),
+    # Georeferenced first if it is, but the box can be aligned to the local frame as well
+    Stage("aligning_bbox", "Aligning Bounding Box", settings.alignbbox_bool,
+      alignbb2cs,
+      requires=["aligning"],
+      after=["populating_targets"]),
+    # First optimisation, with the final set of markers and scalebars
+    Stage("optimizing_alignment", "Optimising Alignment", settings.optimizealignment_bool,
+      optimizealignments,
+      requires=["uncheckingmarkers", "adding_scalebars"],
+      metrics={"estimated_error": calc_error}),
+    # Reducing errors and re-optimising alignment
+    Stage("reducing_error", "Running Error Reduction Algorithms", settings.err_red_bool,
+      lambda: {"error_reduction": json.dumps(reduceerrors())},
+      requires=["optimizing_alignment"],
+      metrics={"estimated_error": calc_error}),
+    Stage("building_depthmaps", "Building Depthmaps", settings.depthmap_bool,
+      depthmaps,
+      requires=["reducing_error", "aligning_bbox"],
+      metrics={"depth_maps_created": "true"}),
+    Stage("building_densecloud", "Building Dense Cloud", settings.densecloud_bool,
+      densecloud,
+      requires=["building_depthmaps"],
+      metrics={"dense_point_cloud_created": "true"}),
+    Stage("meshing", "Creating Mesh", settings.mesh_bool,
+      mesh,
+      requires=[source_stage(settings.source_data)],
+      metrics={"mesh_created": "true"}),
+    Stage("texturing", "Creating Texture", settings.texture_bool,
+      texture,
+      requires=["meshing"],
+      metrics={"texture_created": "true"},
+      exclusive=False),
+    Stage("building_dem", "Building DEM", settings.dem_bool,
+      dem,
+      requires=[source_stage(settings.dem_datasource)],
+      metrics={"dem_created": "true"},
+      exclusive=False),
+    Stage("building_ortho", "Building Orthomosaic", settings.ortho_bool,
+      ortho,
+      requires=[source_stage(settings.ortho_surfacedata)],
+      metrics={"orthophoto_created": "true"},
+      exclusive=False),
+    # Each output is skipped if its data wasn't built, so a failed DEM doesn't cancel the model exports
+    Stage("exporting", "Exporting results", settings.export_bool,
+      export,
+      requires=["aligning"],
+      after=["building_densecloud", "texturing", "building_dem", "building_ortho"]),
+  ],
+    workers=PARALLEL_STAGES,
+    get_status=lambda step: get_status(uuid, step),
+    start=start_stage,
+    finish=finish_stage,
+    fail=fail_stage
+  )
+  try:
+    pipeline.run()
+  finally:
+    if mode == "db":
+      update_processing(processing_uuid, "stage_seconds", json.dumps(pipeline.seconds))
+
+def start_stage(stage):
+  # Waits for a free slot of the stage's class on this node, unless the stage runs elsewhere
+  if not digdok_offload.offloaded(stage.status):
+    digdok_scheduler.slots.acquire(stage.status)
+  checkpoint.begin(stage.status)
+  update_status(uuid, stage.status, "processing")
+  instrument.begin(stage.status)
+
+def finish_stage(stage, metrics):
+  for column, value in metrics.items():
+    print(column + ": " + str(value))
+    update_processing(processing_uuid, column, value)
+  checkpoint.done(stage.status)
+  instrument.end(stage.status, "done")
+  digdok_scheduler.slots.release(stage.status)
+
+def fail_stage(stage, error):
+  update_status(uuid, stage.status, "failed")
+  checkpoint.failed(stage.status)
+  instrument.end(stage.status, "failed")
+  digdok_scheduler.slots.release(stage.status)
 
 
 # Run the script if this is main
@@ -1857,4 +1355,5 @@ if __name__ == "__main__":
     update_status(uuid, "status", "failed")
   else:
     # Set status done
-    update_status(uuid, "status", "done")
\ No newline at end of file
+    update_status(uuid, "status", "done")
+  digdok_meshpost.wait()
\ No newline at end of file
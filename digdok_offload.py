@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# Heavy stages handed to a Metashape network processing server.
+#
+# With a server set in the [offload] section of database.ini, the stages
+# listed there (depth maps and dense cloud by default) are not run on this
+# node. Each chunk's call becomes a task description, the Metashape task name
+# and its parameters, e.g. ("BuildDepthMaps", {"downscale": 2, ...}). The
+# project is saved, the tasks are sent as one batch to the server, which
+# splits them into work items of workitem_size_cameras cameras and spreads
+# those over all its nodes, and the worker waits for the batch before
+# reopening the project with the results. The local worker keeps its lease
+# and gives up the stage slot of the offloaded stage meanwhile.
+#
+# Processing nodes open the project from shared storage, so capture folders
+# must be reachable below the server's root path, set as 'root' if it differs
+# from the path on this worker.
+#
+# Every batch is a row in new.offload_batch (sql/011_offload_batch.sql).
+# LocalBackend runs the same task descriptions in this process and stands in
+# for the server when testing.
+
+import os
+import json
+import time
+import socket
+
+from dbconfig import config
+
+try:
+  import Metashape
+except ImportError:
+  Metashape = None
+
+
+try:
+  offload_params = config(section='offload')
+except Exception:
+  offload_params = {}
+
+SERVER = offload_params.get('server') # Network processing server, None runs everything locally
+ROOT = offload_params.get('root', '') # Prefix of project paths that the nodes see as their root
+STAGES = frozenset(
+  name.strip() for name in offload_params.get('stages', "building_depthmaps,building_densecloud").split(",") if name.strip()
+)
+POLL = float(offload_params.get('poll', 10)) # Seconds between batch status checks
+PRIORITY = int(offload_params.get('priority', 0)) # Batch priority on the server
+
+FINISHED = ("completed", "failed", "aborted", "canceled")
+
+
+def offloaded(stage):
+  """ True if stage is sent to the server instead of run here """
+  return bool(SERVER) and stage in STAGES
+
+def method(task):
+  """ Chunk method doing the same as a Metashape task, BuildDepthMaps -> buildDepthMaps """
+  return task[0].lower() + task[1:]
+
+def describe(params):
+  # Metashape enums and other values as strings, for the database
+  return {name: value if isinstance(value, (bool, int, float, str, type(None))) else str(value) for name, value in params.items()}
+
+# -----------------------------------------------------------------
+
+class LocalBackend:
+  """ Runs task descriptions in this process, one after the other """
+
+  name = "local"
+
+  def __init__(self):
+    self.batches = {}
+
+  def submit(self, doc, tasks):
+    batch_id = len(self.batches) + 1
+    for chunk, task, params in tasks:
+      getattr(chunk, method(task))(**params)
+    self.batches[batch_id] = {"status": "completed"}
+    return batch_id
+
+  def status(self, batch_id):
+    return self.batches[batch_id]
+
+  def collect(self, doc):
+    # The chunks were changed in place
+    pass
+
+class NetworkBackend:
+  """ Sends task descriptions to a Metashape network processing server """
+
+  name = "network"
+
+  def __init__(self, server=None, root=ROOT, priority=PRIORITY):
+    self.server = server or SERVER
+    self.root = root
+    self.priority = priority
+    self.client = None
+
+  def connect(self):
+    if self.client is None:
+      self.client = Metashape.NetworkClient()
+      self.client.connect(self.server)
+    return self.client
+
+  def network_task(self, chunk, task, params):
+    metashape_task = getattr(Metashape.Tasks, task)()
+    for name, value in params.items():
+      setattr(metashape_task, name, value)
+    # Metashape 2.x converts a task for a chunk, 1.x encodes it with the chunk set on the task
+    if hasattr(metashape_task, "toNetworkTask"):
+      return metashape_task.toNetworkTask(chunk)
+    network_task = metashape_task.encode()
+    network_task.frames.append((chunk.key, 0))
+    network_task.network_distribute = True
+    return network_task
+
+  def submit(self, doc, tasks):
+    client = self.connect()
+    path = doc.path
+    if self.root and path.startswith(self.root):
+      path = os.path.relpath(path, self.root)
+    batch_id = client.createBatch(path, [self.network_task(chunk, task, params) for chunk, task, params in tasks])
+    if self.priority:
+      client.setBatchPriority(batch_id, self.priority)
+    client.setBatchPaused(batch_id, False)
+    return batch_id
+
+  def status(self, batch_id):
+    return self.connect().batchStatus(batch_id)
+
+  def collect(self, doc):
+    # The nodes saved their results in the project, read them back
+    doc.open(doc.path, read_only=False, ignore_lock=True)
+
+def backend():
+  return NetworkBackend() if SERVER else LocalBackend()
+
+# -----------------------------------------------------------------
+
+class OffloadError(Exception):
+  pass
+
+def run(doc, stage, tasks, backend, record=None):
+  """ Run tasks, a list of (chunk, task name, parameters), as one batch and wait for it.
+  record(event, values) is called on 'submitted' and 'finished', for the database """
+  doc.save()
+  description = [{"chunk": chunk.label, "task": task, "params": describe(params)} for chunk, task, params in tasks]
+  start = time.monotonic()
+  batch_id = backend.submit(doc, tasks)
+  print(stage + ": " + str(len(tasks)) + " tasks sent as batch " + str(batch_id) + " (" + backend.name + ").")
+  if record:
+    record("submitted", {"stage": stage, "backend": backend.name, "server": getattr(backend, "server", None), "batch_id": str(batch_id), "tasks": json.dumps(description), "worker_id": socket.gethostname() + ":" + str(os.getpid())})
+
+  last_progress = None
+  while True:
+    status = backend.status(batch_id)
+    state = status.get("status")
+    if state in FINISHED:
+      break
+    progress = status.get("progress")
+    if progress is not None and progress != last_progress:
+      print(stage + ": batch " + str(batch_id) + " " + str(state) + ", " + str(round(progress, 1)) + "%")
+      last_progress = progress
+    time.sleep(POLL)
+
+  seconds = round(time.monotonic() - start, 3)
+  if record:
+    record("finished", {"batch_id": str(batch_id), "status": state, "seconds": seconds})
+  if state != "completed":
+    raise OffloadError(stage + ": batch " + str(batch_id) + " ended " + str(state))
+  backend.collect(doc)
+  print(stage + ": batch " + str(batch_id) + " completed in " + str(seconds) + " s.")
+  return seconds
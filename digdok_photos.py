@@ -0,0 +1,332 @@
+#!/usr/bin/python
+#
+# Photo inventory for capture folders.
+#
+# Walks a Photos folder with os.scandir and reads the EXIF header of every
+# JPEG in a thread pool. Only the marker segments at the start of each file
+# are read, never the image data, so a folder of thousands of photos on
+# network storage is catalogued in seconds, before Metashape sees any of them.
+# The result is kept in flat arrays rather than one object per photo.
+#
+# PhotoIndex keeps the inventory in a SQLite file in the capture folder, keyed
+# by path, size and mtime, so rescans only read headers of new or changed files
+# and a resumed capture whose Photos folder hasn't changed isn't listed at all.
+# It also caches per-photo values derived from file contents (digdok_dedup's
+# hashes, digdok_sharpness's scores), cleared whenever a file's size or mtime
+# changes.
+
+import os
+import math
+import struct
+import sqlite3
+from array import array
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg")
+WORKERS = 16 # Threads reading headers, mostly waiting on I/O
+EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+INDEX_FILE = "photo_index.sqlite" # In the capture folder, next to Photos
+# Derived from file contents, NULL until computed
+CACHED_COLUMNS = {
+  "digest": "TEXT", # digdok_dedup
+  "phash": "TEXT", # digdok_dedup
+  "sharpness_ratio": "REAL", # digdok_sharpness
+}
+
+# JPEG start-of-frame markers, these hold the image dimensions
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# TIFF tags used from the EXIF header
+TAG_MODEL = 0x0110
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_PIXEL_X = 0xA002
+TAG_PIXEL_Y = 0xA003
+
+# TIFF field types we read: size in bytes and struct format
+TIFF_TYPES = {
+  2: (1, None), # ASCII
+  3: (2, "H"), # SHORT
+  4: (4, "L"), # LONG
+}
+
+
+def is_photo(name):
+  return name.lower().endswith(PHOTO_EXTENSIONS)
+
+# -----------------------------------------------------------------
+
+def read_ifd(tiff, offset, order):
+  """ Tags of one TIFF IFD as a dict, ASCII values decoded, numbers as ints """
+  tags = {}
+  if offset + 2 > len(tiff):
+    return tags
+  count = struct.unpack_from(order + "H", tiff, offset)[0]
+  for i in range(count):
+    entry = offset + 2 + i * 12
+    if entry + 12 > len(tiff):
+      break
+    tag, type, length = struct.unpack_from(order + "HHL", tiff, entry)
+    if type not in TIFF_TYPES:
+      continue
+    size, format = TIFF_TYPES[type]
+    if size * length <= 4:
+      data_offset = entry + 8
+    else:
+      data_offset = struct.unpack_from(order + "L", tiff, entry + 8)[0]
+    if data_offset + size * length > len(tiff):
+      continue
+    if format is None:
+      tags[tag] = tiff[data_offset:data_offset + length].split(b"\0", 1)[0].decode("ascii", "replace").strip()
+    else:
+      tags[tag] = struct.unpack_from(order + format, tiff, data_offset)[0]
+  return tags
+
+def parse_exif(tiff):
+  """ (timestamp, width, height, model) from the TIFF block of an APP1 Exif segment """
+  order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+  if order is None:
+    return None, 0, 0, ""
+  ifd0 = read_ifd(tiff, struct.unpack_from(order + "L", tiff, 4)[0], order)
+  exif = {}
+  if TAG_EXIF_IFD in ifd0:
+    exif = read_ifd(tiff, ifd0[TAG_EXIF_IFD], order)
+  timestamp = None
+  for value in [exif.get(TAG_DATETIME_ORIGINAL), ifd0.get(TAG_DATETIME)]:
+    if value:
+      try:
+        timestamp = datetime.strptime(value, EXIF_DATE_FORMAT).timestamp()
+        break
+      except ValueError:
+        pass
+  return timestamp, exif.get(TAG_PIXEL_X, 0), exif.get(TAG_PIXEL_Y, 0), ifd0.get(TAG_MODEL, "")
+
+def read_header(path):
+  """ (timestamp, width, height, model) from the JPEG headers of path, skipping over image data """
+  timestamp, width, height, model = None, 0, 0, ""
+  with open(path, "rb") as f:
+    if f.read(2) != b"\xff\xd8":
+      return timestamp, width, height, model
+    while True:
+      marker = f.read(4)
+      if len(marker) < 4 or marker[0] != 0xFF:
+        break
+      code = marker[1]
+      length = struct.unpack(">H", marker[2:])[0] - 2
+      if code == 0xDA or code == 0xD9:
+        # Start of scan, the rest is image data
+        break
+      if code == 0xE1 and timestamp is None:
+        segment = f.read(length)
+        if segment[:6] == b"Exif\0\0":
+          timestamp, width, height, model = parse_exif(segment[6:])
+      elif code in SOF_MARKERS:
+        segment = f.read(5)
+        # The frame header has the real dimensions, EXIF pixel sizes can be missing or stale
+        height, width = struct.unpack(">HH", segment[1:5])
+        break
+      else:
+        f.seek(length, os.SEEK_CUR)
+  return timestamp, width, height, model
+
+# -----------------------------------------------------------------
+
+class PhotoInventory:
+  """ Path, size, mtime, EXIF timestamp, dimensions and camera model of the photos in a folder """
+
+  __slots__ = ("folder", "paths", "sizes", "mtimes", "timestamps", "widths", "heights", "model_index", "models")
+
+  def __init__(self, folder):
+    self.folder = folder
+    self.paths = []
+    self.sizes = array("q") # bytes
+    self.mtimes = array("q") # ns
+    self.timestamps = array("d") # EXIF DateTimeOriginal as epoch seconds, nan if missing
+    self.widths = array("L")
+    self.heights = array("L")
+    self.model_index = array("H") # index into models, camera models repeat so are stored once
+    self.models = []
+
+  def __len__(self):
+    return len(self.paths)
+
+  def append(self, path, size, mtime, timestamp, width, height, model):
+    if model not in self.models:
+      self.models.append(model)
+    self.paths.append(path)
+    self.sizes.append(size)
+    self.mtimes.append(mtime)
+    self.timestamps.append(math.nan if timestamp is None else timestamp)
+    self.widths.append(width)
+    self.heights.append(height)
+    self.model_index.append(self.models.index(model))
+
+  def model(self, i):
+    return self.models[self.model_index[i]]
+
+  def capture_date(self):
+    """ Earliest EXIF date in the folder, or the earliest file modification time if there is none """
+    taken = [t for t in self.timestamps if not math.isnan(t)]
+    if taken:
+      return datetime.fromtimestamp(min(taken))
+    if self.mtimes:
+      return datetime.fromtimestamp(min(self.mtimes) / 1e9)
+    return None
+
+  def megapixels(self):
+    return sum(w * h for w, h in zip(self.widths, self.heights)) / 1e6
+
+  def summary(self):
+    return (
+      str(len(self)) + " photos, " + str(round(sum(self.sizes) / 1e9, 2)) + " GB, "
+      + str(round(self.megapixels())) + " MP, cameras: " + ", ".join(m for m in self.models if m)
+    )
+
+# -----------------------------------------------------------------
+
+def list_photos(folder):
+  """ (path, size, mtime_ns) of the photos directly in folder, sorted by name """
+  photos = []
+  with os.scandir(folder) as entries:
+    for entry in entries:
+      if is_photo(entry.name) and entry.is_file():
+        stat = entry.stat()
+        photos.append((folder + "/" + entry.name, stat.st_size, stat.st_mtime_ns))
+  photos.sort()
+  return photos
+
+def stat_photos(paths):
+  """ (path, size, mtime_ns) of paths, leaving out those that no longer exist """
+  photos = []
+  for path in paths:
+    try:
+      stat = os.stat(path)
+    except FileNotFoundError:
+      continue
+    photos.append((path, stat.st_size, stat.st_mtime_ns))
+  return photos
+
+def read_headers(paths, workers=WORKERS):
+  """ read_header() of each path in a thread pool, in order. Unreadable files get empty values """
+  def safe_read(path):
+    try:
+      return read_header(path)
+    except (OSError, struct.error) as e:
+      print("Could not read EXIF header of " + path + ": " + str(e))
+      return None, 0, 0, ""
+  if not paths:
+    return []
+  with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+    return list(executor.map(safe_read, paths))
+
+def scan(folder, workers=WORKERS):
+  """ PhotoInventory of the photos in folder """
+  photos = list_photos(folder)
+  headers = read_headers([path for path, size, mtime in photos], workers)
+  inventory = PhotoInventory(folder)
+  for (path, size, mtime), header in zip(photos, headers):
+    inventory.append(path, size, mtime, *header)
+  print("Photo inventory of " + folder + ": " + inventory.summary())
+  return inventory
+
+# -----------------------------------------------------------------
+
+class PhotoIndex:
+  """ On-disk inventory of a capture's Photos folder with incremental rescans """
+
+  def __init__(self, capture_folder, readonly=False):
+    self.photo_folder = capture_folder + "/Photos"
+    if readonly:
+      # An existing index only, nothing is created or written in the capture folder
+      self.connection = sqlite3.connect("file:" + capture_folder + "/" + INDEX_FILE + "?mode=ro", uri=True)
+      return
+    self.connection = sqlite3.connect(capture_folder + "/" + INDEX_FILE)
+    self.connection.executescript(
+      "CREATE TABLE IF NOT EXISTS photos ("
+      " path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,"
+      " timestamp REAL, width INTEGER, height INTEGER, model TEXT);"
+      "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+    )
+    # Index files written before the cached columns existed
+    existing = [row[1] for row in self.connection.execute("PRAGMA table_info(photos)")]
+    for column, type in CACHED_COLUMNS.items():
+      if column not in existing:
+        self.connection.execute("ALTER TABLE photos ADD COLUMN " + column + " " + type)
+
+  def get_meta(self, key):
+    row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+  def set_meta(self, key, value):
+    self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+  def get_column(self, column, paths):
+    """ {path: value} of a cached column for paths, None where it isn't computed yet """
+    if column not in CACHED_COLUMNS:
+      raise ValueError("'" + column + "' is not a cached photo index column")
+    wanted = set(paths)
+    return {path: value for path, value in self.connection.execute("SELECT path, " + column + " FROM photos") if path in wanted}
+
+  def set_column(self, column, values):
+    """ Store (path, value) pairs of a cached column """
+    if column not in CACHED_COLUMNS:
+      raise ValueError("'" + column + "' is not a cached photo index column")
+    with self.connection:
+      self.connection.executemany("UPDATE photos SET " + column + " = ? WHERE path = ?", [(value, path) for path, value in values])
+
+  def inventory(self):
+    inventory = PhotoInventory(self.photo_folder)
+    for path, size, mtime, timestamp, width, height, model in self.connection.execute(
+      "SELECT path, size, mtime, timestamp, width, height, model FROM photos ORDER BY path"
+    ):
+      inventory.append(path, size, mtime, timestamp, width, height, model)
+    return inventory
+
+  def rescan(self, force=False, workers=WORKERS):
+    """ Bring the index up to date with the Photos folder and return it as a PhotoInventory """
+    known = {path: (size, mtime) for path, size, mtime in self.connection.execute("SELECT path, size, mtime FROM photos")}
+    # Adding or removing files changes the folder's mtime, overwriting one in place doesn't.
+    # If the folder's mtime hasn't changed the listing is skipped, but the indexed files are still checked.
+    folder_mtime = os.stat(self.photo_folder).st_mtime_ns
+    if not force and self.get_meta("folder_mtime") == str(folder_mtime):
+      photos = stat_photos(sorted(known))
+    else:
+      photos = list_photos(self.photo_folder)
+    changed = [photo for photo in photos if known.get(photo[0]) != (photo[1], photo[2])]
+    removed = set(known) - set(photo[0] for photo in photos)
+    if not changed and not removed:
+      with self.connection:
+        self.set_meta("folder_mtime", folder_mtime)
+      inventory = self.inventory()
+      print("Photo index of " + self.photo_folder + " is current: " + inventory.summary())
+      return inventory
+
+    headers = read_headers([path for path, size, mtime in changed], workers)
+    with self.connection:
+      self.connection.executemany("DELETE FROM photos WHERE path = ?", [(path,) for path in removed])
+      self.connection.executemany(
+        "INSERT OR REPLACE INTO photos (path, size, mtime, timestamp, width, height, model) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [photo + tuple(header) for photo, header in zip(changed, headers)]
+      )
+      self.set_meta("folder_mtime", folder_mtime)
+    print(
+      "Photo index of " + self.photo_folder + ": " + str(len(changed)) + " new or changed, "
+      + str(len(removed)) + " removed, " + str(len(photos) - len(changed)) + " unchanged."
+    )
+    inventory = self.inventory()
+    print("Photo inventory: " + inventory.summary())
+    return inventory
+
+  def close(self):
+    self.connection.close()
+
+def pending(inventory, chunk):
+  """ Paths in the inventory that are not yet cameras in chunk """
+  loaded = set()
+  for camera in chunk.cameras:
+    if camera.photo:
+      loaded.add(os.path.normpath(camera.photo.path))
+  return [path for path in inventory.paths if os.path.normpath(path) not in loaded]
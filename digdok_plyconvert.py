@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#
+# OBJ to binary PLY in constant memory, for nxsbuild.
+#
+# The Nexus files used to be made by loading the exported text OBJ into
+# pymeshlab and saving it again as binary PLY, which holds the whole model in
+# memory several times over. obj_to_ply() streams the OBJ instead, a batch of
+# lines at a time:
+#  - vertices (with their colours, if the OBJ has them) go to a scratch file
+#    as finished PLY records
+#  - texture coordinates go to a scratch file of float32 pairs
+#  - faces go to a scratch file as vertex and texture coordinate indices
+# The PLY header needs the counts, so it is written once the OBJ has been
+# read. The vertex records are copied after it, and the faces written in
+# batches with their wedge texture coordinates looked up in a memory map of the
+# texture coordinate file. Runs of lines of one kind are parsed with numpy.
+#
+# The output is what MeshLab writes with save_wedge_texcoord: texture file
+# comments, x/y/z (and red/green/blue) per vertex, vertex_indices and texcoord
+# lists (and texnumber, with several textures) per face. Normals are left out.
+# Faces with more than three corners are split into triangles.
+
+import os
+import shutil
+import tempfile
+from itertools import groupby
+
+import numpy
+
+
+BATCH_BYTES = 4 * 2 ** 20 # OBJ text read at a time
+FACE_BATCH = 2 ** 18 # Faces written at a time
+
+FACE_INDICES = numpy.dtype([("v", "<i4", 3), ("t", "<i4", 3), ("m", "<i4")])
+
+
+KINDS = {b"v ": "v", b"vt": "vt", b"f ": "f"} # First two bytes of a line -> kind, others are "other"
+
+def kind(line):
+  return KINDS.get(line[:2], "other")
+
+def materials(mtl_path):
+  """ {material name: texture file} from a .mtl file """
+  textures = {}
+  name = None
+  try:
+    with open(mtl_path) as f:
+      for line in f:
+        words = line.split(None, 1)
+        if not words:
+          continue
+        if words[0] == "newmtl":
+          name = words[1].strip()
+        elif words[0] == "map_Kd" and name is not None:
+          textures[name] = words[1].strip()
+  except OSError:
+    print("Could not read materials from " + mtl_path)
+  return textures
+
+def parse(text):
+  """ Whitespace separated numbers in text as a float64 array, parsed in C """
+  # Stops at the first thing that isn't a number, callers check the count
+  return numpy.fromstring(text, dtype=numpy.float64, sep=" ")
+
+def numbers(lines, dtype, columns, keyword):
+  """ The first columns values after keyword on each line, as an (n, columns) array """
+  skip = len(keyword) + 1
+  values = parse(b" ".join([line[skip:] for line in lines]))
+  if values.size == len(lines) * columns:
+    return values.reshape(len(lines), columns).astype(dtype)
+  # Some lines have extra values (a w coordinate), take them line by line
+  return numpy.array([line.split()[1:1 + columns] for line in lines], dtype=dtype)
+
+def corners(line):
+  """ (vertex, texture coordinate) indices of the corners of a face line, 1-based, 0 if missing """
+  result = []
+  for corner in line.split()[1:]:
+    parts = corner.split(b"/")
+    result.append((int(parts[0]), int(parts[1]) if len(parts) > 1 and parts[1] else 0))
+  return result
+
+def faces(lines):
+  """ (n, 3) vertex and texture coordinate indices, 0-based (-1 if missing) of face lines """
+  try:
+    # Fast path: all triangles with the same corner layout
+    text = b" ".join([line[2:] for line in lines]).replace(b"//", b"/0/")
+    layout = lines[0].split()[1].replace(b"//", b"/0/").count(b"/") + 1
+    values = parse(text.replace(b"/", b" ")).astype(numpy.int64).reshape(len(lines), 3, layout)
+    vertices = values[:, :, 0]
+    texcoords = values[:, :, 1] if layout > 1 else numpy.zeros_like(vertices)
+  except ValueError:
+    # Polygons or mixed layouts, split into triangle fans
+    triangles = []
+    for line in lines:
+      face = corners(line)
+      for i in range(1, len(face) - 1):
+        triangles.append((face[0], face[i], face[i + 1]))
+    values = numpy.array(triangles, dtype=numpy.int64).reshape(len(triangles), 3, 2)
+    vertices = values[:, :, 0]
+    texcoords = values[:, :, 1]
+  if (vertices < 0).any() or (texcoords < 0).any():
+    raise ValueError("relative (negative) OBJ indices are not supported")
+  return vertices - 1, texcoords - 1
+
+# -----------------------------------------------------------------
+
+def obj_to_ply(source, target=None):
+  """ Binary PLY of the OBJ source, next to it if target isn't given. Returns the PLY path """
+  target = target or os.path.splitext(source)[0] + ".ply"
+  folder = os.path.dirname(os.path.abspath(source))
+  scratch = tempfile.mkdtemp(prefix="plyconvert-", dir=os.path.dirname(os.path.abspath(target)))
+  try:
+    vertex_path = os.path.join(scratch, "vertices")
+    texcoord_path = os.path.join(scratch, "texcoords")
+    face_path = os.path.join(scratch, "faces")
+    vertex_dtype = None
+    vertex_count = texcoord_count = face_count = 0
+    textures = {} # material name -> texture file
+    used = [] # materials in the order of their texnumber
+    material = 0
+
+    with open(source, "rb") as obj, open(vertex_path, "wb") as vertex_file, \
+        open(texcoord_path, "wb") as texcoord_file, open(face_path, "wb") as face_file:
+      while True:
+        lines = obj.readlines(BATCH_BYTES)
+        if not lines:
+          break
+        for line_kind, run in groupby(lines, kind):
+          run = list(run)
+          if line_kind == "v":
+            if vertex_dtype is None:
+              colors = len(run[0].split()) >= 7
+              vertex_dtype = numpy.dtype(
+                [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+                + ([("red", "u1"), ("green", "u1"), ("blue", "u1")] if colors else [])
+              )
+            columns = 6 if len(vertex_dtype) == 6 else 3
+            values = numbers(run, numpy.float64, columns, b"v")
+            records = numpy.empty(len(run), dtype=vertex_dtype)
+            records["x"], records["y"], records["z"] = values[:, 0], values[:, 1], values[:, 2]
+            if columns == 6:
+              # OBJ colours are 0..1
+              rgb = numpy.clip(numpy.rint(values[:, 3:] * 255), 0, 255).astype("u1")
+              records["red"], records["green"], records["blue"] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+            records.tofile(vertex_file)
+            vertex_count += len(run)
+          elif line_kind == "vt":
+            # Only u and v, an optional w is dropped
+            numbers(run, "<f4", 2, b"vt").tofile(texcoord_file)
+            texcoord_count += len(run)
+          elif line_kind == "f":
+            vertices, texcoords = faces(run)
+            records = numpy.empty(len(vertices), dtype=FACE_INDICES)
+            records["v"], records["t"], records["m"] = vertices, texcoords, material
+            records.tofile(face_file)
+            face_count += len(records)
+          else:
+            for line in run:
+              words = line.decode("utf-8", "replace").split(None, 1)
+              if not words or len(words) < 2:
+                continue
+              if words[0] == "mtllib":
+                textures.update(materials(os.path.join(folder, words[1].strip())))
+              elif words[0] == "usemtl":
+                name = words[1].strip()
+                if name not in used:
+                  used.append(name)
+                material = used.index(name)
+
+    # Materials sharing a texture file share its texnumber, -1 for materials without one
+    texture_files = []
+    for name in used:
+      if name in textures and textures[name] not in texture_files:
+        texture_files.append(textures[name])
+    texnumbers = numpy.array([texture_files.index(textures[name]) if name in textures else -1 for name in used] or [-1], dtype="<i4")
+    with open(target, "wb") as ply:
+      header = ["ply", "format binary_little_endian 1.0"]
+      for texture in texture_files:
+        header.append("comment TextureFile " + texture)
+      header.append("element vertex " + str(vertex_count))
+      for name in (vertex_dtype.names if vertex_dtype else ("x", "y", "z")):
+        header.append("property " + ("uchar " if name in ("red", "green", "blue") else "float ") + name)
+      header.append("element face " + str(face_count))
+      header.append("property list uchar int vertex_indices")
+      if texcoord_count:
+        header.append("property list uchar float texcoord")
+      if len(texture_files) > 1:
+        header.append("property int texnumber")
+      header.append("end_header")
+      ply.write(("\n".join(header) + "\n").encode("ascii"))
+
+      with open(vertex_path, "rb") as vertex_file:
+        shutil.copyfileobj(vertex_file, ply, 2 ** 20)
+      write_faces(ply, face_path, face_count, texcoord_path, texcoord_count, texnumbers if len(texture_files) > 1 else None)
+  finally:
+    shutil.rmtree(scratch, ignore_errors=True)
+  print("Converted " + source + " to " + target + ": " + str(vertex_count) + " vertices, " + str(face_count) + " faces.")
+  return target
+
+def write_faces(ply, face_path, face_count, texcoord_path, texcoord_count, texnumbers=None):
+  """ Face records from the scratch files, texnumbers maps material numbers to texture numbers """
+  fields = [("n", "u1"), ("v", "<i4", 3)]
+  if texcoord_count:
+    fields += [("nt", "u1"), ("t", "<f4", 6)]
+    texcoords = numpy.memmap(texcoord_path, dtype="<f4", mode="r", shape=(texcoord_count, 2))
+  if texnumbers is not None:
+    fields.append(("texnumber", "<i4"))
+  dtype = numpy.dtype(fields)
+  with open(face_path, "rb") as face_file:
+    for start in range(0, face_count, FACE_BATCH):
+      indices = numpy.fromfile(face_file, dtype=FACE_INDICES, count=min(FACE_BATCH, face_count - start))
+      records = numpy.empty(len(indices), dtype=dtype)
+      records["n"] = 3
+      records["v"] = indices["v"]
+      if texcoord_count:
+        records["nt"] = 6
+        # Corners without a texture coordinate get (0, 0)
+        corners = indices["t"]
+        uv = texcoords[numpy.clip(corners, 0, texcoord_count - 1)]
+        uv[corners < 0] = 0
+        records["t"] = uv.reshape(len(indices), 6)
+      if texnumbers is not None:
+        records["texnumber"] = texnumbers[indices["m"]]
+      records.tofile(ply)
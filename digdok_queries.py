@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#
+# Named, parameterized SQL statements for digdok_metashape.
+#
+# Every statement is prepared on the server the first time a pooled connection
+# runs it (PREPARE name AS ...) and executed by name after that, so PostgreSQL
+# parses and plans it once per connection instead of once per call. Values are
+# always passed as parameters. Column names can't be parameters, so the ones
+# that vary (the status step, processing metrics) are checked against a
+# whitelist and get a prepared statement per column.
+
+import hashlib
+
+import digdok_db
+
+
+# Status columns in new.process_status
+STATUS_COLUMNS = frozenset([
+  "status",
+  "estimating_iq",
+  "aligning",
+  "populating_targets",
+  "uncheckingmarkers",
+  "adding_scalebars",
+  "aligning_bbox",
+  "optimizing_alignment",
+  "reducing_error",
+  "building_depthmaps",
+  "building_densecloud",
+  "meshing",
+  "texturing",
+  "building_dem",
+  "building_ortho",
+  "exporting",
+])
+
+# Metric columns in new.processing
+PROCESSING_COLUMNS = frozenset([
+  "duplicates_dropped",
+  "images_aligned",
+  "targets_used",
+  "estimated_error",
+  "error_reduction",
+  "checkpoints",
+  "stage_seconds",
+  "scalebars_used",
+  "depth_maps_created",
+  "dense_point_cloud_created",
+  "mesh_created",
+  "texture_created",
+  "dem_created",
+  "orthophoto_created",
+  "exports",
+])
+
+COLUMNS = {
+  "process_status": STATUS_COLUMNS,
+  "processing": PROCESSING_COLUMNS,
+}
+
+STATEMENTS = {
+  "first_queued_capture": (
+    "SELECT * FROM new.view_process_location LIMIT 1"
+  ),
+  "process_status_row": (
+    "SELECT * FROM new.process_status WHERE uuid = $1::uuid"
+  ),
+  "settings_stamp": (
+    "SELECT settings.uuid, settings.modified "
+    "FROM new.process_settings settings "
+    "JOIN new.process_status proc ON proc.settings_uuid = settings.uuid "
+    "WHERE proc.uuid = $1"
+  ),
+  "settings_row": (
+    "SELECT settings.* "
+    "FROM new.process_settings settings "
+    "WHERE settings.uuid = $1"
+  ),
+  "software_uuid": (
+    "SELECT uuid "
+    "FROM new.software "
+    "WHERE software_name = 'Metashape' AND software_version = $1"
+  ),
+  "insert_software": (
+    "INSERT INTO new.software (company, software_name, software_version, software_type) "
+    "VALUES ('Agisoft'::varchar, 'Metashape'::varchar, $1::varchar, 'Photogrammetry'::varchar) "
+    "RETURNING uuid"
+  ),
+  "processing_for_status": (
+    "SELECT proc.uuid "
+    "FROM new.processing proc "
+    "JOIN new.capture_processing_link cp ON cp.processing_uuid = proc.uuid "
+    "JOIN new.capture cap ON cap.uuid = cp.capture_uuid "
+    "JOIN new.process_status ps ON ps.capture_uuid = cap.uuid "
+    "WHERE ps.uuid = $1::uuid"
+  ),
+  "insert_processing": (
+    "INSERT INTO new.processing (software, processed_on) "
+    "VALUES (ARRAY [$1::uuid], CURRENT_DATE) "
+    "RETURNING uuid"
+  ),
+  "link_processing": (
+    "INSERT INTO new.capture_processing_link (capture_uuid, processing_uuid) "
+    "SELECT cap.uuid, $1::uuid "
+    "FROM new.capture cap "
+    "JOIN new.process_status ps ON ps.capture_uuid = cap.uuid "
+    "WHERE ps.uuid = $2::uuid"
+  ),
+  "add_processing_software": (
+    "UPDATE new.processing "
+    "SET software = (SELECT ARRAY_AGG(DISTINCT e) FROM UNNEST(software || $1::uuid) e) "
+    "WHERE new.processing.uuid = $2::uuid"
+  ),
+  "gcp_targets": (
+    "SELECT target_id, coord_x, coord_y, coord_z "
+    "FROM new.view_gcp_targets "
+    "WHERE status_uuid = $1"
+  ),
+  "insert_stage_timing": (
+    "INSERT INTO new.stage_timing (processing_uuid, stage, outcome, started_at, wall_seconds, "
+    "cpu_seconds, peak_rss_bytes, bytes_written, counts, parameters, worker_id) "
+    "VALUES ($1::uuid, $2, $3, $4::timestamptz, $5, $6, $7, $8, $9::jsonb, $10::jsonb, $11)"
+  ),
+  "insert_offload_batch": (
+    "INSERT INTO new.offload_batch (processing_uuid, stage, backend, server, batch_id, tasks, worker_id) "
+    "VALUES ($1::uuid, $2, $3, $4, $5, $6::jsonb, $7)"
+  ),
+  "finish_offload_batch": (
+    "UPDATE new.offload_batch "
+    "SET status = $1, seconds = $2, finished_at = now() "
+    "WHERE processing_uuid = $3::uuid AND stage = $4 AND batch_id = $5 AND finished_at IS NULL"
+  ),
+  "append_mesh_post": (
+    "UPDATE new.processing "
+    "SET mesh_post = COALESCE(mesh_post, '[]'::jsonb) || $1::jsonb "
+    "WHERE uuid = $2::uuid"
+  ),
+  "stage_history": (
+    "SELECT stage, wall_seconds, peak_rss_bytes, parameters "
+    "FROM new.stage_timing "
+    "WHERE outcome = 'done' "
+    "ORDER BY started_at DESC "
+    "LIMIT $1"
+  ),
+  "unestimated_captures": (
+    "SELECT v.* "
+    "FROM new.view_process_location v "
+    "JOIN new.process_status ps ON ps.uuid = v.uuid "
+    "WHERE ps.estimated_at IS NULL OR (ps.estimated_seconds IS NULL AND ps.estimated_at < ps.queued_at) "
+    "ORDER BY ps.queued_at "
+    "LIMIT $1"
+  ),
+  "set_estimate": (
+    "UPDATE new.process_status "
+    "SET estimated_seconds = $1, estimated_memory = $2, estimated_at = now() "
+    "WHERE uuid = $3::uuid"
+  ),
+  "estimate_failed": (
+    "UPDATE new.process_status "
+    "SET estimated_at = now() "
+    "WHERE uuid = $1::uuid"
+  ),
+  "scalebars": (
+    "SELECT target_first, target_second, distance, precision "
+    "FROM new.view_scalebars "
+    "WHERE status_uuid = $1"
+  ),
+}
+
+# -----------------------------------------------------------------
+
+def check_columns(table, columns):
+  allowed = COLUMNS[table]
+  for column in columns:
+    if column not in allowed:
+      raise ValueError("'" + str(column) + "' is not a known " + table + " column")
+
+def update_statement(table, columns):
+  """ Name of a prepared UPDATE of the given columns of new.<table>, by uuid """
+  columns = sorted(columns)
+  check_columns(table, columns)
+  if len(columns) == 1:
+    name = "update_" + table + "_" + columns[0]
+  else:
+    # Keep combined names inside PostgreSQL's 63 character limit
+    name = "update_" + table + "_" + hashlib.md5(",".join(columns).encode()).hexdigest()[:12]
+  if name not in STATEMENTS:
+    assignments = ", ".join(column + " = $" + str(i + 1) for i, column in enumerate(columns))
+    STATEMENTS[name] = "UPDATE new." + table + " SET " + assignments + " WHERE uuid = $" + str(len(columns) + 1) + "::uuid"
+  return name, columns
+
+def select_statement(table, column):
+  check_columns(table, [column])
+  name = "select_" + table + "_" + column
+  if name not in STATEMENTS:
+    STATEMENTS[name] = "SELECT " + column + " FROM new." + table + " WHERE uuid = $1::uuid"
+  return name
+
+# -----------------------------------------------------------------
+
+def prepare(connection, name):
+  prepared = connection.prepared
+  if name in prepared:
+    return
+  cursor = connection.cursor()
+  try:
+    cursor.execute("PREPARE " + name + " AS " + STATEMENTS[name])
+    connection.commit()
+  except digdok_db.psycopg2.Error as error:
+    connection.rollback()
+    # 42P05: already prepared on this session, e.g. after a lost commit
+    if error.pgcode != "42P05":
+      raise
+  finally:
+    cursor.close()
+  prepared.add(name)
+
+def execute(name, type, args=()):
+  """ Run the named statement with args, preparing it on the connection first if needed """
+  query = "EXECUTE " + name
+  if args:
+    query += " (" + ", ".join(["%s"] * len(args)) + ")"
+  else:
+    args = None
+  try:
+    return digdok_db.execute(query, type, args, prepare=lambda connection: prepare(connection, name))
+  except digdok_db.psycopg2.Error as error:
+    # 26000: the session lost its prepared statements (DISCARD ALL, a pooler), prepare again
+    if error.pgcode != "26000":
+      raise
+    digdok_db.get_pool().forget_prepared()
+    return digdok_db.execute(query, type, args, prepare=lambda connection: prepare(connection, name))
+
+def update_status(uuid, step, status):
+  name, columns = update_statement("process_status", [step])
+  return execute(name, "update", (status, uuid))
+
+def update_processing(uuid, step, value):
+  name, columns = update_statement("processing", [step])
+  return execute(name, "update", (value, uuid))
+
+def update_columns(table, uuid, values):
+  """ Write several columns of one row in a single prepared UPDATE """
+  name, columns = update_statement(table, values)
+  return execute(name, "update", [values[column] for column in columns] + [uuid])
+
+def get_status(uuid, step):
+  return execute(select_statement("process_status", step), "select_one", (uuid,))
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# Atomic job claiming for several workers draining new.view_process_location.
+#
+# A capture is picked and leased in one statement (SELECT ... FOR UPDATE SKIP
+# LOCKED inside an UPDATE), so two render nodes can never start the same job.
+# While a job runs, a heartbeat thread keeps extending the lease. If a worker
+# dies, its lease runs out and the job is put back in the queue for someone
+# else, up to MAX_ATTEMPTS times. Idle workers block in Listener until
+# PostgreSQL notifies them of a newly queued capture.
+#
+# Needs the columns from sql/001_job_leases.sql and the trigger from
+# sql/002_capture_notify.sql. Claims stay within the node budget set in
+# digdok_scheduler.py.
+
+import os
+import time
+import select
+import socket
+import threading
+
+import psycopg2.extensions
+
+import digdok_db
+import digdok_scheduler as scheduler
+
+
+LEASE_SECONDS = 600 # How long a claim is valid without a heartbeat
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+MAX_ATTEMPTS = 3 # Claims of the same job before an expired lease marks it failed
+
+# Order in which claim_job() picks queued captures
+ORDERS = {
+  "queue": "", # view order
+  "sjf": "ORDER BY ps.estimated_seconds ASC NULLS LAST ", # shortest estimated job first, see digdok_estimator.py
+  "priority": scheduler.PRIORITY_ORDER, # highest aged priority first
+}
+CHANNEL = "digdok_capture_queued" # Notified by sql/002_capture_notify.sql
+
+worker_id = socket.gethostname() + ":" + str(os.getpid())
+
+# -----------------------------------------------------------------
+
+def reclaim_expired():
+  # Put jobs from crashed workers back in the queue, or fail them if they keep crashing workers
+  query = (
+    "UPDATE new.process_status "
+    "SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE queued_status END, "
+    "lease_expires = NULL "
+    "WHERE status = 'processing' AND lease_expires < now() "
+    "RETURNING uuid, status;"
+  )
+  reclaimed = digdok_db.execute(query, "update", (MAX_ATTEMPTS,)) or []
+  for job_uuid, status in reclaimed:
+    if status == "failed":
+      print("Lease expired on " + str(job_uuid) + " after " + str(MAX_ATTEMPTS) + " attempts. Marked failed.")
+    else:
+      print("Lease expired on " + str(job_uuid) + ". Returned to queue.")
+  return len(reclaimed)
+
+def claim_job(lease_seconds=LEASE_SECONDS, order="queue"):
+  """ Pick and lease the next queued capture, returns its view_process_location row or None """
+  reclaim_expired()
+  # The candidate row is locked with SKIP LOCKED, so concurrent claims pick different rows.
+  # Claims from this node wait for each other, they all count against its budget
+  lock, lock_args = scheduler.node_lock()
+  budget, budget_args = scheduler.budget()
+  query = lock + (
+    "WITH candidate AS ("
+    " SELECT v.* "
+    " FROM new.view_process_location v "
+    " JOIN new.process_status ps ON ps.uuid = v.uuid "
+    " WHERE (ps.lease_expires IS NULL OR ps.lease_expires < now()) "
+    + budget +
+    " " + ORDERS[order] +
+    " LIMIT 1 "
+    " FOR UPDATE OF ps SKIP LOCKED"
+    ") "
+    "UPDATE new.process_status ps "
+    "SET queued_status = ps.status, status = 'processing', worker_id = %s, "
+    "claimed_at = now(), lease_expires = now() + %s * interval '1 second', attempts = ps.attempts + 1 "
+    "FROM candidate "
+    "WHERE ps.uuid = candidate.uuid "
+    "RETURNING candidate.*;"
+  )
+  claimed = digdok_db.execute(query, "update", lock_args + budget_args + (worker_id, lease_seconds))
+  if not claimed:
+    return None
+  capture = claimed[0]
+  print("Claimed " + str(capture[0]) + " as " + worker_id + ".")
+  return capture
+
+def renew_lease(uuid, lease_seconds=LEASE_SECONDS):
+  query = (
+    "UPDATE new.process_status "
+    "SET lease_expires = now() + %s * interval '1 second' "
+    "WHERE uuid = %s AND worker_id = %s AND status = 'processing' "
+    "RETURNING uuid;"
+  )
+  return bool(digdok_db.execute(query, "update", (lease_seconds, uuid, worker_id)))
+
+def finish_job(uuid, status):
+  """ Set the final status of a claimed job and release its lease """
+  query = (
+    "UPDATE new.process_status "
+    "SET status = %s, lease_expires = NULL, queued_status = NULL "
+    "WHERE uuid = %s AND worker_id = %s "
+    "RETURNING uuid;"
+  )
+  if digdok_db.execute(query, "update", (status, uuid, worker_id)):
+    print("Updated status status to '" + status + "'. \n")
+  else:
+    print("Job " + str(uuid) + " is no longer leased by " + worker_id + ", status not updated.")
+
+def fail_worker_jobs(worker):
+  """ Mark the jobs a dead worker was processing failed, returns their uuids """
+  query = (
+    "UPDATE new.process_status "
+    "SET status = 'failed', lease_expires = NULL, queued_status = NULL "
+    "WHERE worker_id = %s AND status = 'processing' "
+    "RETURNING uuid;"
+  )
+  failed = [row[0] for row in digdok_db.execute(query, "update", (worker,)) or []]
+  for job_uuid in failed:
+    print("Worker " + worker + " died processing " + str(job_uuid) + ". Marked failed.")
+  return failed
+
+# -----------------------------------------------------------------
+
+class Lease:
+  """ Keeps a claimed job's lease alive from a background thread """
+
+  def __init__(self, uuid, lease_seconds=LEASE_SECONDS, interval=HEARTBEAT_SECONDS):
+    self.uuid = uuid
+    self.lease_seconds = lease_seconds
+    self.interval = interval
+    self.lost = False
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.beat, name="lease-" + str(uuid), daemon=True)
+
+  def beat(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        if not renew_lease(self.uuid, self.lease_seconds):
+          self.lost = True
+          print("!!!!! Lease on " + str(self.uuid) + " was lost to another worker !!!!!")
+          return
+      except Exception as e:
+        # Keep trying, the lease is long enough to survive a few missed beats
+        print("Lease heartbeat failed: " + str(e))
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stopped.set()
+    self.thread.join()
+    return False
+
+# -----------------------------------------------------------------
+
+class Listener:
+  """ Blocks on LISTEN until a capture is queued, the timeout runs out or wakeup_fd becomes readable """
+
+  def __init__(self, wakeup_fd=None, channel=CHANNEL):
+    self.wakeup_fd = wakeup_fd
+    self.channel = channel
+    self.connection = None
+
+  def listen(self):
+    # A dedicated connection outside the pool, it sits in LISTEN for the life of the worker
+    self.connection = digdok_db.connect()
+    self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = self.connection.cursor()
+    cursor.execute("LISTEN " + self.channel + ";")
+    cursor.close()
+    print("Listening for queued captures on '" + self.channel + "'.")
+
+  def wait(self, timeout):
+    """ Returns the uuids that were notified, an empty list on timeout or wakeup """
+    try:
+      if self.connection is None or self.connection.closed:
+        self.listen()
+      waiting = [self.connection]
+      if self.wakeup_fd is not None:
+        waiting.append(self.wakeup_fd)
+      readable = select.select(waiting, [], [], timeout)[0]
+      if self.connection not in readable:
+        return []
+      self.connection.poll()
+      notified = [notify.payload for notify in self.connection.notifies]
+      self.connection.notifies.clear()
+      return notified
+    except digdok_db.CONNECTION_ERRORS as error:
+      # Lost the listening connection, fall back to polling until it can be reopened
+      print("Listener connection failed (" + str(error).strip() + "), reconnecting on next wait.")
+      self.close()
+      time.sleep(min(timeout, 5))
+      return []
+
+  def close(self):
+    if self.connection is not None:
+      digdok_db.ConnectionPool.close_quietly(self.connection)
+      self.connection = None
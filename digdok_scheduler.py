@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+# Priority and resource limits for workers sharing render nodes.
+#
+# Captures carry a priority (process_status.priority, sql/010_priority.sql).
+# With --order priority, claim_job() takes the highest priority first, and a
+# capture gains AGING points for every hour it has been queued, so low
+# priority captures are not starved by a steady stream of urgent ones.
+#
+# Whatever the order, a worker only claims a capture that fits its node's
+# budget: the estimated peak memory (digdok_estimator.py) of the jobs running
+# on the node plus the candidate's must stay under the node's memory, and the
+# node runs at most cores / job_cores jobs. Claims on one node are serialised
+# with an advisory lock so two workers can't both take the last room. A node
+# with nothing running always claims, so a capture larger than any node still
+# gets processed.
+#
+# Inside a job, stages of a class share a fixed number of slots per node, e.g.
+# one depth map job at a time but several exports. Slots are lock files in
+# SLOT_FOLDER, held with flock() until the stage ends, so they are released
+# even if the worker crashes.
+#
+# Budgets and slots can be set in optional [scheduler] and [stage_slots]
+# sections of database.ini.
+
+import os
+import time
+import socket
+import tempfile
+
+from dbconfig import config
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+try:
+  scheduler_params = config(section='scheduler')
+except Exception:
+  scheduler_params = {}
+try:
+  slot_params = config(section='stage_slots')
+except Exception:
+  slot_params = {}
+
+
+def physical_memory():
+  try:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+  except (ValueError, OSError, AttributeError):
+    return None
+
+GiB = 2 ** 30
+
+AGING = float(scheduler_params.get('aging', 1)) # Priority points gained per hour queued
+NODE_MEMORY = int(float(scheduler_params.get('node_memory', (physical_memory() or 64 * GiB) / GiB)) * GiB) # Bytes for all jobs on this node
+NODE_CORES = int(scheduler_params.get('node_cores', os.cpu_count() or 1))
+JOB_CORES = int(scheduler_params.get('job_cores', 8)) # Cores one job is given
+NODE_JOBS = max(1, NODE_CORES // JOB_CORES) # Jobs running at once on this node
+DEFAULT_MEMORY = int(float(scheduler_params.get('default_memory', 8)) * GiB) # Assumed for captures without an estimate
+SLOT_FOLDER = scheduler_params.get('slot_folder', os.path.join(tempfile.gettempdir(), "digdok-slots"))
+SLOT_POLL = 5 # Seconds between tries while all slots of a class are taken
+
+node = socket.gethostname()
+
+# Highest priority first, aged by time in the queue, shortest estimate breaks ties
+PRIORITY_ORDER = (
+  "ORDER BY ps.priority + EXTRACT(EPOCH FROM now() - COALESCE(ps.queued_at, now())) / 3600 * " + repr(AGING) + " DESC, "
+  "ps.estimated_seconds ASC NULLS LAST "
+)
+
+# Stage class of each process_status column, stages not listed are not limited
+STAGE_CLASSES = {
+  "aligning": "align",
+  "building_depthmaps": "depthmaps",
+  "building_densecloud": "depthmaps",
+  "meshing": "depthmaps",
+  "texturing": "texture",
+  "building_dem": "raster",
+  "building_ortho": "raster",
+  "exporting": "export",
+}
+
+# Stages of a class running at once on a node
+SLOTS = {
+  "align": 2,
+  "depthmaps": 1,
+  "texture": 2,
+  "raster": 2,
+  "export": 4,
+}
+SLOTS.update({name: int(value) for name, value in slot_params.items()})
+
+# -----------------------------------------------------------------
+
+def node_lock():
+  """ Statement taking the per node claim lock, held until the claim commits """
+  return "SELECT pg_advisory_xact_lock(hashtext(%s)); ", (node,)
+
+def budget():
+  """ WHERE condition on ps (the candidate's process_status row) keeping claims within this node's budget """
+  condition = (
+    " AND ("
+    "  SELECT count(*) = 0 OR (count(*) < %s AND sum(COALESCE(running.estimated_memory, %s)) + COALESCE(ps.estimated_memory, %s) <= %s)"
+    "  FROM new.process_status running "
+    "  WHERE running.status = 'processing' AND running.lease_expires > now() AND split_part(running.worker_id, ':', 1) = %s"
+    " ) "
+  )
+  return condition, (NODE_JOBS, DEFAULT_MEMORY, DEFAULT_MEMORY, NODE_MEMORY, node)
+
+# -----------------------------------------------------------------
+
+class Slots:
+  """ Per node slots for stage classes, acquire(stage) blocks until one of its class is free """
+
+  def __init__(self, folder=SLOT_FOLDER, slots=SLOTS, classes=STAGE_CLASSES):
+    self.folder = folder
+    self.slots = slots
+    self.classes = classes
+    self.held = {} # stage -> open lock file
+
+  def try_slot(self, name):
+    for number in range(self.slots[name]):
+      f = open(os.path.join(self.folder, name + "." + str(number) + ".lock"), "a")
+      try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        f.close()
+        continue
+      return f
+    return None
+
+  def acquire(self, stage):
+    name = self.classes.get(stage)
+    if name is None or name not in self.slots or fcntl is None:
+      return
+    os.makedirs(self.folder, exist_ok=True)
+    waited = False
+    while True:
+      f = self.try_slot(name)
+      if f:
+        break
+      if not waited:
+        print("All " + str(self.slots[name]) + " " + name + " slots on " + node + " are taken, waiting.")
+        waited = True
+      time.sleep(SLOT_POLL)
+    self.held[stage] = f
+
+  def release(self, stage):
+    f = self.held.pop(stage, None)
+    if f:
+      fcntl.flock(f, fcntl.LOCK_UN)
+      f.close()
+
+slots = Slots()
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+#
+# Processing settings for a job, from new.process_settings or the standalone defaults.
+#
+# A setting group is shared by many captures, so parsed settings are kept in an
+# LRU cache keyed by the settings uuid. Each job only asks the database for the
+# settings uuid and the row's modified timestamp (sql/003_settings_modified.sql),
+# and the full row is fetched and validated again only when that has changed.
+
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, fields, asdict
+
+import digdok_queries
+
+
+CACHE_SIZE = 32 # Setting groups kept in memory
+
+# Depth map quality names and their downscale factor
+DEPTHMAP_QUALITY = {
+  "Ultra": 1,
+  "High": 2,
+  "Medium": 4,
+  "Low": 8,
+  "Lowest": 16
+}
+
+# Text values of boolean settings, as given in standalone or JSON-as-text settings
+BOOLEAN_STRINGS = {
+  "true": True, "t": True, "yes": True, "y": True, "on": True, "1": True,
+  "false": False, "f": False, "no": False, "n": False, "off": False, "0": False, "": False
+}
+
+# Column position of each field in SELECT settings.*, used when the table has
+# no column of the same name as the field.
+LEGACY_INDEX = {
+  "setting_group": 1,
+  ## Workflow
+  "est_iq_bool": 2,
+  "align_bool": 3,
+  "poptargets_bool": 4,
+  "uncheckmarkers_bool": 5,
+  "scalebar_bool": 52,
+  "alignbbox_bool": 6,
+  "optimizealignment_bool": 7,
+  "err_red_bool": 8,
+  "depthmap_bool": 9,
+  "densecloud_bool": 10,
+  "mesh_bool": 11,
+  "texture_bool": 12,
+  "dem_bool": 13,
+  "ortho_bool": 14,
+  ## Image quality
+  "iq_threshold": 15,
+  ## Error correction Percentages
+  "RU_Percent": 16,
+  "PA_Percent": 17,
+  "RE_Percent": 18,
+  ## Error correction Thresholds
+  "RU_Threshold": 19,
+  "PA_Threshold": 20,
+  "RE_Threshold": 21,
+  ## Depthmaps settings
+  "depthmap_quality": 22,
+  "depthmap_filter": 23,
+  ## CRS
+  "crs": 24,
+  ## Image alignment settings
+  "keypoint_limit": 25,
+  "tiepoint_limit": 26,
+  "generic_preselection_bool": 27,
+  "reference_preselection_bool": 28,
+  ## UV and Texture settings
+  "uv_pages": 29,
+  "texture_size": 30,
+  "ghosting_filter_bool": 31,
+  "blending_mode": 32,
+  "texture_type": 33,
+  "fill_holes_bool": 34,
+  ## Model/mesh settings
+  "surface_type": 35,
+  "interpolation": 36,
+  "face_count_custom": 37,
+  "source_data": 38,
+  "vertex_colors_bool": 39,
+  "vertex_confidence_bool": 40,
+  ## DEM settings
+  "dem_datasource": 41,
+  "dem_interpolation": 42,
+  "dem_resolution": 43,
+  "dem_params": 55,
+  ## Orthos settings
+  "ortho_surfacedata": 44,
+  "ortho_blending_mode": 45,
+  "ortho_fill_holes_bool": 46,
+  "ortho_ghosting_filter_bool": 47,
+  "ortho_cull_faces_bool": 48,
+  "ortho_refine_seamlines_bool": 49,
+  "ortho_resolution": 50,
+  ## Export settings
+  "export_bool": 51,
+  "short_coords": 53,
+  "export_formats": 54,
+}
+
+# Standalone mode settings
+STANDALONE = {
+  "setting_group": "Default manual settings (HRI 27.12.22)",
+
+  ## Workflow
+  "est_iq_bool": True,
+  "align_bool": True,
+  "poptargets_bool": True,
+  "uncheckmarkers_bool": True,
+  "scalebar_bool": True,
+  "alignbbox_bool": True,
+  "optimizealignment_bool": True,
+  "err_red_bool": True,
+  "depthmap_bool": True,
+  "densecloud_bool": False,
+  "mesh_bool": True,
+  "texture_bool": True,
+  "dem_bool": True,
+  "ortho_bool": True,
+
+  ## Image quality
+  "iq_threshold": 0.6,
+
+  ## Error correction Percentages
+  "RU_Percent": 20,
+  "PA_Percent": 20,
+  "RE_Percent": 20,
+
+  ## Error correction Thresholds
+  "RU_Threshold": 10,
+  "PA_Threshold": 5,
+  "RE_Threshold": 0.9,
+
+  ## Depthmaps settings
+  "depthmap_quality": "High",
+  "depthmap_filter": "MildFiltering",
+
+  ## CRS
+  "crs": 32630,
+
+  ## Image alignment settings
+  "keypoint_limit": 40000,
+  "tiepoint_limit": 10000,
+  "generic_preselection_bool": True,
+  "reference_preselection_bool": True,
+
+  ## UV and Texture settings
+  "uv_pages": 2,
+  "texture_size": 4096,
+  "ghosting_filter_bool": True,
+  "blending_mode": "MosaicBlending",
+  "texture_type": "DiffuseMap",
+  "fill_holes_bool": True,
+
+  ## Model/mesh settings
+  "surface_type": "Arbitrary",
+  "interpolation": "EnabledInterpolation",
+  "face_count_custom": 0,
+  "source_data": "DepthMapsData",
+  "vertex_colors_bool": True,
+  "vertex_confidence_bool": True,
+
+  ## DEM settings
+  "dem_datasource": "DenseCloudData",
+  "dem_interpolation": "EnabledInterpolation",
+  "dem_resolution": 0,
+  "dem_params": None,
+
+  ## Orthos settings
+  "ortho_surfacedata": "ElevationData",
+  "ortho_blending_mode": "MosaicBlending",
+  "ortho_fill_holes_bool": True,
+  "ortho_ghosting_filter_bool": False,
+  "ortho_cull_faces_bool": False,
+  "ortho_refine_seamlines_bool": False,
+  "ortho_resolution": 0,
+
+  ## Export settings
+  "export_bool": True,
+  "export_formats": '[{"type": "mesh", "format": "obj", "settings": {"faces": 0, "texture": true}},{"type": "mesh", "format": "ply", "settings": {"faces": 500000, "texture": true}},{"type": "dem", "format": "tiff", "settings": {"resolution": 0}}]',
+  "short_coords": '[{"x": 0, "y": 0, "z": 0}]',
+}
+
+# -----------------------------------------------------------------
+
+@dataclass
+class ProcessingSettings:
+  __slots__ = tuple(LEGACY_INDEX)
+
+  setting_group: str
+  ## Workflow
+  est_iq_bool: bool
+  align_bool: bool
+  poptargets_bool: bool
+  uncheckmarkers_bool: bool
+  scalebar_bool: bool
+  alignbbox_bool: bool
+  optimizealignment_bool: bool
+  err_red_bool: bool
+  depthmap_bool: bool
+  densecloud_bool: bool
+  mesh_bool: bool
+  texture_bool: bool
+  dem_bool: bool
+  ortho_bool: bool
+  ## Image quality
+  iq_threshold: float
+  ## Error correction Percentages
+  RU_Percent: float
+  PA_Percent: float
+  RE_Percent: float
+  ## Error correction Thresholds
+  RU_Threshold: float
+  PA_Threshold: float
+  RE_Threshold: float
+  ## Depthmaps settings
+  depthmap_quality: str
+  depthmap_filter: str
+  ## CRS
+  crs: int
+  ## Image alignment settings
+  keypoint_limit: int
+  tiepoint_limit: int
+  generic_preselection_bool: bool
+  reference_preselection_bool: bool
+  ## UV and Texture settings
+  uv_pages: int
+  texture_size: int
+  ghosting_filter_bool: bool
+  blending_mode: str
+  texture_type: str
+  fill_holes_bool: bool
+  ## Model/mesh settings
+  surface_type: str
+  interpolation: str
+  face_count_custom: int
+  source_data: str
+  vertex_colors_bool: bool
+  vertex_confidence_bool: bool
+  ## DEM settings
+  dem_datasource: str
+  dem_interpolation: str
+  dem_resolution: float
+  dem_params: object
+  ## Orthos settings
+  ortho_surfacedata: str
+  ortho_blending_mode: str
+  ortho_fill_holes_bool: bool
+  ortho_ghosting_filter_bool: bool
+  ortho_cull_faces_bool: bool
+  ortho_refine_seamlines_bool: bool
+  ortho_resolution: float
+  ## Export settings
+  export_bool: bool
+  short_coords: object
+  export_formats: object
+
+  @classmethod
+  def from_row(cls, row):
+    """ Build from a process_settings row given as a dict of column name to value """
+    values = list(row.values())
+    kwargs = {}
+    for field in fields(cls):
+      if field.name in row:
+        kwargs[field.name] = row[field.name]
+      else:
+        kwargs[field.name] = values[LEGACY_INDEX[field.name]]
+    return cls(**kwargs).validate()
+
+  @classmethod
+  def standalone(cls):
+    return cls(**STANDALONE).validate()
+
+  def validate(self):
+    """ Coerce types and parse JSON fields, raises ValueError listing every bad setting """
+    errors = []
+    for field in fields(self):
+      value = getattr(self, field.name)
+      try:
+        if field.type is bool:
+          value = BOOLEAN_STRINGS[value.strip().lower()] if isinstance(value, str) else bool(value)
+        elif field.type in (int, float) and value is not None:
+          value = field.type(value)
+      except (TypeError, ValueError, KeyError):
+        errors.append(field.name + ": expected " + field.type.__name__ + ", got " + repr(value))
+        continue
+      setattr(self, field.name, value)
+
+    if self.depthmap_quality not in DEPTHMAP_QUALITY:
+      errors.append("depthmap_quality: " + repr(self.depthmap_quality) + " is not one of " + ", ".join(DEPTHMAP_QUALITY))
+    for name in ["RU_Percent", "PA_Percent", "RE_Percent"]:
+      value = getattr(self, name)
+      # NULL turns the criterion off in digdok_errorreduction, values that aren't numbers were reported above
+      if not isinstance(value, (int, float)):
+        continue
+      if not 0 <= value < 100:
+        errors.append(name + ": must be between 0 and 100")
+
+    # JSON settings may come as text (standalone, json columns read as text) or already parsed
+    for name in ["export_formats", "short_coords", "dem_params"]:
+      value = getattr(self, name)
+      if isinstance(value, str):
+        try:
+          setattr(self, name, json.loads(value))
+        except ValueError as e:
+          errors.append(name + ": invalid JSON (" + str(e) + ")")
+    # export() wants short_coords as one {"x", "y", "z"} dict
+    if isinstance(self.short_coords, list):
+      self.short_coords = self.short_coords[0] if self.short_coords else None
+    if self.short_coords and not all(axis in self.short_coords for axis in "xyz"):
+      errors.append("short_coords: needs x, y and z")
+
+    if errors:
+      raise ValueError("Invalid processing settings '" + str(self.setting_group) + "':\n  " + "\n  ".join(errors))
+    return self
+
+  def as_dict(self):
+    return asdict(self)
+
+# -----------------------------------------------------------------
+
+class SettingsCache:
+  """ LRU cache of ProcessingSettings keyed by settings uuid, invalidated by the row's modified timestamp """
+
+  def __init__(self, size=CACHE_SIZE):
+    self.size = size
+    self.entries = OrderedDict() # settings uuid -> (modified, ProcessingSettings)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, status_uuid):
+    """ Settings for the process_status row status_uuid """
+    stamp = digdok_queries.execute("settings_stamp", "select_one", (status_uuid,))
+    if not stamp:
+      raise LookupError("No process settings for " + str(status_uuid))
+    settings_uuid, modified = stamp
+    with self.lock:
+      entry = self.entries.get(settings_uuid)
+      if entry and entry[0] == modified:
+        self.entries.move_to_end(settings_uuid)
+        self.hits += 1
+        print("Settings " + str(settings_uuid) + " reused from cache.")
+        return entry[1]
+    self.misses += 1
+    row = digdok_queries.execute("settings_row", "select_dict", (settings_uuid,))
+    if not row:
+      raise LookupError("No process settings row " + str(settings_uuid))
+    settings = ProcessingSettings.from_row(row)
+    with self.lock:
+      self.entries[settings_uuid] = (modified, settings)
+      self.entries.move_to_end(settings_uuid)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    return settings
+
+  def invalidate(self, settings_uuid=None):
+    with self.lock:
+      if settings_uuid is None:
+        self.entries.clear()
+      else:
+        self.entries.pop(settings_uuid, None)
+
+cache = SettingsCache()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+#
+# Image sharpness pre-filter, run on the Photos folder before Metashape loads it.
+#
+# Each photo is decoded at reduced size (the JPEG decoder's draft mode scales
+# down while decoding), converted to greyscale and scored by the standard
+# deviation of its Laplacian over the standard deviation of the image: blurred
+# photos have little high frequency content, and dividing by the contrast keeps
+# dim or flat photos from looking blurred. Photos are scored in a process pool
+# and the scores are cached in the capture's PhotoIndex, so a resumed capture
+# only scores new photos. Photos that can't be read are cached as FAILED.
+#
+# The score is not on Metashape's Image/Quality scale, and is never written to
+# it. calibrate() fits a line from score to quality on a sample of cameras
+# Metashape analyzed, and screen() uses it to tell which of the rest are
+# clearly sharp and don't need Metashape's analysis. Only Metashape's own
+# quality values disable cameras. Needs Pillow and numpy.
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+  import numpy
+  from PIL import Image
+except ImportError:
+  numpy = None
+  Image = None
+
+
+THUMBNAIL_SIZE = 1024 # Long side of the image the score is computed on
+CHUNK_SIZE = 8 # Photos handed to a worker process at a time
+FAILED = -1.0 # Cached score of a photo that couldn't be read, NaN would be stored as NULL
+SAMPLE_SIZE = 24 # Cameras Metashape analyzes to calibrate the scores of a chunk
+MIN_CORRELATION = 0.8 # Weaker fits leave every camera to Metashape
+MARGIN = 0.15 # Predicted quality above the threshold by this much counts as clearly sharp
+
+
+def available():
+  return numpy is not None and Image is not None
+
+def score(path):
+  """ Laplacian standard deviation over image standard deviation of path scaled to THUMBNAIL_SIZE,
+  FAILED if the photo can't be read """
+  try:
+    with Image.open(path) as image:
+      image.draft("L", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+      image = image.convert("L")
+      # draft() only scales by powers of two, resize so every camera is scored at the same size
+      image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+      pixels = numpy.asarray(image, dtype=numpy.float32)
+  except OSError as e:
+    print("Could not score " + path + ": " + str(e))
+    return FAILED
+  laplacian = (
+    pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+    - 4 * pixels[1:-1, 1:-1]
+  )
+  # Both grow linearly with contrast, +1 keeps a blank frame from dividing by zero
+  return float(laplacian.std() / (pixels.std() + 1.0))
+
+def score_all(paths, workers=None):
+  """ score() of each path in order, in a process pool """
+  if not paths:
+    return []
+  workers = workers or os.cpu_count()
+  try:
+    # Spawned, not forked: this runs inside Metashape, which holds threads and locks a fork would copy
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+      return list(executor.map(score, paths, chunksize=CHUNK_SIZE))
+  except (OSError, BrokenProcessPool) as e:
+    # Embedded interpreters can't always start worker processes, decoding mostly releases the GIL
+    print("Process pool unavailable (" + str(e) + "), scoring photos in threads.")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      return list(executor.map(score, paths))
+
+# -----------------------------------------------------------------
+
+def scores(inventory, index, workers=None):
+  """ {path: score} of the photos in the inventory, scoring the ones the index has no score for.
+  Photos that couldn't be read are left out """
+  values = index.get_column("sharpness_ratio", inventory.paths)
+  missing = [path for path in inventory.paths if values.get(path) is None]
+  if missing:
+    print("Scoring sharpness of " + str(len(missing)) + " photos.")
+    computed = score_all(missing, workers)
+    index.set_column("sharpness_ratio", zip(missing, computed))
+    values.update(zip(missing, computed))
+  return {path: value for path, value in values.items() if value is not None and value != FAILED}
+
+def sample(scores, size=SAMPLE_SIZE):
+  """ Up to size paths spread evenly over the range of scores, for calibrate() """
+  ranked = sorted(scores, key=scores.get)
+  if len(ranked) <= size:
+    return ranked
+  return [ranked[round(i * (len(ranked) - 1) / (size - 1))] for i in range(size)]
+
+def calibrate(scores, qualities):
+  """ (slope, intercept) of Metashape quality against score over the paths in qualities,
+  None if the fit is too weak to predict from """
+  paths = [path for path in qualities if path in scores]
+  if len(paths) < 3:
+    return None
+  x = numpy.array([scores[path] for path in paths])
+  y = numpy.array([qualities[path] for path in paths])
+  if x.std() == 0 or y.std() == 0:
+    return None
+  correlation = float(numpy.corrcoef(x, y)[0, 1])
+  if not correlation >= MIN_CORRELATION:
+    print("Sharpness scores correlate " + str(round(correlation, 2)) + " with Metashape's quality, not used.")
+    return None
+  slope, intercept = numpy.polyfit(x, y, 1)
+  return float(slope), float(intercept)
+
+def screen(scores, fit, threshold, margin=MARGIN):
+  """ Paths whose quality predicted by fit is clearly above threshold """
+  slope, intercept = fit
+  return [path for path, value in scores.items() if slope * value + intercept >= threshold + margin]
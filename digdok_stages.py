@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#
+# Processing stages of a job and the order they run in.
+#
+# Each Stage names its process_status column, the setting that turns it on,
+# the function doing the work, the stages whose results it needs (requires) and
+# the stages it only has to run after (after), such as optional stages whose
+# failure it can live with. Pipeline.run() starts every enabled stage whose
+# requirements are done, skipped or turned off and whose after stages have
+# ended one way or another, in the order the stages are listed. A stage whose status is already
+# 'done' or 'skip' is not run again. When a stage fails, the stages depending
+# on it are not started, the rest of the job carries on, and run() raises
+# StageError at the end. Every stage is timed.
+#
+# Stages marked exclusive run on their own, in the calling thread, which is
+# what Metashape stages working on the open document need. The others may run
+# next to each other in a thread pool, up to Pipeline.workers at a time.
+
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Stage states
+DONE = "done"
+SKIPPED = "skipped" # done or skipped in an earlier run
+DISABLED = "disabled" # turned off in the settings
+FAILED = "failed"
+BLOCKED = "blocked" # a dependency failed or was blocked
+
+SATISFIED = (DONE, SKIPPED, DISABLED)
+
+
+class StageError(Exception):
+  def __init__(self, failed, blocked):
+    self.failed = failed
+    self.blocked = blocked
+    message = "Stages failed: " + ", ".join(failed)
+    if blocked:
+      message += "; not run because of them: " + ", ".join(blocked)
+    super().__init__(message)
+
+class Stage:
+  """ One processing step. work() does it and returns a dict of new.processing metrics, or None.
+  metrics are added to those when it succeeds, callable values are called for the value """
+
+  __slots__ = ("status", "title", "enabled", "work", "requires", "after", "metrics", "exclusive")
+
+  def __init__(self, status, title, enabled, work, requires=(), metrics=None, exclusive=True, after=()):
+    self.status = status # process_status column, also the stage's name
+    self.title = title
+    self.enabled = enabled
+    self.work = work
+    self.requires = tuple(requires)
+    self.after = tuple(after) # Run after these, whatever their outcome
+    self.metrics = metrics or {}
+    self.exclusive = exclusive # False if it can run next to other stages
+
+  def __call__(self):
+    metrics = dict(self.work() or {})
+    for column, value in self.metrics.items():
+      metrics[column] = value() if callable(value) else value
+    return metrics
+
+  def __repr__(self):
+    return "Stage(" + self.status + ")"
+
+# -----------------------------------------------------------------
+
+class Pipeline:
+  """ Runs stages in dependency order.
+  get_status(column) returns a stage's stored status, start(stage), finish(stage, metrics) and
+  fail(stage, error) are called from the thread calling run() """
+
+  def __init__(self, stages, get_status, start, finish, fail, workers=1):
+    names = [stage.status for stage in stages]
+    for stage in stages:
+      for required in stage.requires + stage.after:
+        if required not in names or names.index(required) >= names.index(stage.status):
+          raise ValueError(stage.status + " requires " + required + ", which is not listed before it")
+    self.stages = stages
+    self.get_status = get_status
+    self.start = start
+    self.finish = finish
+    self.fail = fail
+    self.workers = workers
+    self.states = {}
+    self.seconds = {}
+
+  def timed(self, stage):
+    start = time.perf_counter()
+    try:
+      return stage()
+    finally:
+      self.seconds[stage.status] = round(time.perf_counter() - start, 3)
+
+  def ready(self, stage):
+    """ True if stage can start, None if it has to wait, False if it never can """
+    states = [self.states.get(required) for required in stage.requires]
+    if any(state in (FAILED, BLOCKED) for state in states):
+      return False
+    if all(state in SATISFIED for state in states) and all(self.states.get(other) is not None for other in stage.after):
+      return True
+    return None
+
+  def completed(self, stage, metrics, error):
+    if error is None:
+      self.states[stage.status] = DONE
+      print(stage.title + " done in " + str(self.seconds[stage.status]) + " s.")
+      self.finish(stage, metrics)
+    else:
+      self.states[stage.status] = FAILED
+      print()
+      print("!!!!! Exception !!!!!")
+      print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+      print()
+      self.fail(stage, error)
+
+  def run(self):
+    pending = list(self.stages)
+    running = {} # future -> stage
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      while pending or running:
+        for stage in list(pending):
+          ready = self.ready(stage)
+          if ready is None:
+            continue
+          if ready is False:
+            pending.remove(stage)
+            self.states[stage.status] = BLOCKED
+            print(stage.title + " not run, a stage it depends on failed.\n")
+            continue
+          if not stage.enabled:
+            pending.remove(stage)
+            self.states[stage.status] = DISABLED
+            continue
+          if self.get_status(stage.status) in ["done", "skip"]:
+            pending.remove(stage)
+            self.states[stage.status] = SKIPPED
+            print(stage.title + " already done. Skipping.\n")
+            continue
+          # Stages start in the order listed, an exclusive one waits for the running ones to finish
+          if len(running) >= self.workers or (running and (stage.exclusive or any(other.exclusive for other in running.values()))):
+            break
+          pending.remove(stage)
+          print("")
+          print("***** " + stage.title + " *****")
+          print("")
+          self.start(stage)
+          if stage.exclusive:
+            try:
+              result = self.timed(stage)
+            except Exception as e:
+              self.completed(stage, None, e)
+            else:
+              self.completed(stage, result, None)
+            # Later stages may depend on this one, look at the list again
+            break
+          running[executor.submit(self.timed, stage)] = stage
+
+        if not running:
+          continue
+        finished, not_done = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+          stage = running.pop(future)
+          error = future.exception()
+          self.completed(stage, None if error else future.result(), error)
+
+    failed = [name for name, state in self.states.items() if state == FAILED]
+    if failed:
+      raise StageError(failed, [name for name, state in self.states.items() if state == BLOCKED])
+    return self.states
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Write-behind cache for a job's process_status row and processing metrics.
+#
+# The whole new.process_status row is read once when the job starts and
+# get_status() is answered from memory. Status and metric updates are kept in
+# memory and written as one multi-column UPDATE per table: in the background
+# when a stage finishes or the flush interval runs out, and synchronously when
+# a stage fails or the job ends, so nothing is lost on failure or exit. A
+# metrics batch that fails is retried column by column, and a column that still
+# fails is logged and dropped rather than holding back every later write.
+
+import atexit
+import threading
+
+import digdok_queries
+
+
+FLUSH_INTERVAL = 30 # Seconds between background flushes while a stage is running
+STAGE_BOUNDARY = ["done", "skip"] # Statuses that end a stage and trigger a background flush
+
+
+class StatusCache:
+
+  def __init__(self, uuid, processing_uuid=None, flush_interval=FLUSH_INTERVAL):
+    self.uuid = uuid
+    self.processing_uuid = processing_uuid
+    self.flush_interval = flush_interval
+    self.lock = threading.Lock() # Guards the pending writes
+    self.flush_lock = threading.Lock() # One flush at a time, so writes reach the database in order
+    self.pending_status = {}
+    self.pending_processing = {}
+    self.row = self.load()
+    self.wake = threading.Event()
+    self.stopped = False
+    self.thread = threading.Thread(target=self.flusher, name="status-" + str(uuid), daemon=True)
+    self.thread.start()
+    atexit.register(self.close)
+
+  def load(self):
+    row = digdok_queries.execute("process_status_row", "select_dict", (self.uuid,))
+    if row is None:
+      raise LookupError("No process_status row for " + str(self.uuid))
+    return row
+
+  # -----------------------------------------------------------------
+
+  def get_status(self, step):
+    with self.lock:
+      return self.row[step]
+
+  def update_status(self, step, status):
+    with self.lock:
+      if step not in self.row or step not in digdok_queries.STATUS_COLUMNS:
+        print("process_status has no status column " + step + ", status not updated.")
+        return
+      self.row[step] = status
+      self.pending_status[step] = status
+    if status == "failed":
+      # Make failures durable straight away, without hiding the stage's own error if the database fails
+      try:
+        self.flush()
+      except Exception as e:
+        # Pending writes were put back, the next flush retries them
+        print("Status flush after failure of " + step + " failed: " + str(e))
+    elif status in STAGE_BOUNDARY:
+      self.flush_async()
+    print("Updated " + step + " status to '" + status + "'. \n")
+
+  def update_processing(self, step, value):
+    if step not in digdok_queries.PROCESSING_COLUMNS:
+      print("processing has no metric column " + step + ", not updated.")
+      return
+    with self.lock:
+      self.pending_processing[step] = value
+
+  # -----------------------------------------------------------------
+
+  def flush_async(self):
+    self.wake.set()
+
+  def flusher(self):
+    while not self.stopped:
+      self.wake.wait(self.flush_interval)
+      self.wake.clear()
+      try:
+        self.flush()
+      except Exception as e:
+        # Pending writes were put back, the next flush retries them
+        print("Background status flush failed: " + str(e))
+
+  def flush(self):
+    with self.flush_lock:
+      with self.lock:
+        status, self.pending_status = self.pending_status, {}
+        processing, self.pending_processing = self.pending_processing, {}
+      try:
+        if status:
+          self.write("process_status", self.uuid, status)
+        if processing:
+          if self.processing_uuid is None:
+            raise ValueError("processing_uuid not set, can't write " + ", ".join(processing))
+          try:
+            self.write("processing", self.processing_uuid, processing)
+          except Exception as e:
+            print("Processing metrics batch failed (" + str(e) + "), writing the columns one by one.")
+            self.write_each("processing", self.processing_uuid, processing)
+      except Exception:
+        # Put the writes back underneath anything newer that came in meanwhile
+        with self.lock:
+          self.pending_status = {**status, **self.pending_status}
+          self.pending_processing = {**processing, **self.pending_processing}
+        raise
+
+  @staticmethod
+  def write(table, uuid, values):
+    digdok_queries.update_columns(table, uuid, values)
+    values.clear()
+
+  @staticmethod
+  def write_each(table, uuid, values):
+    """ Write each column on its own, so one bad column doesn't hold back the rest. Columns that still fail are dropped. """
+    for column, value in list(values.items()):
+      try:
+        digdok_queries.update_columns(table, uuid, {column: value})
+      except Exception as e:
+        print("Dropped " + table + "." + column + " = " + str(value) + ": " + str(e))
+      del values[column]
+
+  def close(self):
+    """ Stop the background flusher and write everything that is still pending """
+    atexit.unregister(self.close)
+    self.stopped = True
+    self.wake.set()
+    self.thread.join()
+    try:
+      self.flush()
+    except Exception as e:
+      # Don't replace the exception that ended the job, if any
+      print("Final status flush failed, pending writes lost: " + str(e))
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# Several workers on one node, each in its own process.
+#
+# digdok_metashape keeps the open project, settings and stage state in module
+# globals, starting with doc = Metashape.Document(). Rather than threading all
+# of that through, every worker is a separate process started with the
+# 'spawn' method, so it imports the modules afresh and gets its own Document,
+# database pool and claimed job; nothing is shared through fork. Workers
+# coordinate only through the database (leases, node budget) and the stage
+# slots in digdok_scheduler.py.
+#
+# Supervisor keeps up to scheduler.NODE_JOBS workers running. A worker that
+# dies without finishing cleanly has the job it held marked failed and is
+# restarted, waiting longer after each quick crash. Signals go to the
+# supervisor only (workers run in their own process group) and are passed on:
+# the first lets every worker finish its job, a second stops them now.
+
+import os
+import sys
+import time
+import signal
+import socket
+import multiprocessing
+
+import digdok_queue as queue
+import digdok_scheduler as scheduler
+
+
+CHECK_INTERVAL = 1 # Seconds between checks on the workers
+MIN_UPTIME = 60 # A worker dying sooner than this counts as a quick crash
+RESTART_DELAY = 5 # Seconds before restarting after a quick crash, doubled each time
+MAX_RESTART_DELAY = 600
+
+context = multiprocessing.get_context("spawn")
+
+
+def worker(number, options, log_folder=None):
+  """ Worker process entry point, options are passed to digdok_main.work() """
+  if hasattr(os, "setpgrp"):
+    os.setpgrp()
+  if log_folder:
+    log = open(os.path.join(log_folder, "worker-" + str(number) + ".log"), "a", buffering=1)
+    sys.stdout = sys.stderr = log
+  import digdok_main
+  digdok_main.work(**options)
+
+# -----------------------------------------------------------------
+
+class Supervisor:
+  """ Keeps a number of worker processes running, restarting them when they crash """
+
+  def __init__(self, workers, options, log_folder=None):
+    if workers > scheduler.NODE_JOBS:
+      print("Node budget allows " + str(scheduler.NODE_JOBS) + " jobs, starting " + str(scheduler.NODE_JOBS) + " workers instead of " + str(workers) + ".")
+      workers = scheduler.NODE_JOBS
+    self.workers = workers
+    self.options = options
+    self.log_folder = log_folder
+    self.processes = {} # worker number -> Process
+    self.started = {} # worker number -> monotonic start time
+    self.delays = {} # worker number -> restart delay after its last quick crash
+    self.restart_at = {} # worker number -> monotonic time to restart it
+    self.signals = 0
+
+  def handle(self, signum, frame):
+    self.signals += 1
+    if self.signals == 1:
+      print()
+      print("Shutdown requested, workers finish their current job. Signal again to stop now.")
+    for process in self.processes.values():
+      if process.is_alive():
+        os.kill(process.pid, signum)
+
+  def start(self, number):
+    process = context.Process(
+      target=worker, args=(number, self.options, self.log_folder), name="digdok-worker-" + str(number)
+    )
+    process.start()
+    self.processes[number] = process
+    self.started[number] = time.monotonic()
+    print("Started worker " + str(number) + " (pid " + str(process.pid) + ").")
+
+  def exited(self, number, process):
+    worker_id = socket.gethostname() + ":" + str(process.pid) # digdok_queue.worker_id of that process
+    del self.processes[number]
+    if process.exitcode == 0:
+      print("Worker " + str(number) + " finished.")
+      return
+    print("!!!!! Worker " + str(number) + " (pid " + str(process.pid) + ") exited with code " + str(process.exitcode) + " !!!!!")
+    if self.signals:
+      # Stopped on request, an interrupted job goes back to the queue when its lease runs out
+      return
+    try:
+      queue.fail_worker_jobs(worker_id)
+    except Exception as e:
+      print("Could not mark the jobs of " + worker_id + " failed: " + str(e))
+    if time.monotonic() - self.started[number] < MIN_UPTIME:
+      delay = min(self.delays.get(number, RESTART_DELAY / 2) * 2, MAX_RESTART_DELAY)
+    else:
+      delay = 0
+    self.delays[number] = delay or RESTART_DELAY / 2
+    self.restart_at[number] = time.monotonic() + delay
+    if delay:
+      print("Restarting worker " + str(number) + " in " + str(delay) + " s.")
+
+  def run(self):
+    signal.signal(signal.SIGINT, self.handle)
+    signal.signal(signal.SIGTERM, self.handle)
+    if self.log_folder:
+      os.makedirs(self.log_folder, exist_ok=True)
+    for number in range(self.workers):
+      self.start(number)
+
+    while self.processes or (self.restart_at and not self.signals):
+      for number, process in list(self.processes.items()):
+        if not process.is_alive():
+          process.join()
+          self.exited(number, process)
+      for number, at in list(self.restart_at.items()):
+        if not self.signals and time.monotonic() >= at:
+          del self.restart_at[number]
+          self.start(number)
+      time.sleep(CHECK_INTERVAL)
+    print("All workers stopped.")
@@ -0,0 +1,16 @@
+-- Leases for atomic job claiming, see digdok_queue.py
+--
+-- A worker claims a capture by setting status to 'processing' together with its
+-- worker id and a lease expiry, in the same statement that picks the row. The
+-- status the row had while queued is kept so an expired lease can put it back.
+
+ALTER TABLE new.process_status
+  ADD COLUMN IF NOT EXISTS worker_id text,
+  ADD COLUMN IF NOT EXISTS claimed_at timestamptz,
+  ADD COLUMN IF NOT EXISTS lease_expires timestamptz,
+  ADD COLUMN IF NOT EXISTS queued_status text,
+  ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS process_status_lease_idx
+  ON new.process_status (lease_expires)
+  WHERE status = 'processing';
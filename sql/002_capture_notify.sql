@@ -0,0 +1,19 @@
+-- Wake idle workers when a capture is queued, see digdok_queue.Listener
+--
+-- Fires on new process_status rows and whenever a row's status changes to
+-- something that is not being worked on or finished, e.g. when a capture is
+-- re-queued by hand or an expired lease is returned to the queue.
+
+CREATE OR REPLACE FUNCTION new.notify_capture_queued() RETURNS trigger AS $$
+BEGIN
+  IF NEW.status IS NULL OR NEW.status NOT IN ('processing', 'done', 'skip', 'failed') THEN
+    PERFORM pg_notify('digdok_capture_queued', NEW.uuid::text);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS process_status_notify_queued ON new.process_status;
+CREATE TRIGGER process_status_notify_queued
+  AFTER INSERT OR UPDATE OF status ON new.process_status
+  FOR EACH ROW EXECUTE FUNCTION new.notify_capture_queued();
@@ -0,0 +1,19 @@
+-- Modified timestamp on setting groups, see digdok_settings.SettingsCache
+--
+-- Workers keep parsed settings in memory and only fetch a setting group again
+-- when its modified timestamp has changed.
+
+ALTER TABLE new.process_settings
+  ADD COLUMN IF NOT EXISTS modified timestamptz NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION new.touch_process_settings() RETURNS trigger AS $$
+BEGIN
+  NEW.modified := now();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS process_settings_touch ON new.process_settings;
+CREATE TRIGGER process_settings_touch
+  BEFORE UPDATE ON new.process_settings
+  FOR EACH ROW EXECUTE FUNCTION new.touch_process_settings();
@@ -0,0 +1,4 @@
+-- Number of duplicate photos left out of a capture's chunk, see digdok_dedup.py
+
+ALTER TABLE new.processing
+  ADD COLUMN IF NOT EXISTS duplicates_dropped integer;
@@ -0,0 +1,4 @@
+-- Per-pass point counts and timings of error reduction, see digdok_errorreduction.reduce()
+
+ALTER TABLE new.processing
+  ADD COLUMN IF NOT EXISTS error_reduction jsonb;
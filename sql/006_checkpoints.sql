@@ -0,0 +1,4 @@
+-- Project saves of a job (reason, stages covered, seconds), see digdok_checkpoint.py
+
+ALTER TABLE new.processing
+  ADD COLUMN IF NOT EXISTS checkpoints jsonb;
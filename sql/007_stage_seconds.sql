@@ -0,0 +1,4 @@
+-- Wall time of each processing stage of a job, see digdok_stages.py
+
+ALTER TABLE new.processing
+  ADD COLUMN IF NOT EXISTS stage_seconds jsonb;
@@ -0,0 +1,19 @@
+-- Resource use of each processing stage, see digdok_instrument.py
+
+CREATE TABLE IF NOT EXISTS new.stage_timing (
+  id bigserial PRIMARY KEY,
+  processing_uuid uuid NOT NULL REFERENCES new.processing (uuid) ON DELETE CASCADE,
+  stage text NOT NULL,
+  outcome text NOT NULL,
+  started_at timestamptz NOT NULL,
+  wall_seconds double precision,
+  cpu_seconds double precision,
+  peak_rss_bytes bigint,
+  bytes_written bigint,
+  counts jsonb,
+  parameters jsonb,
+  worker_id text
+);
+
+CREATE INDEX IF NOT EXISTS stage_timing_processing_idx ON new.stage_timing (processing_uuid);
+CREATE INDEX IF NOT EXISTS stage_timing_stage_idx ON new.stage_timing (stage, started_at);
@@ -0,0 +1,30 @@
+-- Estimated runtime and peak memory of queued captures, see digdok_estimator.py
+--
+-- estimated_at is set when a capture was estimated, or when estimating it
+-- failed (estimated_seconds stays NULL), so it isn't tried on every claim.
+-- Changing a setting group clears the estimates of its captures that haven't
+-- started, they are estimated again with the new settings.
+
+ALTER TABLE new.process_status
+  ADD COLUMN IF NOT EXISTS estimated_seconds double precision,
+  ADD COLUMN IF NOT EXISTS estimated_memory bigint,
+  ADD COLUMN IF NOT EXISTS estimated_at timestamptz;
+
+CREATE INDEX IF NOT EXISTS process_status_estimate_idx
+  ON new.process_status (estimated_seconds);
+
+CREATE OR REPLACE FUNCTION new.clear_capture_estimates() RETURNS trigger AS $$
+BEGIN
+  UPDATE new.process_status
+  SET estimated_seconds = NULL, estimated_memory = NULL, estimated_at = NULL
+  WHERE settings_uuid = NEW.uuid
+    AND estimated_at IS NOT NULL
+    AND (status IS NULL OR status NOT IN ('processing', 'done', 'skip', 'failed'));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS process_settings_clear_estimates ON new.process_settings;
+CREATE TRIGGER process_settings_clear_estimates
+  AFTER UPDATE ON new.process_settings
+  FOR EACH ROW EXECUTE FUNCTION new.clear_capture_estimates();
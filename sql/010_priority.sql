@@ -0,0 +1,29 @@
+-- Capture priorities for the scheduler, see digdok_scheduler.py
+--
+-- queued_at is when a capture entered the queue. It is kept when an expired
+-- lease returns a capture to the queue, and reset when a finished or failed
+-- capture is queued again, so aging starts over.
+-- Captures are estimated (digdok_estimator.py) in queued_at order, and one
+-- whose estimate failed is tried again once it is queued again.
+
+ALTER TABLE new.process_status
+  ADD COLUMN IF NOT EXISTS priority integer NOT NULL DEFAULT 0,
+  ADD COLUMN IF NOT EXISTS queued_at timestamptz DEFAULT now();
+
+CREATE OR REPLACE FUNCTION new.set_capture_queued_at() RETURNS trigger AS $$
+BEGIN
+  IF OLD.status IN ('done', 'skip', 'failed')
+     AND (NEW.status IS NULL OR NEW.status NOT IN ('processing', 'done', 'skip', 'failed')) THEN
+    NEW.queued_at := now();
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS process_status_queued_at ON new.process_status;
+CREATE TRIGGER process_status_queued_at
+  BEFORE UPDATE OF status ON new.process_status
+  FOR EACH ROW EXECUTE FUNCTION new.set_capture_queued_at();
+
+CREATE INDEX IF NOT EXISTS process_status_priority_idx
+  ON new.process_status (priority DESC, queued_at);
@@ -0,0 +1,18 @@
+-- Stages sent to a Metashape network processing server, see digdok_offload.py
+
+CREATE TABLE IF NOT EXISTS new.offload_batch (
+  id bigserial PRIMARY KEY,
+  processing_uuid uuid NOT NULL REFERENCES new.processing (uuid) ON DELETE CASCADE,
+  stage text NOT NULL,
+  backend text NOT NULL,
+  server text,
+  batch_id text NOT NULL,
+  tasks jsonb,
+  worker_id text,
+  status text NOT NULL DEFAULT 'submitted',
+  submitted_at timestamptz NOT NULL DEFAULT now(),
+  finished_at timestamptz,
+  seconds double precision
+);
+
+CREATE INDEX IF NOT EXISTS offload_batch_processing_idx ON new.offload_batch (processing_uuid);
@@ -0,0 +1,4 @@
+-- Timings and sizes of the export outputs of a job, see digdok_export.py
+
+ALTER TABLE new.processing
+  ADD COLUMN IF NOT EXISTS exports jsonb;
@@ -0,0 +1,4 @@
+-- Mesh post-processing results of a job, see digdok_meshpost.py
+
+ALTER TABLE new.processing
+  ADD COLUMN IF NOT EXISTS mesh_post jsonb;